@@ -0,0 +1,317 @@
+import mmap
+import pickle
+import threading
+from array import array
+from collections import Counter
+from collections.abc import Sequence
+from itertools import accumulate, chain
+
+# file text is stored utf-8 encoded, surrogatepass keeps the round trip exact for any str
+TEXT_ENCODING = "utf-8"
+TEXT_ERRORS = "surrogatepass"
+
+
+class NgramIndex:
+    """Trigram index over the files of a TextBuffer, used to skip files that cannot contain a string.
+    Files are identified by their offset in the buffer, empty files are not indexed.
+    """
+
+    def __init__(self, typecode="I"):
+        # offset of a file in the buffer -> slot, postings are arrays of the sorted slots of the files holding a gram
+        self.typecode = typecode
+        self.slots = {}
+        self.postings = {}
+        # last two characters of each file, trigrams do not cover the bigram at the very end
+        self.tails = {}
+        self.bigrams = None
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        starts = buffer.file_starts
+        # two bytes per posting are enough for most repositories
+        ngram_index = cls("H" if len(starts) <= 1 << 16 else "I")
+        for i, base in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else len(buffer)
+            ngram_index.add_file(base, buffer.decode(base, end))
+        return ngram_index
+
+    def add_file(self, base, text):
+        if not text:
+            return
+        slot = len(self.slots)
+        self.slots[base] = slot
+        postings = self.postings
+        for gram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            if gram not in postings:
+                postings[gram] = array(self.typecode)
+            postings[gram].append(slot)
+        if len(text) >= 2:
+            if text[-2:] not in self.tails:
+                self.tails[text[-2:]] = array(self.typecode)
+            self.tails[text[-2:]].append(slot)
+
+    def get_bigram_postings(self):
+        if self.bigrams is None:
+            bigrams = {gram: set(slots) for gram, slots in self.tails.items()}
+            for gram, slots in self.postings.items():
+                if gram[:2] not in bigrams:
+                    bigrams[gram[:2]] = set()
+                bigrams[gram[:2]].update(slots)
+            self.bigrams = {gram: array(self.typecode, sorted(slots)) for gram, slots in bigrams.items()}
+        return self.bigrams
+
+    def match_slots(self, query, max_l_dist=0):
+        """Slots of the files that may contain query within max_l_dist edits, or None if the query is too short to tell."""
+        # q-gram lemma: a match with at most k edits keeps at least len(query) - q + 1 - k * q of the q-grams of the query
+        for q, postings in ((3, self.postings), (2, None)):
+            threshold = len(query) - q + 1 - max_l_dist * q
+            if threshold > 0:
+                break
+        else:
+            return None
+        if postings is None:
+            postings = self.get_bigram_postings()
+        gram_slots = [postings.get(query[i:i + q], ()) for i in range(len(query) - q + 1)]
+        if threshold == len(gram_slots):
+            gram_slots.sort(key=len)
+            slots = set(gram_slots[0])
+            for other_slots in gram_slots[1:]:
+                slots.intersection_update(other_slots)
+            return slots
+        counts = Counter(chain.from_iterable(gram_slots))
+        return {slot for slot, count in counts.items() if count >= threshold}
+
+    def may_contain(self, slots, base):
+        """Check the file at base against the slots returned by match_slots, files that are not indexed always pass."""
+        slot = self.slots.get(base)
+        return slots is None or slot is None or slot in slots
+
+
+# the n-gram index of a buffer is built by the first search that needs it
+ngram_index_lock = threading.Lock()
+
+
+class TextBuffer:
+    """Encoded text of many files concatenated in one buffer.
+    The data is bytes, or a memoryview of an mmap when the structure was loaded from the cache.
+    """
+
+    __slots__ = ("data", "file_starts", "ngram_index")
+
+    def __init__(self, data=b"", file_starts=None):
+        self.data = data
+        # offset of each file in the buffer, in the order they were added, None if the files are unknown
+        self.file_starts = file_starts
+        self.ngram_index = None
+
+    def decode(self, start, end):
+        return str(self.data[start:end], TEXT_ENCODING, TEXT_ERRORS)
+
+    def get_ngram_index(self, build=True):
+        """The n-gram index of the files, built on first use. None if it is not built yet and build is False,
+        or if the files of the buffer are unknown.
+        """
+        if self.ngram_index is None and build and self.file_starts is not None:
+            with ngram_index_lock:
+                if self.ngram_index is None:
+                    self.ngram_index = NgramIndex.from_buffer(self)
+        return self.ngram_index
+
+    def __len__(self):
+        return len(self.data)
+
+    def __reduce__(self):
+        return TextBuffer, (bytes(self.data), self.file_starts)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class FileLines(Sequence):
+    """Read-only list of the lines of a file, backed by a byte range of a shared TextBuffer.
+    Lines are decoded on access, so a structure only holds one encoded copy of each file and
+    the "text" of classes and functions are views over the lines of their file.
+    """
+
+    __slots__ = ("buffer", "base", "offsets", "start", "stop")
+
+    def __init__(self, buffer, base, offsets, start=0, stop=None):
+        # offsets[i] is the start of line i relative to base, the last entry is one past the end of the text
+        self.buffer = buffer
+        self.base = base
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets) - 1 if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.lines()[index]
+            return self.view(start, stop).lines()
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        line = self.start + index
+        return self.buffer.decode(
+            self.base + self.offsets[line], self.base + self.offsets[line + 1] - 1
+        )
+
+    def __iter__(self):
+        return iter(self.lines())
+
+    def view(self, start, stop):
+        """Lines [start:stop] as a FileLines sharing the same buffer, clamped like a list slice."""
+        line_range = range(self.start, self.stop)[start:stop]
+        return FileLines(self.buffer, self.base, self.offsets, line_range.start, max(line_range.start, line_range.stop))
+
+    def text(self):
+        """The lines joined with "\\n", same as "\\n".join(lines) but without splitting the text."""
+        if not len(self):
+            return ""
+        return self.buffer.decode(
+            self.base + self.offsets[self.start], self.base + self.offsets[self.stop] - 1
+        )
+
+    def lines(self):
+        if not len(self):
+            return []
+        return self.text().split("\n")
+
+    def __eq__(self, other):
+        if isinstance(other, (FileLines, list, tuple)):
+            return self.lines() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return self.lines() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.lines()
+
+    def __repr__(self):
+        return repr(self.lines())
+
+    def __reduce__(self):
+        return FileLines, (self.buffer, self.base, self.offsets, self.start, self.stop)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def join_lines(lines):
+    """Same as "\n".join(lines), without splitting a FileLines first."""
+    if isinstance(lines, FileLines):
+        return lines.text()
+    return "\n".join(lines)
+
+
+class TextBufferBuilder:
+    """Collects the lines of many files into one TextBuffer.
+    The returned FileLines can only be read once finish() has been called.
+    """
+
+    def __init__(self):
+        self.buffer = TextBuffer(file_starts=array("I"))
+        self.chunks = []
+        self.size = 0
+
+    def add(self, lines):
+        """Add the lines of a file to the buffer.
+        :param lines: Lines of the file, without line endings.
+        :return: A FileLines over the added lines.
+        """
+        text = "\n".join(lines)
+        data = text.encode(TEXT_ENCODING, TEXT_ERRORS)
+        if text.isascii():
+            line_sizes = (len(line) + 1 for line in lines)
+        else:
+            line_sizes = (len(line.encode(TEXT_ENCODING, TEXT_ERRORS)) + 1 for line in lines)
+        offsets = array("I", accumulate(chain((0,), line_sizes)))
+        file_lines = FileLines(self.buffer, self.size, offsets)
+        self.buffer.file_starts.append(self.size)
+        self.chunks.append(data)
+        self.size += len(data)
+        return file_lines
+
+    def finish(self):
+        self.buffer.data = b"".join(self.chunks)
+        self.chunks = []
+        return self.buffer
+
+
+class StructurePickler(pickle.Pickler):
+    # text buffers go to a separate file so that loading can mmap them instead of copying
+    def __init__(self, file, text_file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.text_file = text_file
+        self.text_size = 0
+        self.buffer_ids = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, TextBuffer):
+            return None
+        if id(obj) not in self.buffer_ids:
+            self.text_file.write(obj.data)
+            # keep a reference to obj, its id must not be reused while pickling
+            self.buffer_ids[id(obj)] = (obj, self.text_size, len(obj))
+            self.text_size += len(obj)
+        _, offset, size = self.buffer_ids[id(obj)]
+        # the n-gram index is not pickled, it is rebuilt from the text when a search needs it
+        return offset, size, obj.file_starts
+
+
+class StructureUnpickler(pickle.Unpickler):
+    def __init__(self, file, text_data):
+        super().__init__(file)
+        self.text_data = text_data
+        self.buffers = {}
+
+    def persistent_load(self, pid):
+        offset, size, file_starts = pid
+        if not isinstance(file_starts, array):
+            # written with the n-gram index in the pickle, its files are not known
+            file_starts = None
+        if (offset, size) not in self.buffers:
+            self.buffers[(offset, size)] = TextBuffer(self.text_data[offset:offset + size], file_starts)
+        return self.buffers[(offset, size)]
+
+
+def dump_structure(structure, file, text_file):
+    """Pickle a structure, writing the text buffers it references to a separate file.
+    :param structure: The structure to pickle.
+    :param file: Binary file the pickle is written to.
+    :param text_file: Binary file the text buffers are written to.
+    :return: None
+    """
+    StructurePickler(file, text_file).dump(structure)
+
+
+def load_structure(file, text_path=None, use_mmap=True):
+    """Load a structure written by dump_structure.
+    :param file: Binary file the pickle is read from.
+    :param text_path: Path to the file the text buffers were written to.
+    :param use_mmap: Map the text file instead of reading it, so the pages are shared by every process loading it.
+    :return: The structure.
+    """
+    text_data = memoryview(b"")
+    if text_path is not None:
+        with open(text_path, "rb") as f:
+            if use_mmap and f.seek(0, 2) > 0:
+                text_data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            else:
+                f.seek(0)
+                text_data = memoryview(f.read())
+    return StructureUnpickler(file, text_data).load()
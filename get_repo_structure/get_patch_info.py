@@ -67,3 +67,131 @@ def parse_patch(patch):
         file_changes.append(current_file)
 
     return file_changes
+
+
+def split_patch_by_file(patch):
+    """
+    Split a git patch into per-file hunks that can be applied in memory.
+
+    Parameters:
+        patch (str): The git patch as a string.
+
+    Returns:
+        list: A list of dictionaries with the old path, the new path (None for /dev/null) and the hunks.
+              Each hunk is a dictionary with the old start line, the old lines and the new lines,
+              and whether the old and the new side end without a newline at the end of the file.
+
+    Raises:
+        ValueError: If the patch contains changes that cannot be applied line by line (binary or malformed hunks).
+    """
+    file_patches = []
+    current_file = None
+    lines = patch.split("\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("diff --git"):
+            match = re.match(r"diff --git a/(.+?) b/(.+)$", line)
+            if not match:
+                raise ValueError(f"Malformed diff header: {line}")
+            current_file = {
+                "old_file": match.group(1),
+                "new_file": match.group(2),
+                "hunks": [],
+            }
+            file_patches.append(current_file)
+        elif line.startswith("Binary files") or line.startswith("GIT binary patch"):
+            raise ValueError("Binary patches are not supported")
+        elif current_file is not None and line.startswith("--- "):
+            path = line[4:].strip()
+            current_file["old_file"] = None if path == "/dev/null" else path[2:] if path.startswith("a/") else path
+        elif current_file is not None and line.startswith("+++ "):
+            path = line[4:].strip()
+            current_file["new_file"] = None if path == "/dev/null" else path[2:] if path.startswith("b/") else path
+        elif current_file is not None and line.startswith("deleted file mode"):
+            current_file["new_file"] = None
+        elif current_file is not None and line.startswith("new file mode"):
+            current_file["old_file"] = None
+        elif current_file is not None and line.startswith("@@ "):
+            match = re.match(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@", line)
+            if not match:
+                raise ValueError(f"Malformed hunk header: {line}")
+            old_count = int(match.group(2)) if match.group(2) is not None else 1
+            new_count = int(match.group(4)) if match.group(4) is not None else 1
+            hunk = {
+                "old_start": int(match.group(1)),
+                "old_lines": [],
+                "new_lines": [],
+                "old_no_newline": False,
+                "new_no_newline": False,
+            }
+            tag = None
+            # consume exactly the number of lines announced in the header, and the end of file marker of the last line
+            while i + 1 < len(lines) and (
+                len(hunk["old_lines"]) < old_count
+                or len(hunk["new_lines"]) < new_count
+                or lines[i + 1].startswith("\\")
+            ):
+                i += 1
+                hunk_line = lines[i]
+                if hunk_line.startswith("\\"):
+                    # "\ No newline at end of file" applies to the line before it
+                    if tag in ("-", " "):
+                        hunk["old_no_newline"] = True
+                    if tag in ("+", " "):
+                        hunk["new_no_newline"] = True
+                    continue
+                tag, text = (hunk_line[0], hunk_line[1:]) if hunk_line else (" ", "")
+                if tag == " ":
+                    hunk["old_lines"].append(text)
+                    hunk["new_lines"].append(text)
+                elif tag == "-":
+                    hunk["old_lines"].append(text)
+                elif tag == "+":
+                    hunk["new_lines"].append(text)
+                else:
+                    raise ValueError(f"Malformed hunk line: {hunk_line}")
+            if len(hunk["old_lines"]) != old_count or len(hunk["new_lines"]) != new_count:
+                raise ValueError(f"Truncated hunk: {line}")
+            current_file["hunks"].append(hunk)
+        i += 1
+
+    return file_patches
+
+
+def apply_hunks(lines, hunks):
+    """
+    Apply the hunks of one file to its lines.
+
+    Parameters:
+        lines (list): The lines of the original file, without line endings.
+        hunks (list): The hunks returned by split_patch_by_file for this file.
+
+    Returns:
+        list: The lines of the patched file.
+
+    Raises:
+        ValueError: If a hunk does not match the original lines.
+    """
+    new_lines = []
+    position = 0
+    for hunk in hunks:
+        old_block = hunk["old_lines"]
+        # a hunk that removes nothing is inserted after old_start, otherwise it starts at old_start
+        expected = hunk["old_start"] if not old_block else hunk["old_start"] - 1
+        index = None
+        # like git apply, look for the block around the announced position if the file has drifted
+        for offset in range(len(lines) + 1):
+            for candidate in (expected - offset, expected + offset):
+                if position <= candidate <= len(lines) - len(old_block) and lines[candidate:candidate + len(old_block)] == old_block:
+                    index = candidate
+                    break
+            if index is not None:
+                break
+        if index is None:
+            raise ValueError(f"Hunk at line {hunk['old_start']} does not apply")
+        new_lines.extend(lines[position:index])
+        new_lines.extend(hunk["new_lines"])
+        position = index + len(old_block)
+    new_lines.extend(lines[position:])
+    return new_lines
@@ -1,10 +1,37 @@
 import ast
+import hashlib
+import multiprocessing
 import os
 import subprocess
+import threading
 import uuid
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from filelock import FileLock
+from get_repo_structure.file_text import TextBufferBuilder, dump_structure, load_structure
+from get_repo_structure.get_patch_info import apply_hunks, split_patch_by_file
 sys.setrecursionlimit(10000)
 
+# persistent bare mirrors of the benchmark repos, per-call checkouts are shared clones of these
+REPO_MIRROR_DIR = os.environ.get(
+    "REPO_MIRROR_DIR", os.path.join(os.path.expanduser("~"), ".cache", "patchpilot", "mirrors")
+)
+
+# parsed structures keyed by (repo, commit, patch hash), least recently used entries are evicted past the size bound
+STRUCTURE_CACHE_DIR = os.environ.get(
+    "STRUCTURE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "patchpilot", "structures")
+)
+STRUCTURE_CACHE_MAX_BYTES = int(os.environ.get("STRUCTURE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+# the file text of cached structures is mmapped on load, so threads and processes share the pages
+STRUCTURE_TEXT_MMAP = os.environ.get("STRUCTURE_TEXT_MMAP", "1") == "1"
+
+# create_structure parses files in a process pool shared by all threads, small repos are parsed in-process
+STRUCTURE_PARSE_WORKERS = int(os.environ.get("STRUCTURE_PARSE_WORKERS", os.cpu_count() or 1))
+MIN_FILES_FOR_PARSE_POOL = 200
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
 repo_to_top_folder = {
     "django/django": "django",
     "sphinx-doc/sphinx": "sphinx",
@@ -58,7 +85,84 @@ def checkout_commit(repo_path, commit_id):
         print(f"An unexpected error occurred: {e}")
 
 
-def clone_repo(repo_name, repo_playground):
+def get_mirror_path(repo_name):
+    return os.path.join(REPO_MIRROR_DIR, repo_name.replace("/", "__") + ".git")
+
+
+def commit_in_mirror(mirror_path, commit_id):
+    o = subprocess.run(
+        ["git", "-C", mirror_path, "cat-file", "-e", f"{commit_id}^{{commit}}"],
+        capture_output=True,
+    )
+    return o.returncode == 0
+
+
+def ensure_repo_mirror(repo_name, commit_id=None):
+    """Create or refresh the local bare mirror of the repository.
+    :param repo_name: Name of the github repository, e.g. django/django
+    :param commit_id: If given, the mirror is only fetched when it doesn't contain this commit
+    :return: Path to the mirror, or None if the mirror is not available
+    """
+    mirror_path = get_mirror_path(repo_name)
+    os.makedirs(REPO_MIRROR_DIR, exist_ok=True)
+    # the lock is shared by all threads and processes working on the same mirror
+    with FileLock(mirror_path + ".lock"):
+        try:
+            if not os.path.exists(mirror_path):
+                print(f"Creating mirror of https://github.com/{repo_name}.git at {mirror_path}...")
+                subprocess.run(
+                    [
+                        "git",
+                        "clone",
+                        "--mirror",
+                        f"https://github.com/{repo_name}.git",
+                        mirror_path,
+                    ],
+                    check=True,
+                )
+            elif commit_id is None or not commit_in_mirror(mirror_path, commit_id):
+                print(f"Updating mirror at {mirror_path}...")
+                subprocess.run(
+                    ["git", "-C", mirror_path, "remote", "update", "--prune"], check=True
+                )
+        except subprocess.CalledProcessError as e:
+            print(f"An error occurred while running git command: {e}")
+        if not os.path.exists(mirror_path):
+            return None
+        if commit_id is not None and not commit_in_mirror(mirror_path, commit_id):
+            print(f"Commit {commit_id} is not available in mirror {mirror_path}")
+            return None
+    return mirror_path
+
+
+def clone_repo(repo_name, repo_playground, commit_id=None):
+    # clone from the local mirror if possible, the clone shares the objects of the mirror so it is almost free
+    mirror_path = ensure_repo_mirror(repo_name, commit_id)
+    if mirror_path is not None:
+        try:
+            print(
+                f"Cloning repository from {mirror_path} to {repo_playground}/{repo_to_top_folder[repo_name]}..."
+            )
+            subprocess.run(
+                [
+                    "git",
+                    "clone",
+                    "--quiet",
+                    "--shared",
+                    "--no-checkout",
+                    mirror_path,
+                    f"{repo_playground}/{repo_to_top_folder[repo_name]}",
+                ],
+                check=True,
+            )
+            print("Repository cloned successfully.")
+            return
+        except subprocess.CalledProcessError as e:
+            print(f"An error occurred while cloning from mirror, falling back to github: {e}")
+            subprocess.run(
+                ["rm", "-rf", f"{repo_playground}/{repo_to_top_folder[repo_name]}"]
+            )
+
     try:
 
         print(
@@ -80,11 +184,166 @@ def clone_repo(repo_name, repo_playground):
         print(f"An unexpected error occurred: {e}")
 
 
+def read_files_at_commit(repo_name, commit_id, file_paths):
+    """Read files of a commit from the local mirror, without cloning or checking out the repository.
+    :param repo_name: Name of the github repository, e.g. django/django
+    :param commit_id: Commit to read the files from
+    :param file_paths: Paths of the files, relative to the repository root
+    :return: Dictionary from the path to its (mode, content) for the paths that exist at the commit, or None if the mirror is not available
+    """
+    mirror_path = ensure_repo_mirror(repo_name, commit_id)
+    if mirror_path is None:
+        return None
+    files = dict()
+    if not file_paths:
+        return files
+    try:
+        o = subprocess.run(
+            ["git", "-C", mirror_path, "ls-tree", "-z", commit_id, "--", *file_paths],
+            capture_output=True,
+            check=True,
+        )
+        entries = []
+        for entry in o.stdout.decode("utf-8").split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, object_type, sha = info.split()
+            if object_type == "blob":
+                entries.append((path, mode, sha))
+        # all blobs are read by one git process
+        o = subprocess.run(
+            ["git", "-C", mirror_path, "cat-file", "--batch"],
+            input="".join(f"{sha}\n" for _, _, sha in entries).encode("utf-8"),
+            capture_output=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"An error occurred while running git command: {e}")
+        return None
+    output = o.stdout
+    position = 0
+    for path, mode, _ in entries:
+        # each blob is "<sha> blob <size>\n<content>\n"
+        header_end = output.index(b"\n", position)
+        size = int(output[position:header_end].split()[2])
+        content = output[header_end + 1: header_end + 1 + size]
+        files[path] = (mode, content.decode("utf-8", errors="replace"))
+        position = header_end + 1 + size + 1
+    return files
+
+
+def get_structure_cache_key(repo_name, commit_id, model_patch=""):
+    patch_hash = hashlib.sha256(model_patch.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{repo_name}\0{commit_id}\0{patch_hash}".encode("utf-8")).hexdigest()
+
+
+def load_cached_structure(cache_key):
+    cache_file = os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.pkl")
+    text_file = os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.text")
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, "rb") as f:
+            structure = load_structure(
+                f, text_file if os.path.exists(text_file) else None, STRUCTURE_TEXT_MMAP
+            )
+    except Exception as e:
+        print(f"Failed to load cached structure {cache_file}: {e}")
+        return None
+    # bump the access time used for LRU eviction
+    os.utime(cache_file)
+    return structure
+
+
+def store_cached_structure(cache_key, structure):
+    os.makedirs(STRUCTURE_CACHE_DIR, exist_ok=True)
+    cache_file = os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.pkl")
+    text_file = os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.text")
+    tmp_id = uuid.uuid4()
+    with open(f"{cache_file}.{tmp_id}.tmp", "wb") as f, open(f"{text_file}.{tmp_id}.tmp", "wb") as text_f:
+        dump_structure(structure, f, text_f)
+    # the pickle is moved last, an entry only exists once its text is in place
+    os.replace(f"{text_file}.{tmp_id}.tmp", text_file)
+    os.replace(f"{cache_file}.{tmp_id}.tmp", cache_file)
+    evict_structure_cache()
+
+
+def evict_structure_cache(max_bytes=None):
+    """Remove the least recently used cached structures until the cache fits in max_bytes."""
+    if max_bytes is None:
+        max_bytes = STRUCTURE_CACHE_MAX_BYTES
+    entries = []
+    total_size = 0
+    for file_name in os.listdir(STRUCTURE_CACHE_DIR):
+        if not file_name.endswith(".pkl"):
+            continue
+        cache_key = file_name[: -len(".pkl")]
+        try:
+            stat = os.stat(os.path.join(STRUCTURE_CACHE_DIR, file_name))
+        except FileNotFoundError:
+            continue
+        size = stat.st_size
+        try:
+            size += os.path.getsize(os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.text"))
+        except FileNotFoundError:
+            pass
+        entries.append((stat.st_mtime, size, cache_key))
+        total_size += size
+    entries.sort()
+    for _, size, cache_key in entries:
+        if total_size <= max_bytes:
+            break
+        # structures already loaded keep working, their text is mapped and the mapping outlives the file
+        for file_name in (f"{cache_key}.pkl", f"{cache_key}.text"):
+            try:
+                os.remove(os.path.join(STRUCTURE_CACHE_DIR, file_name))
+            except FileNotFoundError:
+                pass
+        total_size -= size
+
+
 def get_project_structure_from_scratch(
     repo_name, commit_id, instance_id, repo_playground, **kwargs
 ):
     model_patch = kwargs.get("model_patch", "")
-    
+    use_cache = kwargs.get("use_cache", True)
+
+    cache_key = get_structure_cache_key(repo_name, commit_id, model_patch)
+    if use_cache:
+        os.makedirs(STRUCTURE_CACHE_DIR, exist_ok=True)
+        # threads asking for the same structure wait for the first one to parse it
+        with FileLock(os.path.join(STRUCTURE_CACHE_DIR, f"{cache_key}.lock")):
+            structure = load_cached_structure(cache_key)
+            if structure is None and model_patch:
+                # the patch usually touches a handful of files, re-parse only those on top of the base structure
+                base_structure = get_project_structure_from_scratch(
+                    repo_name, commit_id, instance_id, repo_playground
+                )["structure"]
+                try:
+                    structure = apply_patch_to_structure(base_structure, model_patch, repo_name)
+                except ValueError as e:
+                    print(f"Failed to apply the patch to the cached structure, rebuilding from scratch: {e}")
+            if structure is None:
+                structure = create_structure_from_checkout(
+                    repo_name, commit_id, repo_playground, model_patch
+                )
+                store_cached_structure(cache_key, structure)
+    else:
+        structure = create_structure_from_checkout(
+            repo_name, commit_id, repo_playground, model_patch
+        )
+
+    d = {
+        "repo": repo_name,
+        "base_commit": commit_id,
+        "structure": structure,
+        "instance_id": instance_id,
+    }
+    return d
+
+
+def create_structure_from_checkout(repo_name, commit_id, repo_playground, model_patch=""):
     # Generate a temperary folder and add uuid to avoid collision
     repo_playground = os.path.join(repo_playground, str(uuid.uuid4()))
 
@@ -94,7 +353,7 @@ def get_project_structure_from_scratch(
     # create playground
     os.makedirs(repo_playground)
 
-    clone_repo(repo_name, repo_playground)
+    clone_repo(repo_name, repo_playground, commit_id)
     checkout_commit(f"{repo_playground}/{repo_to_top_folder[repo_name]}", commit_id)
     if model_patch:
         apply_patch(f"{repo_playground}/{repo_to_top_folder[repo_name]}", model_patch)
@@ -103,21 +362,73 @@ def get_project_structure_from_scratch(
     subprocess.run(
         ["rm", "-rf", f"{repo_playground}/{repo_to_top_folder[repo_name]}"], check=True
     )
-    d = {
-        "repo": repo_name,
-        "base_commit": commit_id,
-        "structure": structure,
-        "instance_id": instance_id,
-    }
-    return d
+    return structure
 
 
-# check whether the node is at global level by checking whether it is at module level
-def is_global_node(node, module):
-    for child in ast.iter_child_nodes(module):
-        if child == node:
-            return True
-    return False
+def apply_patch_to_structure(structure, patch, repo_name):
+    """Apply a patch to a parsed repository structure by re-parsing only the files the patch touches.
+    :param structure: Structure of the repository at the base commit, it is not modified
+    :param patch: Git diff to apply
+    :param repo_name: Name of the github repository, used to locate the files at the repository root
+    :return: The structure of the patched repository
+    """
+    new_structure = dict(structure)
+    text_builder = TextBufferBuilder()
+
+    def get_parent(file_path, create):
+        # copy the directories on the way down so that the base structure is shared but never modified
+        parts = file_path.split("/")
+        if len(parts) == 1:
+            # create_structure stores files at the repository root under the top folder name
+            parts = [repo_to_top_folder[repo_name]] + parts
+        curr_struct = new_structure
+        for part in parts[:-1]:
+            if part not in curr_struct:
+                if not create:
+                    return None, parts[-1]
+                curr_struct[part] = {}
+            curr_struct[part] = dict(curr_struct[part])
+            curr_struct = curr_struct[part]
+        return curr_struct, parts[-1]
+
+    def remove_empty_dirs(file_path):
+        # git does not keep empty directories, so neither does a structure built from a checkout
+        parts = file_path.split("/")[:-1]
+        while len(parts) > 1:
+            parent, dir_name = get_parent("/".join(parts), create=False)
+            if parent is None or parent.get(dir_name):
+                break
+            del parent[dir_name]
+            parts = parts[:-1]
+
+    for file_patch in split_patch_by_file(patch):
+        old_file, new_file = file_patch["old_file"], file_patch["new_file"]
+        old_lines = []
+        if old_file is not None:
+            parent, file_name = get_parent(old_file, create=False)
+            if parent is None or file_name not in parent:
+                raise ValueError(f"{old_file} is not in the structure")
+            if old_file.endswith(".py"):
+                old_lines = parent[file_name].get("text", [])
+                if isinstance(old_lines, str):
+                    old_lines = old_lines.splitlines()
+                old_lines = list(old_lines)
+            if old_file != new_file:
+                del parent[file_name]
+                remove_empty_dirs(old_file)
+        if new_file is None:
+            continue
+        parent, file_name = get_parent(new_file, create=True)
+        if not new_file.endswith(".py"):
+            parent[file_name] = {}
+            continue
+        new_lines = apply_hunks(old_lines, file_patch["hunks"])
+        parent[file_name] = create_file_entry(
+            parse_python_file(new_file, "\n".join(new_lines)), text_builder
+        )
+    text_builder.finish()
+
+    return new_structure
 
 
 def find_global_vars_in_function(function_node, global_vars):
@@ -195,21 +506,23 @@ def parse_python_file(file_path, file_content=None):
     global_vars = {}
     imports = []
     import_interval = []
+    file_lines = file_content.splitlines()
     # first get all global variables and imports, they will be used in the next steps
-    for node in ast.walk(parsed_data):
-        # global variables (Assign nodes && at module level)
-        if isinstance(node, ast.Assign) and is_global_node(node, parsed_data):
+    # only module level statements count, so there is no need to walk the whole tree
+    for node in parsed_data.body:
+        # global variables
+        if isinstance(node, ast.Assign):
             for target in node.targets:
                 if isinstance(target, ast.Name):  
                     value = ast.unparse(node.value)  
                     global_vars[target.id] = value
 
         # import statements
-        elif isinstance(node, ast.Import) and is_global_node(node, parsed_data):
+        elif isinstance(node, ast.Import):
             for alias in node.names:
                 imports.append(f"import {alias.name}")
             import_interval.append((node.lineno, node.end_lineno))
-        elif isinstance(node, ast.ImportFrom) and is_global_node(node, parsed_data):
+        elif isinstance(node, ast.ImportFrom):
             module = node.module if node.module else ""
             for alias in node.names:
                 imports.append(f"from {module} import {alias.name}")
@@ -225,9 +538,7 @@ def parse_python_file(file_path, file_content=None):
                             "name": n.name,
                             "start_line": n.lineno,
                             "end_line": n.end_lineno,
-                            "text": file_content.splitlines()[
-                                n.lineno - 1 : n.end_lineno
-                            ],
+                            "text": file_lines[n.lineno - 1 : n.end_lineno],
                             "used_globals": used_globals,
                         }
                     )
@@ -237,9 +548,7 @@ def parse_python_file(file_path, file_content=None):
                     "name": node.name,
                     "start_line": node.lineno,
                     "end_line": node.end_lineno,
-                    "text": file_content.splitlines()[
-                        node.lineno - 1 : node.end_lineno
-                    ],
+                    "text": file_lines[node.lineno - 1 : node.end_lineno],
                     "methods": methods,
                 }
             )
@@ -253,23 +562,84 @@ def parse_python_file(file_path, file_content=None):
                         "name": node.name,
                         "start_line": node.lineno,
                         "end_line": node.end_lineno,
-                        "text": file_content.splitlines()[
-                            node.lineno - 1 : node.end_lineno
-                        ],
+                        "text": file_lines[node.lineno - 1 : node.end_lineno],
                         "used_globals": used_globals,
                     }
                 )
     import_interval =  splice_intervals(import_interval)
 
-    return class_info, function_names, file_content.splitlines(), imports, import_interval
+    return class_info, function_names, file_lines, imports, import_interval
+
+
+def get_parse_pool():
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None:
+            # spawn instead of fork, create_structure is called from many threads at once
+            parse_pool = ProcessPoolExecutor(
+                max_workers=STRUCTURE_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return parse_pool
 
 
-def create_structure(directory_path):
+def parse_python_files(file_paths, num_workers=None):
+    """Parse Python files, fanning out to the shared process pool for large batches.
+    :param file_paths: Paths to the Python files.
+    :param num_workers: Number of processes to use, defaults to STRUCTURE_PARSE_WORKERS.
+    :return: Iterator over the parse_python_file results, in the order of file_paths.
+    """
+    global parse_pool
+    if num_workers is None:
+        num_workers = STRUCTURE_PARSE_WORKERS
+    parsed = 0
+    if num_workers > 1 and len(file_paths) >= MIN_FILES_FOR_PARSE_POOL:
+        try:
+            chunksize = max(1, len(file_paths) // (num_workers * 4))
+            for result in get_parse_pool().map(parse_python_file, file_paths, chunksize=chunksize):
+                yield result
+                parsed += 1
+        except BrokenProcessPool as e:
+            print(f"Parse pool is broken, parsing serially: {e}")
+            with parse_pool_lock:
+                parse_pool = None
+    for file_path in file_paths[parsed:]:
+        yield parse_python_file(file_path)
+
+
+def create_file_entry(parsed_file, text_builder):
+    """Create the structure entry of a parsed Python file, storing its text in the shared buffer.
+    :param parsed_file: The result of parse_python_file.
+    :param text_builder: TextBufferBuilder collecting the text of the structure.
+    :return: The entry of the file in the structure.
+    """
+    class_info, function_names, file_lines, imports, import_interval = parsed_file
+    if isinstance(file_lines, list):
+        file_lines = text_builder.add(file_lines)
+        # the text of classes, methods and functions are views over the lines of the file
+        for clazz in class_info:
+            clazz["text"] = file_lines.view(clazz["start_line"] - 1, clazz["end_line"])
+            for method in clazz["methods"]:
+                method["text"] = file_lines.view(method["start_line"] - 1, method["end_line"])
+        for function in function_names:
+            function["text"] = file_lines.view(function["start_line"] - 1, function["end_line"])
+    return {
+        "classes": class_info,
+        "functions": function_names,
+        "text": file_lines,
+        "imports": imports,
+        "import_interval": import_interval,
+    }
+
+
+def create_structure(directory_path, num_workers=None):
     """Create the structure of the repository directory by parsing Python files.
     :param directory_path: Path to the repository directory.
+    :param num_workers: Number of processes used to parse the files, defaults to STRUCTURE_PARSE_WORKERS.
     :return: A dictionary representing the structure.
     """
     structure = {}
+    python_files = []
 
     for root, _, files in os.walk(directory_path):
         repo_name = os.path.basename(directory_path)
@@ -284,15 +654,19 @@ def create_structure(directory_path):
         for file_name in files:
             if file_name.endswith(".py"):
                 file_path = os.path.join(root, file_name)
-                class_info, function_names, file_lines, imports, import_interval = parse_python_file(file_path)
-                curr_struct[file_name] = {
-                    "classes": class_info,
-                    "functions": function_names,
-                    "text": file_lines,
-                    "imports": imports,
-                    "import_interval": import_interval,
-                }
+                # keep the slot so the walk order is preserved, it is filled once the files are parsed
+                curr_struct[file_name] = None
+                python_files.append((curr_struct, file_name, file_path))
             else:
                 curr_struct[file_name] = {}
 
+    # all files of the structure share one text buffer, lines are only split when they are read
+    text_builder = TextBufferBuilder()
+    parsed_files = parse_python_files(
+        [file_path for _, _, file_path in python_files], num_workers
+    )
+    for (curr_struct, file_name, _), parsed_file in zip(python_files, parsed_files):
+        curr_struct[file_name] = create_file_entry(parsed_file, text_builder)
+    text_builder.finish()
+
     return structure
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from collections import Counter
+import asyncio
 import json
 import re
 from patchpilot.repair.utils import construct_topn_file_context
@@ -11,15 +12,53 @@ from patchpilot.util.preprocess_data import (
     correct_file_paths,
     get_full_file_paths_and_classes_and_functions,
     get_repo_files,
+    get_repo_index,
     show_project_structure,
 )
 
 MAX_CONTEXT_LENGTH = 128000
 
 
+def chunk_lines_by_tokens(line_tokens, budget, overlap=0, fits=None):
+    """
+    Split lines into chunks whose token counts add up to less than budget, with a running sum over per-line counts.
+
+    Arguments:
+    line_tokens -- number of tokens of each line
+    budget -- a chunk must have fewer tokens than this
+    overlap -- number of lines a chunk repeats from the end of the previous one
+    fits -- optional exact check of a (start, end) chunk, lines are moved to the next chunk until it passes
+
+    Returns:
+    list of (start, end) line ranges, a line longer than the budget gets a chunk of its own
+    """
+    chunks = []
+    start = 0
+    while start < len(line_tokens):
+        end = start
+        total = 0
+        while end < len(line_tokens) and (end == start or total + line_tokens[end] < budget):
+            total += line_tokens[end]
+            end += 1
+        if fits is not None:
+            while end - start > 1 and not fits(start, end):
+                end -= 1
+        if chunks and end <= chunks[-1][1]:
+            # the overlap leaves no room for a new line, continue right after the previous chunk instead
+            start = chunks[-1][1]
+            continue
+        chunks.append((start, end))
+        if end == len(line_tokens):
+            break
+        start = max(start + 1, end - overlap)
+    return chunks
+
+
 class FL(ABC):
     def __init__(self, instance_id, structure, problem_statement):
-        self.structure = structure
+        # structure can be a raw structure or a RepoIndex shared by all localization steps
+        self.repo_index = get_repo_index(structure)
+        self.structure = self.repo_index.structure
         self.instance_id = instance_id
         self.problem_statement = problem_statement
 
@@ -445,6 +484,9 @@ Return just the locations. Do not include any comments or explanations. Do not f
             )
             traj = tool_model.codegen(message, num_samples=1,
                                  tools=[search_string_schema, search_class_def_schema, search_func_def_schema])[0]
+        elif self.backend == "mock":
+            traj = model.codegen(message, num_samples=1,
+                                 tools=[search_string_schema, search_class_def_schema, search_func_def_schema])[0]
         else:
             raise ValueError(f"Backend {self.backend} is not supported")
         if traj:
@@ -462,7 +504,7 @@ Return just the locations. Do not include any comments or explanations. Do not f
                             pattern = r"(?i)\b\w*warning\w*\b|\b\w*error\w*\b"
                             cleaned_text = re.sub(pattern, "", query_string)
                             cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
-                            search_results = " ".join(search_string(cleaned_text, structure=self.structure))
+                            search_results = " ".join(search_string(cleaned_text, structure=self.repo_index))
                             if search_results:
                                 search_str_with_file[query_string] = search_results
                                 self.logger.info(f'search result for string {query_string}: {search_results}')
@@ -476,7 +518,7 @@ Return just the locations. Do not include any comments or explanations. Do not f
                             raise e
                         if argument_dict and isinstance(argument_dict, dict) and "class_name" in argument_dict:
                             class_name = argument_dict["class_name"]
-                            search_results = " ".join(search_class_def(class_name, structure=self.structure))
+                            search_results = " ".join(search_class_def(class_name, structure=self.repo_index))
                             if search_results:
                                 search_str_with_file[class_name] = search_results
                                 self.logger.info(f'search result for class {class_name}: {search_results}')
@@ -490,7 +532,7 @@ Return just the locations. Do not include any comments or explanations. Do not f
                             raise e
                         if argument_dict and isinstance(argument_dict, dict) and "function_name" in argument_dict:
                             function_name = argument_dict["function_name"]
-                            search_results = " ".join(search_func_def(function_name, structure=self.structure))
+                            search_results = " ".join(search_func_def(function_name, structure=self.repo_index))
                             if search_results:
                                 search_str_with_file[function_name] = search_results
                                 self.logger.info(f'search result for func {function_name}: {search_results}')
@@ -579,7 +621,7 @@ Return just the locations. Do not include any comments or explanations. Do not f
         model_found_files = [item for item, count in element_count.most_common()]
 
         files, classes, functions = get_full_file_paths_and_classes_and_functions(
-            self.structure
+            self.repo_index
         )
 
         # sort based on order of appearance in model_found_files
@@ -598,7 +640,7 @@ Return just the locations. Do not include any comments or explanations. Do not f
     def localize_function_from_compressed_files(self, file_names, mock=False, num_samples=1, coverage_info=None, additional_info=None):
         from patchpilot.util.api_requests import num_tokens_from_messages
         from patchpilot.util.model import make_model        
-        file_contents = get_repo_files(self.structure, file_names)
+        file_contents = get_repo_files(self.repo_index, file_names)
         coverage_dict = {}
         if coverage_info and "coverage_dict" in coverage_info:
             coverage_dict = coverage_info["coverage_dict"]
@@ -640,6 +682,28 @@ Return just the locations. Do not include any comments or explanations. Do not f
                 num_tokens_from_messages(message, self.model_name) >= MAX_CONTEXT_LENGTH
             )
 
+        # drop files using the token counts of each file instead of re-encoding the whole message every time
+        content_tokens = [num_tokens_from_messages(content, self.model_name) for content in contents]
+        estimated_tokens = num_tokens_from_messages(
+            template.format(problem_statement=self.problem_statement, file_contents=""), self.model_name
+        ) + sum(content_tokens)
+        all_contents = contents
+        while estimated_tokens >= MAX_CONTEXT_LENGTH and len(contents) > 1:
+            self.logger.info(f"reducing to \n{len(contents)} files")
+            contents = contents[:-1]
+            estimated_tokens -= content_tokens[len(contents)]
+        if len(contents) < len(all_contents):
+            # the estimate can be off by a few tokens where the files are joined, keep the last dropped file if it fits
+            message_with_next_file = template.format(
+                problem_statement=self.problem_statement, file_contents="".join(all_contents[:len(contents) + 1])
+            )
+            if not message_too_long(message_with_next_file):
+                contents = all_contents[:len(contents) + 1]
+            file_contents = "".join(contents)
+            message = template.format(
+                problem_statement=self.problem_statement, file_contents=file_contents
+            )
+
         while message_too_long(message) and len(contents) > 1:
             self.logger.info(f"reducing to \n{len(contents)} files")
             contents = contents[:-1]
@@ -717,9 +781,11 @@ Return just the locations. Do not include any comments or explanations. Do not f
         self,
         file_names,
         num_samples: int = 1,
+        chunk_overlap: int = 0,
+        max_concurrent_requests: int = 4,
     ):
-        from patchpilot.util.api_requests import num_tokens_from_messages
-        from patchpilot.util.model import make_model
+        from patchpilot.util.api_requests import get_encoding, num_tokens_from_messages
+        from patchpilot.util.model import make_model, run_coroutine
 
         def message_too_long(msg: str) -> bool:
             return (
@@ -730,12 +796,14 @@ Return just the locations. Do not include any comments or explanations. Do not f
             )
 
         # read repo files
-        file_contents = get_repo_files(self.structure, file_names)
+        file_contents = get_repo_files(self.repo_index, file_names)
 
         # containers
         results = [[[] for _ in file_names] for _ in range(num_samples)]
         raw_outputs_per_sample: list[list[str]] = [[] for _ in range(num_samples)]
         traj = {"prompt": [], "response": []}
+        # (file index, file name, prompt) of every chunk, in file and chunk order
+        chunk_requests = []
 
         # iterate over files
         for file_idx, fn in enumerate(file_names):
@@ -747,35 +815,32 @@ Return just the locations. Do not include any comments or explanations. Do not f
                 for idx, line in enumerate(code.splitlines(keepends=True), start=1)
             ]
 
-            # chunk long files
-            chunks, current = [], []
-            for line in numbered:
-                current.append(line)
+            # chunk long files, the lines and the rest of the prompt are tokenized once and summed up
+            def build_prompt(file_content):
                 content_block = self.file_content_in_block_template.format(
-                    file_name=fn, file_content="".join(current)
+                    file_name=fn, file_content=file_content
                 )
-                prompt = self.obtain_relevant_code_combine_top_n_prompt.format(
+                return self.obtain_relevant_code_combine_top_n_prompt.format(
                     problem_statement=self.problem_statement,
                     file_contents=content_block,
                     last_search_results="",
                 )
-                if message_too_long(prompt):
-                    last = current.pop()
-                    if current:
-                        chunks.append("".join(current))
-                    current = [last]
-            if current:
-                chunks.append("".join(current))
-
-            # query model per chunk
-            model = make_model(
-                model=self.model_name,
-                backend=self.backend,
-                logger=self.logger,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                batch_size=num_samples,
+
+            prompt_tokens = num_tokens_from_messages(
+                [{"role": "user", "content": build_prompt("")}], self.model_name
             )
+            # lines are counted in one batch and not memoized, they would only evict whole prompts from the cache
+            line_tokens = [len(tokens) for tokens in get_encoding(self.model_name).encode_batch(numbered)]
+            # tokens can merge across line boundaries, so each chunk is checked against the actual prompt
+            chunks = [
+                "".join(numbered[start:end])
+                for start, end in chunk_lines_by_tokens(
+                    line_tokens,
+                    MAX_CONTEXT_LENGTH - prompt_tokens,
+                    chunk_overlap,
+                    fits=lambda start, end: not message_too_long(build_prompt("".join(numbered[start:end]))),
+                )
+            ]
 
             for chunk in chunks:
                 content_block = self.file_content_in_block_template.format(
@@ -786,20 +851,43 @@ Return just the locations. Do not include any comments or explanations. Do not f
                     file_contents=content_block,
                     last_search_results="",
                 )
+                chunk_requests.append((file_idx, fn, message))
+
+        # query model per chunk, the chunks of all files are sent concurrently
+        model = make_model(
+            model=self.model_name,
+            backend=self.backend,
+            logger=self.logger,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            batch_size=num_samples,
+        )
+
+        async def query_chunks():
+            # bounds the requests of this call, the shared event loop serves every instance at once
+            semaphore = asyncio.Semaphore(max(1, max_concurrent_requests))
 
-                raw_trajs = model.codegen(message, num_samples=num_samples)
+            async def query_chunk(message):
+                async with semaphore:
+                    return await model.acodegen(message, num_samples=num_samples)
 
-                traj["prompt"].append(message)
-                traj["response"].extend([rt["response"] for rt in raw_trajs])
+            # gather keeps the order of the chunks, so the outputs are the same as when querying serially
+            return await asyncio.gather(*(query_chunk(message) for _, _, message in chunk_requests))
 
-                # parse outputs
-                for samp_id, rt in enumerate(raw_trajs):
-                    raw = rt["response"]
-                    raw_outputs_per_sample[samp_id].append(raw)
+        all_raw_trajs = run_coroutine(query_chunks())
 
-                    blocks = extract_code_blocks(raw) or [raw]
-                    locs = extract_locs_for_files(blocks, [fn])[0][0]
-                    results[samp_id][file_idx].append(locs)
+        for (file_idx, fn, message), raw_trajs in zip(chunk_requests, all_raw_trajs):
+            traj["prompt"].append(message)
+            traj["response"].extend([rt["response"] for rt in raw_trajs])
+
+            # parse outputs
+            for samp_id, rt in enumerate(raw_trajs):
+                raw = rt["response"]
+                raw_outputs_per_sample[samp_id].append(raw)
+
+                blocks = extract_code_blocks(raw) or [raw]
+                locs = extract_locs_for_files(blocks, [fn])[0][0]
+                results[samp_id][file_idx].append(locs)
         meta = {"raw_output_loc": raw_outputs_per_sample}
         return results, meta, traj
 
@@ -823,12 +911,12 @@ Return just the locations. Do not include any comments or explanations. Do not f
         from patchpilot.util.api_requests import num_tokens_from_messages
         from patchpilot.util.model import make_model
 
-        file_contents = get_repo_files(self.structure, file_names)
+        file_contents = get_repo_files(self.repo_index, file_names)
         topn_content, file_loc_intervals, _, _ = construct_topn_file_context(
             coarse_locs,
             file_names,
             file_contents,
-            self.structure,
+            self.repo_index,
             context_window=context_window,
             loc_interval=True,
             add_space=add_space,
@@ -889,6 +977,9 @@ Return just the locations. Do not include any comments or explanations. Do not f
                 "prompt_tokens": sum(
                     raw_traj["usage"]["prompt_tokens"] for raw_traj in raw_trajs
                 ),
+                "cached_prompt_tokens": sum(
+                    raw_traj["usage"].get("cached_prompt_tokens", 0) for raw_traj in raw_trajs
+                ),
             },
         }
         model_found_locs_separated_in_samples = []
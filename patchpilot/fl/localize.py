@@ -6,7 +6,7 @@ import pickle
 from datasets import load_dataset
 from patchpilot.util.preprocess_data import (
     transfer_arb_locs_to_locs,
-    get_full_file_paths_and_classes_and_functions,
+    RepoIndex,
 )
 
 from patchpilot.fl.FL import LLMFL
@@ -117,6 +117,8 @@ def localize_instance(
     # filter out test files (unless its pytest)
     if not file_json["instance_id"].startswith("pytest"):
         filter_out_test_files(structure)
+    # all localization steps share one index of the filtered structure
+    repo_index = RepoIndex(structure)
 
     found_files = []
     found_related_locs = []
@@ -130,7 +132,7 @@ def localize_instance(
     search_str_with_file = dict()
     fl = LLMFL(
         file_json["instance_id"],
-        structure,
+        repo_index,
         problem_statement,
         args.model,
         args.backend,
@@ -144,7 +146,7 @@ def localize_instance(
     if args.file_level:
         fl = LLMFL(
             file_json["instance_id"],
-            structure,
+            repo_index,
             problem_statement,
             args.model,
             args.backend,
@@ -179,7 +181,7 @@ def localize_instance(
         pred_files = found_files[: args.top_n]
         fl = LLMFL(
             instance_id,
-            structure,
+            repo_index,
             problem_statement,
             args.model,
             args.backend,
@@ -194,6 +196,8 @@ def localize_instance(
         ) = fl.localize_line_from_files(
             pred_files,
             num_samples=args.num_samples,
+            chunk_overlap=args.chunk_overlap,
+            max_concurrent_requests=args.max_concurrent_requests,
         )
         additional_artifact_loc_edit_location = [additional_artifact_loc_edit_location]
 
@@ -203,7 +207,7 @@ def localize_instance(
             pred_files = found_files[: args.top_n]
             fl = LLMFL(
                 file_json["instance_id"],
-                structure,
+                repo_index,
                 problem_statement,
                 args.model,
                 args.backend,
@@ -234,7 +238,7 @@ def localize_instance(
         pred_files = found_files[: args.top_n]
         fl = LLMFL(
             instance_id,
-            structure,
+            repo_index,
             problem_statement,
             args.model,
             args.backend,
@@ -271,8 +275,6 @@ def localize_instance(
                     if found_edit_locs[sample_index][i] and isinstance(found_edit_locs[sample_index][i], list) and found_edit_locs[sample_index][i][0] is not None:
                             found_edit_locs_merged[i] += found_edit_locs[sample_index][i][0] + "\n"
 
-        files, _, _ = get_full_file_paths_and_classes_and_functions(structure)
-
         # Construct file contents
         file_contents = dict()
 
@@ -280,11 +282,10 @@ def localize_instance(
         for i, pred_file in enumerate(pred_files):
             content = None
 
-            for file_content in files:
-                if file_content[0] == pred_file:
-                    content = "\n".join(file_content[1])
-                    file_contents[pred_file] = content
-                    break
+            file_content = repo_index.get_file(pred_file)
+            if file_content is not None:
+                content = "\n".join(file_content[1])
+                file_contents[pred_file] = content
 
             assert content is not None, f"{pred_file} file not found"
 
@@ -353,7 +354,7 @@ def localize_instance(
 
         fl = LLMFL(
             file_json["instance_id"],
-            structure,
+            repo_index,
             problem_statement,
             args.model,
             args.backend,
@@ -560,6 +561,18 @@ def main():
         help="Whether to match model generated files based on subdirectories of original repository if no full matches can be found",
     )
     parser.add_argument("--context_window", type=int, default=10)
+    parser.add_argument(
+        "--chunk_overlap",
+        type=int,
+        default=0,
+        help="Number of lines repeated between consecutive chunks when a file is too long for one direct_line_level prompt",
+    )
+    parser.add_argument(
+        "--max_concurrent_requests",
+        type=int,
+        default=4,
+        help="Maximum number of direct_line_level requests sent at once for one instance",
+    )
     parser.add_argument(
         "--num_threads",
         type=int,
@@ -586,7 +599,7 @@ def main():
         default="gpt-4o-2024-08-06",
     )
     parser.add_argument(
-        "--backend", type=str, default="openai", choices=["openai", "deepseek", "claude"]
+        "--backend", type=str, default="openai", choices=["openai", "deepseek", "claude", "mock"]
     )
     parser.add_argument(
         "--benchmark",
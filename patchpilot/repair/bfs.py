@@ -1,4 +1,5 @@
 from patchpilot.util.model import make_model
+from patchpilot.util.api_requests import create_cached_message, get_message_text
 from patchpilot.util.utils import setup_logger
 from patchpilot.repair.utils import post_process_raw_output, apply_search_replace
 import re
@@ -18,7 +19,9 @@ and then you should provide me a one *SEARCH/REPLACE* edit to fix the issue.
 """
 
 
-apply_plan_prompt = """
+# the prompt is sent as three blocks, the issue and code are shared by every step and plan of an instance,
+# the plan by every step and retry of that plan, so they are cached prompt prefixes
+apply_plan_context_prompt = """
 We are currently solving the following issue within our repository. 
 {whole_function_prompt}
 Please follow the provided step of a plan to generate one *SEARCH/REPLACE* edit to fix the issue, focusing only on the current step.
@@ -64,10 +67,14 @@ Below are some code segments, each from a relevant file. One or more of these fi
 {content}
 --- END FILES ---
 
-Here is the whole plan for fixing the issue:
+"""
+
+apply_plan_planning_prompt = """Here is the whole plan for fixing the issue:
 {planning}
 
-Here is the current step for fixing the issue:
+"""
+
+apply_plan_step_prompt = """Here is the current step for fixing the issue:
 {step}
 
 {errors}
@@ -202,19 +209,24 @@ def apply_plan_step_by_step(log_file, model_version, plan, problem_statement, co
             else:
                 whole_prompt = ""
 
-            message = apply_plan_prompt.format(
-                whole_function_prompt=whole_prompt,
-                problem_statement=problem_statement,
-                content=content,
-                planning=plan,
+            step_prompt = apply_plan_step_prompt.format(
                 errors=error_prompt,
                 step=current_step
             )
             if feedback_prompt:
-                message += 'Here are some feedbacks from the previous generation, they are just for your reference. Do not search for the feedbacks in the codebase. \n'
-                message += feedback_prompt
+                step_prompt += 'Here are some feedbacks from the previous generation, they are just for your reference. Do not search for the feedbacks in the codebase. \n'
+                step_prompt += feedback_prompt
+            message = create_cached_message(
+                apply_plan_context_prompt.format(
+                    whole_function_prompt=whole_prompt,
+                    problem_statement=problem_statement,
+                    content=content,
+                ),
+                apply_plan_planning_prompt.format(planning=plan),
+                step_prompt,
+            )
 
-            logger.info(f'prompting with apply_plan_prompt {message}')
+            logger.info(f'prompting with apply_plan_prompt {get_message_text(message)}')
             sample_traj = model.codegen(message, num_samples=1)[0]
             sample_response = sample_traj['response']
 
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from filelock import FileLock
+
+GENERATION_FIELDS = ("raw_output", "git_diffs", "raw_git_diffs")
+
+
+def get_generation_lock(output_file):
+    # one lock per output file, so experiments writing to different folders do not wait for each other
+    return FileLock(output_file + ".lock")
+
+
+def append_generations(output_file, instance_id, raw_outputs, git_diffs, raw_git_diffs):
+    """
+    Append the generations of one batch of an instance to the log, the previous records are not rewritten.
+    An instance has one record per batch until the log is compacted.
+    """
+    record = json.dumps(
+        {
+            "instance_id": instance_id,
+            "raw_output": raw_outputs,
+            "git_diffs": git_diffs,
+            "raw_git_diffs": raw_git_diffs,
+        }
+    )
+    with get_generation_lock(output_file):
+        with open(output_file, "a+b") as f:
+            # a record cut short by an interrupted run must not swallow this one
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+            f.write((record + "\n").encode("utf-8"))
+            f.flush()
+
+
+def read_generation_records(output_file):
+    records = []
+    with open(output_file, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a record cut short by an interrupted run, its batch is generated again
+                print(f"skipping a truncated record in {output_file}")
+    return records
+
+
+def merge_generation_records(records):
+    generations = dict()
+    for record in records:
+        instance_id = record["instance_id"]
+        if instance_id not in generations:
+            generations[instance_id] = {"instance_id": instance_id, **{field: [] for field in GENERATION_FIELDS}}
+        if record.get("raw_output") == "":
+            # an instance without any output, it is post-processed into an empty patch
+            generations[instance_id]["empty_output"] = True
+            continue
+        for field in GENERATION_FIELDS:
+            generations[instance_id][field].extend(record.get(field, []))
+    return generations
+
+
+def load_generations(output_file):
+    """
+    Returns the index of the log, instance_id -> {"instance_id", "raw_output", "git_diffs", "raw_git_diffs"},
+    with the generations of all batches of an instance in the order they were appended. Instances recorded with
+    an empty raw_output also have "empty_output" set.
+    """
+    if not os.path.exists(output_file):
+        return dict()
+    return merge_generation_records(read_generation_records(output_file))
+
+
+def compact_generations(output_file):
+    """
+    Rewrite the log with one record per instance, the format of output.jsonl before it became append-only.
+    """
+    if not os.path.exists(output_file):
+        return
+    with get_generation_lock(output_file):
+        records = read_generation_records(output_file)
+        generations = merge_generation_records(records)
+        if len(generations) == len(records):
+            return
+        tmp_file = output_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for entry in generations.values():
+                if entry.pop("empty_output", False) and not entry["raw_output"]:
+                    entry["raw_output"] = ""
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_file, output_file)
+
+
+class EarlyExitRegistry:
+    """
+    Instances with a sample that passed all verifications, they are not sampled again.
+    The registry is saved to disk on every change, a resumed run keeps skipping them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.finished = dict()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.finished = json.load(f)
+
+    def __contains__(self, instance_id):
+        return instance_id in self.finished
+
+    def __len__(self):
+        return len(self.finished)
+
+    def add(self, instance_id, sample_idx, model_patch):
+        with self.lock:
+            if instance_id in self.finished:
+                return
+            self.finished[instance_id] = {"sample_idx": sample_idx, "model_patch": model_patch}
+            with get_generation_lock(self.path):
+                tmp_file = self.path + ".tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump(self.finished, f, indent=4)
+                os.replace(tmp_file, self.path)
@@ -9,11 +9,13 @@ import re
 import ast
 from datasets import load_dataset
 from tqdm import tqdm
-from filelock import FileLock
 from patchpilot.repair.bfs import vote_outputs_unwrap, apply_plan_step_by_step
+from patchpilot.repair.generation_log import append_generations, load_generations, compact_generations, \
+    get_generation_lock, GENERATION_FIELDS, EarlyExitRegistry
 from patchpilot.util.model import make_model
+from patchpilot.util.api_requests import create_cached_message, get_message_text
 from patchpilot.util.preprocess_data import (
-    get_full_file_paths_and_classes_and_functions,
+    RepoIndex,
     get_repo_structure,
     transfer_arb_locs_to_locs,
     find_definitions_by_name,
@@ -25,7 +27,7 @@ from patchpilot.fl.FL import LLMFL
 from patchpilot.util.utils import load_jsonl, setup_logger
 from patchpilot.repair.utils import post_process_raw_output, post_process_raw_output_refine, construct_topn_file_context
 from patchpilot.reproduce.reproduce import reproduce, ensure_directory_exists
-from patchpilot.reproduce.verify import verify
+from patchpilot.reproduce.verify import execute_verify_instance
 from patchpilot.reproduce.task import make_swe_tasks, parse_task_list_file
 from patchpilot.util.search_tool import search_func_def_with_class_and_file_schema, search_func_def_with_class_and_file
 
@@ -35,12 +37,12 @@ not_found_file_dict = dict()
 
 locs_global = []
 
-lock_path = '/tmp/lock_file'
-output_file_lock = FileLock(lock_path)
 
 num_generated_sample = 0
 round_idx = 0
 last_round = False
+# instances that already have a sample passing all verifications, set up in main
+early_exit_registry = None
 orig_verify_folder = ""
 
 planning_example_format = """Here is an example of the output format:
@@ -458,6 +460,12 @@ You need to first reason about each aspect of **Completeness and Consistency**,
 """
 
 
+def create_planning_message(prompt, suffix="", **kwargs):
+    # the prompt ends with the issue and the code, the plans sampled with the same prompt share it as a cached prefix
+    # and only the reproduce info appended to some of them follows it
+    return create_cached_message(prompt.format(**kwargs).strip(), suffix)
+
+
 def weighted_sampling(models, weights):
     return random.choices(models, weights, k=1)[0]
 
@@ -609,7 +617,7 @@ def parse_git_diff_to_dict(diff_text: str) -> dict[str, str]:
     return diff_dict
 
 
-def process_loc(loc, args, swe_bench_data, prev_generations):
+def process_loc(loc, args, swe_bench_data, prev_generations, num_generated_sample):
     
     instance_id = loc["instance_id"]
     log_file = os.path.join(
@@ -630,12 +638,10 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
     found = False
     # we should just check the raw_output_file
     
-    for entry in prev_generations:
-        if entry["instance_id"] == instance_id:
-            generated_for_instance = len(entry["git_diffs"])
-            if generated_for_instance >= num_generated_sample + args.batch_size:
-                found = True
-            break
+    if instance_id in prev_generations:
+        generated_for_instance = len(prev_generations[instance_id]["git_diffs"])
+        if generated_for_instance >= num_generated_sample + args.batch_size:
+            found = True
 
     if found:
         logger.info(f"skipping {instance_id} since patch already generated")
@@ -710,7 +716,8 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
         structure = get_repo_structure(
             instance_id, bench_data["repo"], bench_data["base_commit"], "playground"
         )
-    files,  classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    # index the structure once, every lookup below goes through it
+    repo_index = RepoIndex(structure)
 
     poc_code_prompt = ""
     base_patch_prompt = ""
@@ -790,6 +797,9 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
                     )
                     traj = tool_model.codegen(ask_llm_for_search_prompt, num_samples=1,
                                               tools=[search_func_def_with_class_and_file_schema])[0]
+                elif args.backend == "mock":
+                    traj = greedy_model.codegen(ask_llm_for_search_prompt, num_samples=1,
+                                                tools=[search_func_def_with_class_and_file_schema])[0]
                 else:
                     raise ValueError(f"Backend {args.backend} is not supported")
                 if traj:
@@ -806,7 +816,7 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
                                     class_name = argument_dict.get("class_name", "")
                                     function_name = argument_dict.get("function_name", "")
                                     if function_name:
-                                        found_file_name, found_class_name, function_code = search_func_def_with_class_and_file(structure=structure, function_name=function_name, class_name=class_name)
+                                        found_file_name, found_class_name, function_code = search_func_def_with_class_and_file(structure=repo_index, function_name=function_name, class_name=class_name)
                                         failed_functionality_test_info[function_name] = {"class_name": found_class_name, "file_name": found_file_name, "function_code": function_code}
                                         break
             
@@ -848,12 +858,11 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
     # pred_files are the files that we have localized
     for i, pred_file in enumerate(pred_files):
         content = None
-        # files are all files in the repo, index 0 is the file name, index 1 is the content
-        for file_content in files:
-            if file_content[0] == pred_file:
-                content = "\n".join(file_content[1])
-                file_contents[pred_file] = content
-                break
+        # index 0 is the file name, index 1 is the content
+        file_content = repo_index.get_file(pred_file)
+        if file_content is not None:
+            content = "\n".join(file_content[1])
+            file_contents[pred_file] = content
 
         assert content is not None, f"{pred_file} file not found"
     
@@ -887,20 +896,19 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
         additional_prompt += feedback_prompt
         print(f"Redoing localization for the current instance {instance_id}")
         logger.info(f"Redoing localization for the current instance {instance_id}")
-        modified_funcs=find_modified_functions(base_patch_diff, structure)
+        modified_funcs=find_modified_functions(base_patch_diff, repo_index)
         modified_funcs_to_callers = {}
         modified_funcs_to_same_name_funcs = {}
-        files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
         if modified_funcs and len(modified_funcs) <= 3:
             for func in modified_funcs:
-                all_callers = find_callers_by_name(func, structure)
+                all_callers = find_callers_by_name(func, repo_index)
                 all_callers = all_callers[:3]
                 for caller in all_callers:
                     if caller['file'] not in loc['found_files']:
                         if func not in modified_funcs_to_callers:
                             modified_funcs_to_callers[func] = []
                         modified_funcs_to_callers[func].append(caller)
-                all_defs = find_definitions_by_name(func, structure)
+                all_defs = find_definitions_by_name(func, repo_index)
                 for all_def in all_defs:
                     if all_def['file'] not in loc['found_files']:
                         if func not in modified_funcs_to_same_name_funcs:
@@ -910,12 +918,12 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
         for func, callers in modified_funcs_to_callers.items():
             for caller in callers:
                 additional_prompt += f"For modified function {func}, we found a caller in File {caller['file']}: Line interval {caller['start_line']}-{caller['end_line']}, caller function {caller.get('caller_name','unknown')}\n"
-                additional_prompt += f"Here is the content of the caller function:\n" + extract_file_content(files,caller['file'], caller['start_line'], caller['end_line']) + "\n"
+                additional_prompt += f"Here is the content of the caller function:\n" + extract_file_content(repo_index,caller['file'], caller['start_line'], caller['end_line']) + "\n"
         for func, same_name_funcs in modified_funcs_to_same_name_funcs.items():
             for same_name_func in same_name_funcs:
                 additional_prompt += f"For modified function {func}, we found a function with the same name in File {same_name_func['file']}: Line interval {same_name_func['start_line']}-{same_name_func['end_line']}\n"
-                additional_prompt += f"Here is the content of the function:\n" + extract_file_content(files,same_name_func['file'], same_name_func['start_line'], same_name_func['end_line']) + "\n"
-        loc = redo_localization(instance_id, args, logger, loc, additional_prompt, problem_statement, structure, not_found_file_dict=not_found_file_dict)
+                additional_prompt += f"Here is the content of the function:\n" + extract_file_content(repo_index,same_name_func['file'], same_name_func['start_line'], same_name_func['end_line']) + "\n"
+        loc = redo_localization(instance_id, args, logger, loc, additional_prompt, problem_statement, repo_index, not_found_file_dict=not_found_file_dict)
         # get the new localization results
         pred_files = loc["found_files"]
         file_contents = dict()
@@ -923,12 +931,11 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
         for i, pred_file in enumerate(pred_files):
             content = None
 
-            # files are all files in the repo, index 0 is the file name, index 1 is the content
-            for file_content in files:
-                if file_content[0] == pred_file:
-                    content = "\n".join(file_content[1])
-                    file_contents[pred_file] = content
-                    break
+            # index 0 is the file name, index 1 is the content
+            file_content = repo_index.get_file(pred_file)
+            if file_content is not None:
+                content = "\n".join(file_content[1])
+                file_contents[pred_file] = content
 
             assert content is not None, f"{pred_file} file not found"
         file_loc_intervals = {}
@@ -969,7 +976,7 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
         file_to_edit_locs,
         pred_files,
         file_contents,
-        structure,
+        repo_index,
         context_window=args.context_window,
         loc_interval=args.loc_interval,
         fine_grain_loc_only=args.fine_grain_loc_only,
@@ -997,7 +1004,7 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
             file_to_edit_locs_func,
             pred_files,
             file_contents,
-            structure,
+            repo_index,
             context_window=args.context_window,
             loc_interval=args.loc_interval,
             fine_grain_loc_only=args.fine_grain_loc_only,
@@ -1017,55 +1024,58 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
     # with verifier, get batch_size plans and generate batch_size patches, let verifier to find one patch that can pass the verification
     # note that for the last batch, args.batch_size may be modified to be smaller
     if args.sample_mod or base_patch_diff == "":
-        message_get_plan = planning_prompt_random_file.format(
+        message_get_plan = create_planning_message(
+            planning_prompt_random_file,
             problem_statement=problem_statement,
             content=topn_content.rstrip(),
             example=example,
-            files=' '.join(file_loc_intervals.keys())
-        ).strip()
+        )
     elif args.refine_mod:
         content = topn_content.rstrip()
         if instance_id in reloca_ids or did_relocate:
             feedback_prompt += '\n The previous patch may have targeted incorrect locations, such as the wrong lines, functions, or files. Your need to carefully evaluate and double-check to propose a plan that patches the correct locations to effectively resolve the issue.'
             feedback_prompt += '\n Note that the provided previous patch is just for reference, we will not apply it to the codebase. You need to propose a new patch based on the current code context.'
-        message_get_plan = planning_prompt_poc_feedback.format(
+        message_get_plan = create_planning_message(
+            planning_prompt_poc_feedback,
             problem_statement=problem_statement,
             content=content,
             example=example,
             feedback=feedback_prompt,
-        ).strip()
+        )
     else:
         raise ValueError("invalid mode, must be sample_mod or refine_mod")
     
     planning_trajs = []
     # get one greedy plan for the first batch
     if num_generated_sample == 0:
-        logger.info(f"prompting with message:\n{message_get_plan}")
+        logger.info(f"prompting with message:\n{get_message_text(message_get_plan)}")
         print('generating greedy plan')
         planning_trajs = greedy_model.codegen(message_get_plan, num_samples=1)
         logger.info(f"Got response:\n{planning_trajs}")
 
     # get one greedy plan for fixing the bug in a general way
     if num_generated_sample == 0 and args.batch_size > 1:
-        message_general = planning_prompt_general.format(
+        message_general = create_planning_message(
+            planning_prompt_general,
             problem_statement=problem_statement,
             content=topn_content.rstrip(),
             example=example,
-        ).strip()
+        )
         print('generating big plan')
-        logger.info(f"prompting with message:\n{message_general}")
+        logger.info(f"prompting with message:\n{get_message_text(message_general)}")
         planning_trajs += greedy_model.codegen(message_general, num_samples=1)
         logger.info(f"Got response:\n{planning_trajs}")
 
     # get one greedy plan for fixing the bug with minimal modifications
     if num_generated_sample == 0 and args.batch_size > 2:
-        message_minimal = planning_prompt_minimal.format(
+        message_minimal = create_planning_message(
+            planning_prompt_minimal,
             problem_statement=problem_statement,
             content=topn_content.rstrip(),
             example=example,
-        ).strip()
+        )
         print('generating minimal plan')
-        logger.info(f"prompting with message:\n{message_minimal}")
+        logger.info(f"prompting with message:\n{get_message_text(message_minimal)}")
         planning_trajs += greedy_model.codegen(message_minimal, num_samples=1)
         logger.info(f"Got response:\n{planning_trajs}")
 
@@ -1084,6 +1094,8 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
             availabel_model = {'claude-3-5-sonnet-20241022': 1}
         elif args.backend == "deepseek":
             availabel_model = {'deepseek-reasoner': 1}
+        elif args.backend == "mock":
+            availabel_model = {args.model: 1}
         else:
             raise NotImplementedError(f"backend {args.backend} not implemented for diverse sampling")
 
@@ -1104,33 +1116,26 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
             else:
                 topn_content_sample = topn_content
 
+            # if the instance is reproduced, 50% possibility to provide the reproduce info
+            reproduce_info = ""
+            if include_reproduce_info_sample == 'yes' and poc_code:
+                reproduce_info = poc_info_prompt.format(poc_code=poc_code, stdout=poc_orig_std_out, stderr=poc_orig_std_err)
+
             if prompt_sample == 'general':
-                message = planning_prompt_general.format(
-                    problem_statement=problem_statement,
-                    content=topn_content_sample.rstrip(),
-                    example=example,
-                ).strip()
+                sample_prompt = planning_prompt_general
             elif prompt_sample == 'minimal':
-                message = planning_prompt_minimal.format(
-                    problem_statement=problem_statement,
-                    content=topn_content_sample.rstrip(),
-                    example=example,
-                ).strip()
+                sample_prompt = planning_prompt_minimal
             else: # normal
-                message = planning_prompt_random_file.format(
-                    problem_statement=problem_statement,
-                    content=topn_content_sample.rstrip(),
-                    example=example,
-                    files=' '.join(file_loc_intervals.keys())
-                ).strip()
-            # if the instance is reproduced, 50% possibility to provide the reproduce info
-            if include_reproduce_info_sample == 'yes':
-                reproduce_info = ""
-                if poc_code:
-                    reproduce_info = poc_info_prompt.format(poc_code=poc_code, stdout=poc_orig_std_out, stderr=poc_orig_std_err)
-                    message += reproduce_info
+                sample_prompt = planning_prompt_random_file
+            message = create_planning_message(
+                sample_prompt,
+                problem_statement=problem_statement,
+                content=topn_content_sample.rstrip(),
+                suffix=reproduce_info,
+                example=example,
+            )
 
-            logger.info(f"prompting with message:\n{message}")
+            logger.info(f"prompting with message:\n{get_message_text(message)}")
             planning_trajs += make_model(
                 model=model_sample,
                 logger=logger,
@@ -1151,7 +1156,7 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
             temperature=1,
             batch_size=args.batch_size,
         )
-        logger.info(f"prompting with message:\n{message_get_plan}")
+        logger.info(f"prompting with message:\n{get_message_text(message_get_plan)}")
         if num_generated_sample == 0:
             if args.batch_size > 3:
                 planning_trajs += model_sample.codegen(message_get_plan, num_samples=args.batch_size-3)
@@ -1218,53 +1223,9 @@ def process_loc(loc, args, swe_bench_data, prev_generations):
     
     raw_outputs = [patch_candidate for patch_candidate in patch_candidates]
     
-    # save generated patches to file
-    # use lock to prevent multiple threads from writing to the same file at the same time
-    with output_file_lock:
-        if os.path.exists(args.output_file):
-            prev_generations = load_jsonl(args.output_file)
-            found = False
-            for entry in prev_generations:
-                if entry["instance_id"] == instance_id:
-                    found = True
-                    entry["raw_output"].extend(raw_outputs)
-                    entry["git_diffs"].extend(git_diffs)
-                    entry["raw_git_diffs"].extend(raw_git_diffs)
-                    break
-            if found:
-                with open(args.output_file, "w") as f:
-                    for entry in prev_generations:
-                        f.write(json.dumps(entry) + "\n")
-                    f.flush()
-            else:  # previous generations do not contain the current instance, add it
-                with open(args.output_file, "a") as f:
-                    f.write(
-                        json.dumps(
-                            {
-                                "instance_id": instance_id,
-                                "raw_output": raw_outputs,
-                                "git_diffs": git_diffs,
-                                "raw_git_diffs": raw_git_diffs,
-                            }
-                        )
-                        + "\n"
-                    )
-                    f.flush()
-        else:
-            # write the first instance
-            with open(args.output_file, "a") as f:
-                f.write(
-                    json.dumps(
-                        {
-                            "instance_id": instance_id,
-                            "raw_output": raw_outputs,
-                            "git_diffs": git_diffs,
-                            "raw_git_diffs": raw_git_diffs,
-                        }
-                    )
-                    + "\n"
-                )
-                f.flush()
+    # save generated patches to file, the batch is appended as a new record of the instance
+    append_generations(args.output_file, instance_id, raw_outputs, git_diffs, raw_git_diffs)
+    return raw_outputs, git_diffs, raw_git_diffs
 
 
 def redo_localization(instance_id, args, logger, loc, additional_prompt, problem_statement, structure, not_found_file_dict=None):
@@ -1385,92 +1346,139 @@ def repair(args):
         for loc in locs:
             f.write(json.dumps(loc) + "\n")
             
-    prev_generations = []
-    if os.path.exists(args.raw_output_file):
-        prev_generations = load_jsonl(args.raw_output_file)
-        
+    prev_generations = load_generations(args.raw_output_file)
+    processed_samples = load_processed_samples(args, range(num_generated_sample, args.max_samples))
     
     if args.num_threads == 1:
         for loc in tqdm(locs, total=len(locs)):
-            process_loc(loc, args, swe_bench_data, prev_generations)
+            repair_instance(loc, args, swe_bench_data, prev_generations, processed_samples)
     else:
         with concurrent.futures.ThreadPoolExecutor(
                 max_workers=args.num_threads
         ) as executor:
             futures = {
-                executor.submit(process_loc, loc, args, swe_bench_data, prev_generations): loc
+                executor.submit(repair_instance, loc, args, swe_bench_data, prev_generations, processed_samples): loc
                 for loc in locs
             }
             for future in tqdm(
                     concurrent.futures.as_completed(futures), total=len(locs)
             ):
                 result = future.result()
+    # merge the records appended in this round into one entry per instance
+    compact_generations(args.raw_output_file)
 
 
-def post_process_repair(args):
+def repair_instance(loc, args, swe_bench_data, prev_generations, processed_samples):
     """
-    apply some diff formatting.
+    Generate, post-process and verify the batches of one instance without waiting for the other instances,
+    every sample is verified as soon as its batch is generated.
+    In sample mode the next batch starts once the verification of the previous one finishes, and the instance
+    stops early when a sample passes all verifications. In refine mode only the batch of the current round is
+    generated, the rerank after the round needs the results of all instances.
     """
-    raw_outputs = load_jsonl(args.raw_output_file)
+    instance_id = loc["instance_id"]
+    generation = {field: [] for field in GENERATION_FIELDS}
+    if instance_id in prev_generations:
+        generation = {field: list(prev_generations[instance_id][field]) for field in GENERATION_FIELDS}
+        generation["empty_output"] = prev_generations[instance_id].get("empty_output", False)
+
+    generated = num_generated_sample
+    while generated < args.max_samples:
+        if early_exit_registry is not None and instance_id in early_exit_registry:
+            print(f"{instance_id} has a sample passing all verifications, stop generating")
+            break
+        instance_args = copy.copy(args)
+        instance_args.batch_size = min(args.batch_size, args.max_samples - generated)
+        new_generations = process_loc(loc, instance_args, swe_bench_data, prev_generations, generated)
+        if new_generations:
+            for field, values in zip(GENERATION_FIELDS, new_generations):
+                generation[field].extend(values)
+
+        for sample_idx in range(generated, generated + instance_args.batch_size):
+            result = post_process_sample(args, instance_id, generation, sample_idx, processed_samples)
+            if result is not None:
+                verify_sample(args, instance_id, result["model_patch"], sample_idx)
+        generated += instance_args.batch_size
+
+        if not args.sample_mod:
+            break
 
-    for raw_output in raw_outputs:
-        git_diff = ""
-        raw_git_diff = ""
-        instance_id = raw_output["instance_id"]
-        if instance_id not in args.task_ids_to_repair:
-            continue
-        skip=False
-        if os.path.exists(args.output_file):
-            with open(args.output_file, "r") as f:
-                for line in f:
-                    data = json.loads(line)
-                    if data.get("instance_id") == instance_id:
-                        # If a match is found, skip further processing
-                        skip=True
-                        break
-        if skip:
-            continue
 
-        if raw_output["raw_output"] == "":
-            with open(args.output_file, "a") as f:
-                f.write(
-                    json.dumps(
-                        {
-                            "model_name_or_path": "PatchingPilot",
-                            "instance_id": instance_id,
-                            "model_patch": "",
-                        }
-                    )
-                    + "\n"
-                )
-            continue
+def get_processed_file(args, sample_idx):
+    return args.raw_output_file.replace(".jsonl", f"_{sample_idx}_processed.jsonl")
 
-        if args.select_id == -1:
-            # Use the last generation
-            assert False, "not implemented for now"
-        else:
-            # Use the indexed generation
-            generation_idx = args.select_id
-            if generation_idx >= len(raw_output["git_diffs"]) or generation_idx >= len(raw_output["raw_git_diffs"]):
-                continue
-            git_diff = raw_output["git_diffs"][generation_idx]
-            raw_git_diff = raw_output["raw_git_diffs"][generation_idx]       
-        
-        print(f"The patch for the {generation_idx}-th patch in post process:")
+
+def post_process_sample(args, instance_id, generation, sample_idx, processed_samples):
+    """
+    apply some diff formatting to one sample of an instance and save it to f"_{sample_idx}_processed.jsonl".
+    Returns the processed result, or None if the instance has no such sample.
+    """
+    if instance_id in processed_samples[sample_idx]:
+        return processed_samples[sample_idx][instance_id]
+    if generation.get("empty_output") and not generation["git_diffs"]:
+        # an instance without any output still gets a record, with an empty patch
+        result = {
+            "model_name_or_path": "PatchingPilot",
+            "instance_id": instance_id,
+            "model_patch": "",
+        }
+    elif sample_idx >= len(generation["git_diffs"]) or sample_idx >= len(generation["raw_git_diffs"]):
+        return None
+    else:
+        git_diff = generation["git_diffs"][sample_idx]
+        raw_git_diff = generation["raw_git_diffs"][sample_idx]
+
+        print(f"The patch for the {sample_idx}-th patch in post process:")
         print(f'model_patch: {git_diff.lstrip()}')
-        
-        with open(args.output_file, "a") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "model_name_or_path": "PatchingPilot",
-                        "instance_id": instance_id,
-                        "model_patch": git_diff.lstrip(),
-                        "raw_model_patch": raw_git_diff.lstrip(),
-                    }
-                )
-                + "\n"
-            )
+
+        result = {
+            "model_name_or_path": "PatchingPilot",
+            "instance_id": instance_id,
+            "model_patch": git_diff.lstrip(),
+            "raw_model_patch": raw_git_diff.lstrip(),
+        }
+    processed_file = get_processed_file(args, sample_idx)
+    with get_generation_lock(processed_file):
+        with open(processed_file, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    return result
+
+
+def verify_sample(args, instance_id, model_patch, sample_idx):
+    """
+    Verify one sample of an instance into the samples_{sample_idx} verify folder, returns its rank.
+    The samples of an instance are verified one after another, they share the task of the instance.
+    """
+    tasks = [task for task in args.tasks_list if task.task_id == instance_id]
+    if not tasks:
+        return sys.maxsize
+    task = tasks[0]
+    sample_args = copy.copy(args)
+    sample_args.verify_folder = orig_verify_folder + f"/samples_{sample_idx}"
+    ensure_directory_exists(sample_args.verify_folder)
+    verify_file = os.path.join(sample_args.verify_folder, instance_id, "verify_outputs.json")
+
+    task.patched_diff = model_patch
+    existing_instance_ids = {instance_id} if os.path.exists(verify_file) else set()
+    print(f"=================== verifying the {sample_idx}-th patch of {instance_id} ===================")
+    try:
+        execute_verify_instance(task, sample_args, existing_instance_ids)
+    except Exception as e:
+        print(f"failed to verify the {sample_idx}-th patch of {instance_id}: {e}")
+    if not os.path.exists(verify_file):
+        return sys.maxsize
+    with open(verify_file, "r") as f:
+        verify_info = json.load(f)
+    rank = get_rank_from_verify_info(args, verify_info, model_patch)
+    if rank == 0 and early_exit_registry is not None and exits_early(verify_info):
+        early_exit_registry.add(instance_id, sample_idx, model_patch)
+    return rank
+
+
+def exits_early(verify_info):
+    # a patch only passes all verifications if at least one poc was executed, without one rank 0 just means
+    # that the functionality tests passed, and later samples or the refinement may still find a verified patch
+    return any(verify_info["result"]["poc_is_executed"])
 
 
 def get_line_change_num(patch):
@@ -1517,16 +1525,15 @@ def break_tie(args, loc, instance_id, final_patches, min_patches):
     structure = get_repo_structure(
         instance_id, bench_data["repo"], bench_data["base_commit"], "playground"
     )
-    files, _, _ = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = RepoIndex(structure)
     file_contents = dict()
     for i, pred_file in enumerate(pred_files):
         content = None
 
-        for file_content in files:
-            if file_content[0] == pred_file:
-                content = "\n".join(file_content[1])
-                file_contents[pred_file] = content
-                break
+        file_content = repo_index.get_file(pred_file)
+        if file_content is not None:
+            content = "\n".join(file_content[1])
+            file_contents[pred_file] = content
 
         assert content is not None, f"{pred_file} file not found"
 
@@ -1583,6 +1590,23 @@ def get_rank_from_verify_info(args, verify_info, model_patch) -> float:
     return rank
 
 
+def load_processed_samples(args, sample_indices):
+    """
+    Index of the post-processed samples, sample index -> instance_id -> processed result.
+    Each file is read once, post_process_sample writes one result per instance and sample.
+    Instances that stopped early have no results for the later samples.
+    """
+    processed_samples = dict()
+    for i in sample_indices:
+        processed_samples[i] = dict()
+        processed_file = get_processed_file(args, i)
+        if not os.path.exists(processed_file):
+            continue
+        for result in load_jsonl(processed_file):
+            processed_samples[i].setdefault(result["instance_id"], result)
+    return processed_samples
+
+
 def rerank_by_verification(args, num_generated_sample_before, num_generated_sample, best_patch_file=None):
     # key is the instance_id, value is also a dict, with key being the patch and value being the rank (listed above)
     all_predictions = dict()
@@ -1603,30 +1627,27 @@ def rerank_by_verification(args, num_generated_sample_before, num_generated_samp
     global reloca_ids
     reloca_ids = []
 
+    processed_samples = load_processed_samples(args, range(num_generated_sample))
     for i in range(num_generated_sample_before, num_generated_sample):
-        with open(args.raw_output_file.replace(
-                ".jsonl", f"_{i}_processed.jsonl"), "r") as f:
-            for line in f:
-                result = json.loads(line)
-                instance_id = result["instance_id"]
-                if instance_id not in args.task_ids_to_repair:
-                    continue
-                if "model_patch" in result:
-                    verify_file = args.verify_folder + os.path.join(f"/samples_{i}", instance_id, "verify_outputs.json")
-                    if os.path.exists(verify_file):
-                        print("checking the verification file", verify_file)
-                        with open(verify_file, "r") as f:
-                            verify_info = json.load(f)
-                        model_patch = result["model_patch"]
-                        rank = get_rank_from_verify_info(args, verify_info, model_patch)                     
-                    else:
-                        rank = sys.maxsize
-                if instance_id not in all_predictions:
-                    all_predictions[instance_id] = {result["model_patch"]: rank}
+        for instance_id, result in processed_samples[i].items():
+            if instance_id not in args.task_ids_to_repair:
+                continue
+            if "model_patch" in result:
+                verify_file = args.verify_folder + os.path.join(f"/samples_{i}", instance_id, "verify_outputs.json")
+                if os.path.exists(verify_file):
+                    print("checking the verification file", verify_file)
+                    with open(verify_file, "r") as f:
+                        verify_info = json.load(f)
+                    model_patch = result["model_patch"]
+                    rank = get_rank_from_verify_info(args, verify_info, model_patch)                     
                 else:
-                    # if there are multiple patches that are exactly the same, we only keep the one with the smallest rank, since the verification res may be unstable
-                    all_predictions[instance_id][result["model_patch"]] = min(rank, all_predictions[instance_id].get(
-                        result["model_patch"], sys.maxsize))
+                    rank = sys.maxsize
+            if instance_id not in all_predictions:
+                all_predictions[instance_id] = {result["model_patch"]: rank}
+            else:
+                # if there are multiple patches that are exactly the same, we only keep the one with the smallest rank, since the verification res may be unstable
+                all_predictions[instance_id][result["model_patch"]] = min(rank, all_predictions[instance_id].get(
+                    result["model_patch"], sys.maxsize))
 
     if best_patch_file:
         with open(best_patch_file, "r") as f:
@@ -1693,16 +1714,12 @@ def rerank_by_verification(args, num_generated_sample_before, num_generated_samp
     # get the indices of the final patches (which sample they are from)
     final_patch_indices = dict()
 
-    for i in range(num_generated_sample):
-        with open(args.raw_output_file.replace(".jsonl", f"_{i}_processed.jsonl"), "r") as f:
-            for line in f:
-                result = json.loads(line)
-                if result["instance_id"] in final_patch_indices:
-                    continue
-                instance_id = result["instance_id"]
-                if "model_patch" in result and instance_id in final_patches:
-                    if result["model_patch"] == final_patches[instance_id]:
-                        final_patch_indices[instance_id] = i
+    for instance_id, final_patch in final_patches.items():
+        for i in range(num_generated_sample):
+            result = processed_samples[i].get(instance_id)
+            if result is not None and result.get("model_patch") == final_patch:
+                final_patch_indices[instance_id] = i
+                break
     return final_patches, patches_passed_all_verifications, patches_passed_all_functionality_tests_no_poc, final_ranks, final_patch_indices
 
 
@@ -1726,7 +1743,7 @@ def main():
         default="gpt-4o-2024-08-06",
     )
     parser.add_argument(
-        "--backend", type=str, default="openai", choices=["openai", "deepseek", "claude"]
+        "--backend", type=str, default="openai", choices=["openai", "deepseek", "claude", "mock"]
     )
     parser.add_argument("--output_folder", type=str, required=True)
     parser.add_argument("--add_space", action="store_true")
@@ -1839,6 +1856,8 @@ def main():
     global reloca_ids
     global reloca_locs
     global last_round
+    global early_exit_registry
+    early_exit_registry = EarlyExitRegistry(os.path.join(args.output_folder, "early_exit.json"))
 
     # repair and post-process
     # reproduce
@@ -1856,26 +1875,16 @@ def main():
             last_round = True
         print(f"already generated {num_generated_sample} examples")
         print(f"generating the {num_generated_sample + 1}th to {num_generated_sample + args.batch_size}th examples in round {round_idx}")
-        repair(args)  # output.jsonl should have all generations in this round
-        for i in range(args.batch_size):
-            args.output_file = args.raw_output_file.replace(
-                ".jsonl", f"_{num_generated_sample + i}_processed.jsonl"
-            )
-            args.select_id = num_generated_sample + i
-            # do postprocess and save the processed output file to f"_{num_generated_sample+i}_processed.jsonl"
-            post_process_repair(args)
-
-        # for each output file in the round, do verification
-            args.patch_file = args.output_file
-            args.verify_folder = orig_verify_folder + f"/samples_{num_generated_sample+i}"
-            ensure_directory_exists(args.verify_folder)
-            print(f"=================== verifying the patch_file {args.patch_file} ===================")
-            verify(args)
+        # every instance generates, post-processes to f"_{sample_idx}_processed.jsonl" and verifies its samples on its own,
+        # in sample mode it also goes on with its next batches, so the whole budget is used in one call
+        repair(args)
+        print(f"{len(early_exit_registry)} instances have a sample passing all verifications")
 
         # update round_idx and num_generated_sample
-        args.output_file = args.raw_output_file  # reset the output file
-
-        num_generated_sample += args.batch_size
+        if args.sample_mod:
+            num_generated_sample = args.max_samples
+        else:
+            num_generated_sample += args.batch_size
 
         #if refine mode, rerank the patches by verification results for each round, save the results for each round
         if args.refine_mod:
@@ -1953,6 +1962,9 @@ def main():
                 task.patched_diff = patches_passed_all_verifications[instance_id]
                 finish_gen_ids.append(instance_id)
             
+            for instance_id in finish_gen_ids:
+                if instance_id in best_patches:
+                    early_exit_registry.add(instance_id, final_patch_indices.get(instance_id), best_patches[instance_id])
             args.task_ids_to_repair = [id for id in args.task_ids_to_repair if id not in finish_gen_ids]
             args.tasks_list = [task for task in args.tasks_list if task.task_id not in finish_gen_ids]
             
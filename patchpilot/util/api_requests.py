@@ -1,5 +1,14 @@
+import asyncio
+import email.utils
+import functools
+import hashlib
+import importlib
+import os
+import random
+import threading
 import time
 import json
+from collections import OrderedDict
 from typing import Dict, Union
 
 import anthropic
@@ -7,20 +16,76 @@ import openai
 import tiktoken
 
 
-def num_tokens_from_messages(message, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
+# token counts of recent prompts, keyed by (model, hash of the text)
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", 4096))
+token_count_cache = OrderedDict()
+token_count_cache_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Returns the tiktoken encoding of a model, loaded once per model."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if isinstance(message, list):
-        # use last message.
-        num_tokens = len(encoding.encode(message[0]["content"]))
-    else:
-        num_tokens = len(encoding.encode(message))
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_text(text, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens of a text, memoized for recently counted texts."""
+    key = (model, hashlib.sha256(text.encode("utf-8", "surrogatepass")).digest())
+    with token_count_cache_lock:
+        if key in token_count_cache:
+            token_count_cache.move_to_end(key)
+            return token_count_cache[key]
+    num_tokens = len(get_encoding(model).encode(text))
+    with token_count_cache_lock:
+        token_count_cache[key] = num_tokens
+        while len(token_count_cache) > TOKEN_COUNT_CACHE_SIZE:
+            token_count_cache.popitem(last=False)
     return num_tokens
 
 
+def num_tokens_from_messages(message, model="gpt-3.5-turbo-0301"):
+    """Returns the number of tokens used by a list of messages."""
+    if isinstance(message, list):
+        # use last message, the text blocks of create_cached_message are counted as their joined text
+        return num_tokens_from_text(join_text_blocks(message[:1])[0]["content"], model)
+    return num_tokens_from_text(message, model)
+
+
+def create_cached_message(*blocks) -> list:
+    """User message made of a stable prompt prefix and a varying suffix, e.g. (issue and code, plan, current step).
+    Anthropic caches the prompt up to the end of every block but the last one, OpenAI caches the longest prefix it has
+    already seen on its own, so the blocks are joined for it. Blocks are joined without separators.
+    """
+    content = [{"type": "text", "text": block} for block in blocks if block]
+    # Anthropic allows at most 4 cache breakpoints in a request
+    for block in content[:-1][-3:]:
+        block["cache_control"] = {"type": "ephemeral"}
+    return [{"role": "user", "content": content}]
+
+
+def is_text_blocks(content) -> bool:
+    return isinstance(content, list) and all(isinstance(block, dict) and block.get("type") == "text" for block in content)
+
+
+def join_text_blocks(messages: list) -> list:
+    """Messages with the text blocks of create_cached_message joined into plain string contents."""
+    return [
+        dict(message, content="".join(block["text"] for block in message["content"]))
+        if is_text_blocks(message.get("content")) else message
+        for message in messages
+    ]
+
+
+def get_message_text(message: Union[str, list]) -> str:
+    """The prompt of a string or list message as text, for logging."""
+    if isinstance(message, str):
+        return message
+    return "\n".join(str(message.get("content", "")) for message in join_text_blocks(message))
+
+
 def create_chatgpt_config(
     message: Union[str, list],
     max_tokens: int,
@@ -30,6 +95,9 @@ def create_chatgpt_config(
     model: str = "gpt-3.5-turbo",
     **kwargs,
 ) -> Dict:
+    if isinstance(message, list):
+        # OpenAI compatible servers cache prompt prefixes automatically, no breakpoints are sent
+        message = join_text_blocks(message)
     if 'o1' in model or 'o3' in model or 'o4' in model or "deepseek" in model:
         # o1 doesn't support system messages
         if isinstance(message, list):
@@ -70,58 +138,224 @@ def create_chatgpt_config(
     return config
 
 
+# API clients are shared by all decoders of the process so that connections are kept alive between requests
+API_MAX_CONNECTIONS = int(os.environ.get("API_MAX_CONNECTIONS", 100))
+api_clients = {}
+api_clients_lock = threading.Lock()
+
+
+def get_connection_limits(sdk):
+    """Returns the connection limits of the pooled clients, built with the limits type of the HTTP
+    transport the SDK runs on (httpx or httpx2), which is the only one its default clients accept."""
+    limits_class = type(importlib.import_module(f"{sdk.__name__}._constants").DEFAULT_CONNECTION_LIMITS)
+    return limits_class(
+        max_connections=API_MAX_CONNECTIONS,
+        max_keepalive_connections=API_MAX_CONNECTIONS,
+    )
+
+
+def get_client(backend, base_url=None, api_key=None, use_async=False):
+    """Returns the pooled client of a backend ("openai" or "anthropic"), created on first use.
+    Async clients are bound to the event loop they are first used in, so they are pooled per loop."""
+    key = (backend, base_url, api_key, asyncio.get_running_loop() if use_async else None)
+    with api_clients_lock:
+        if key not in api_clients:
+            kwargs = {"api_key": api_key} if api_key else {}
+            sdk = anthropic if backend == "anthropic" else openai
+            if backend == "anthropic":
+                client_class = anthropic.AsyncAnthropic if use_async else anthropic.Anthropic
+            else:
+                client_class = openai.AsyncOpenAI if use_async else openai.OpenAI
+            http_client_class = sdk.DefaultAsyncHttpxClient if use_async else sdk.DefaultHttpxClient
+            api_clients[key] = client_class(
+                base_url=base_url,
+                http_client=http_client_class(limits=get_connection_limits(sdk)),
+                **kwargs,
+            )
+        return api_clients[key]
+
+
 def handler(signum, frame):
     # swallow signum and frame
     raise Exception("end of time")
 
 
-def request_chatgpt_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+# requests and tokens per minute allowed for each (backend, model), 0 means unlimited
+API_RPM_LIMIT = float(os.environ.get("API_RPM_LIMIT", 0))
+API_TPM_LIMIT = float(os.environ.get("API_TPM_LIMIT", 0))
+# exponential backoff between retries, in seconds
+API_RETRY_BASE_DELAY = float(os.environ.get("API_RETRY_BASE_DELAY", 1))
+API_RETRY_MAX_DELAY = float(os.environ.get("API_RETRY_MAX_DELAY", 60))
+
+
+class RateLimiter:
+    """Token buckets for the requests and the tokens per minute of one backend and model, shared by all threads.
+    A rate limit error pauses every request of the bucket instead of letting each thread retry on its own."""
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_refill = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens):
+        """Takes a request and tokens from the buckets, or returns how long to wait until they are available."""
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last_refill
+            self.last_refill = now
+            self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60)
+            self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60)
+            # a request larger than the bucket only waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+            wait = self.paused_until - now
+            if self.requests_per_minute:
+                wait = max(wait, (1 - self.available_requests) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                wait = max(wait, (tokens - self.available_tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+            if self.requests_per_minute:
+                self.available_requests -= 1
+            if self.tokens_per_minute:
+                self.available_tokens -= tokens
+            return 0
+
+    def acquire(self, tokens=0):
+        wait = self.try_acquire(tokens)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.try_acquire(tokens)
+
+    async def aacquire(self, tokens=0):
+        wait = self.try_acquire(tokens)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.try_acquire(tokens)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(backend, model):
+    key = (backend, model)
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(API_RPM_LIMIT, API_TPM_LIMIT)
+        return rate_limiters[key]
+
+
+def estimate_request_tokens(config):
+    """Prompt tokens of a request config plus the tokens it may generate, used to admit it under the tokens per minute limit."""
+    if not API_TPM_LIMIT:
+        return 0
+    texts = [config.get("system", ""), config.get("prompt", "")]
+    for message in config.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, list):
+            texts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+        else:
+            texts.append(content or "")
+    prompt_tokens = sum(num_tokens_from_text(text, config["model"]) for text in texts if isinstance(text, str) and text)
+    return prompt_tokens + config.get("max_tokens", config.get("max_completion_tokens", 0))
+
+
+def get_retry_after(e):
+    """Seconds to wait according to the Retry-After headers of an API error, or None."""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            retry_after = headers["retry-after"]
+            try:
+                return float(retry_after)
+            except ValueError:
+                return max(0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def get_backoff_delay(retries):
+    delay = min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** retries)
+    # jitter spreads out the retries of requests that failed at the same time
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def get_retry_delay(e, config, logger, retries=0):
+    """Logs a failed API request and returns how long to wait before retrying it, invalid requests are raised again."""
+    if isinstance(e, (openai.BadRequestError, anthropic.BadRequestError)):
+        logger.info("Request invalid")
+        print(e)
+        logger.info(e)
+        raise e
+    elif isinstance(e, RATE_LIMIT_ERRORS):
+        print(config)
+        print("Rate limit exceeded. Waiting...")
+        logger.info("Rate limit exceeded. Waiting...")
+        print(e)
+        logger.info(e)
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            return retry_after + random.uniform(0, API_RETRY_BASE_DELAY)
+        return get_backoff_delay(retries)
+    elif isinstance(e, (openai.APIConnectionError, anthropic.APIConnectionError)):
+        print("API connection error. Waiting...")
+        logger.info("API connection error. Waiting...")
+        print(e)
+        logger.info(e)
+        return get_backoff_delay(retries)
+    elif isinstance(e, json.decoder.JSONDecodeError):
+        print("JSON parsing in response error. Waiting...")
+        logger.info("JSON parsing in response error. Waiting...")
+        print(e)
+        logger.info(e)
+        return get_backoff_delay(retries)
+    else:
+        print("Unknown error. Waiting...")
+        logger.info("Unknown error. Waiting...")
+        print(e)
+        logger.info(e)
+        return get_backoff_delay(retries)
+
+
+RATE_LIMIT_ERRORS = (openai.RateLimitError, anthropic.RateLimitError)
+RETRYABLE_ERRORS = (openai.OpenAIError, anthropic.AnthropicError, json.decoder.JSONDecodeError)
+
+
+def request_with_retries(create, config, logger, max_retries=40, backend="openai"):
+    """Calls create() until it returns a response or max_retries attempts failed, returns None in that case.
+    Each attempt is admitted by the rate limiter of the backend and model."""
     ret = None
     retries = 0
+    rate_limiter = get_rate_limiter(backend, config.get("model"))
+    request_tokens = estimate_request_tokens(config)
 
-    if api_key:
-        client = openai.OpenAI(base_url=base_url, api_key=api_key)
-    else:
-        client = openai.OpenAI(base_url=base_url)
-    
     while ret is None and retries < max_retries:
+        rate_limiter.acquire(request_tokens)
         try:
             # Attempt to get the completion
             logger.info("Creating API request")
-            ret = client.chat.completions.create(**config)
-
-        except openai.OpenAIError as e:
-            if isinstance(e, openai.BadRequestError):
-                logger.info("Request invalid")
-                print(e)
-                logger.info(e)
-                raise e
-            elif isinstance(e, openai.RateLimitError):
-                print(config)
-                print("Rate limit exceeded. Waiting...")
-                logger.info("Rate limit exceeded. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            elif isinstance(e, openai.APIConnectionError):
-                print("API connection error. Waiting...")
-                logger.info("API connection error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
+            ret = create()
+        except RETRYABLE_ERRORS as e:
+            delay = get_retry_delay(e, config, logger, retries)
+            if isinstance(e, RATE_LIMIT_ERRORS):
+                # hold back every request to this model, not only this one
+                rate_limiter.pause(delay)
             else:
-                print("Unknown error. Waiting...")
-                logger.info("Unknown error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(1)
-
-        except json.decoder.JSONDecodeError as jsone:
-            print("JSON parsing in response error. Waiting...")
-            logger.info("JSON parsing in response error. Waiting...")
-            print(jsone)
-            logger.info(jsone)
-            time.sleep(5)
+                time.sleep(delay)
 
         retries += 1
 
@@ -129,61 +363,24 @@ def request_chatgpt_engine(config, logger, base_url=None, max_retries=40, timeou
     return ret
 
 
-def request_chatgpt_response_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+async def arequest_with_retries(acreate, config, logger, max_retries=40, backend="openai"):
+    """Same as request_with_retries for a coroutine function, waiting without blocking the event loop."""
     ret = None
     retries = 0
-    input = config["messages"][0]["content"]
-    model = config["model"]
-
-    if api_key:
-        client = openai.OpenAI(base_url=base_url, api_key=api_key)
-    else:
-        client = openai.OpenAI(base_url=base_url)
+    rate_limiter = get_rate_limiter(backend, config.get("model"))
+    request_tokens = estimate_request_tokens(config)
 
     while ret is None and retries < max_retries:
+        await rate_limiter.aacquire(request_tokens)
         try:
-            # Attempt to get the completion
             logger.info("Creating API request")
-            ret = client.responses.create(
-                model=model,
-                input = input,
-                reasoning={
-                    "effort": "high"
-                }
-            )
-
-        except openai.OpenAIError as e:
-            if isinstance(e, openai.BadRequestError):
-                logger.info("Request invalid")
-                print(e)
-                logger.info(e)
-                raise e
-            elif isinstance(e, openai.RateLimitError):
-                print(config)
-                print("Rate limit exceeded. Waiting...")
-                logger.info("Rate limit exceeded. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            elif isinstance(e, openai.APIConnectionError):
-                print("API connection error. Waiting...")
-                logger.info("API connection error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
+            ret = await acreate()
+        except RETRYABLE_ERRORS as e:
+            delay = get_retry_delay(e, config, logger, retries)
+            if isinstance(e, RATE_LIMIT_ERRORS):
+                rate_limiter.pause(delay)
             else:
-                print("Unknown error. Waiting...")
-                logger.info("Unknown error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(1)
-
-        except json.decoder.JSONDecodeError as jsone:
-            print("JSON parsing in response error. Waiting...")
-            logger.info("JSON parsing in response error. Waiting...")
-            print(jsone)
-            logger.info(jsone)
-            time.sleep(5)
+                await asyncio.sleep(delay)
 
         retries += 1
 
@@ -191,68 +388,64 @@ def request_chatgpt_response_engine(config, logger, base_url=None, max_retries=4
     return ret
 
 
+def create_chat_completion(client, config):
+    return client.chat.completions.create(**config)
+
+
+def create_response(client, config):
+    return client.responses.create(
+        model=config["model"],
+        input=config["messages"][0]["content"],
+        reasoning={
+            "effort": "high"
+        }
+    )
+
+
+def create_prefill_completion(client, config):
+    return client.completions.create(
+        model=config["model"],
+        prompt=config["prompt"],
+        max_tokens=config["max_tokens"],
+        temperature=config["temperature"]
+    )
+
+
+def create_anthropic_message(client, config):
+    return client.messages.create(**config)
+
+
+def request_chatgpt_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+    client = get_client("openai", base_url, api_key)
+    return request_with_retries(lambda: create_chat_completion(client, config), config, logger, max_retries)
+
+
+def request_chatgpt_response_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+    client = get_client("openai", base_url, api_key)
+    return request_with_retries(lambda: create_response(client, config), config, logger, max_retries)
+
+
 def request_chatgpt_prefill_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
-    ret = None
-    retries = 0
+    client = get_client("openai", base_url, api_key)
+    return request_with_retries(lambda: create_prefill_completion(client, config), config, logger, max_retries)
 
-    model = config["model"]
-    temperature = config["temperature"]
-    max_tokens = config["max_tokens"]
-    prompt = config["prompt"]
 
-    if api_key:
-        client = openai.OpenAI(base_url=base_url, api_key=api_key)
-    else:
-        client = openai.OpenAI(base_url=base_url)
+async def arequest_chatgpt_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+    client = get_client("openai", base_url, api_key, use_async=True)
+    return await arequest_with_retries(lambda: create_chat_completion(client, config), config, logger, max_retries)
 
-    while ret is None and retries < max_retries:
-        try:
-            # Attempt to get the completion
-            logger.info("Creating API request")
-            ret = client.completions.create(
-                model=model,
-                prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature
-            )
 
-        except openai.OpenAIError as e:
-            if isinstance(e, openai.BadRequestError):
-                logger.info("Request invalid")
-                print(e)
-                logger.info(e)
-                raise e
-            elif isinstance(e, openai.RateLimitError):
-                print(config)
-                print("Rate limit exceeded. Waiting...")
-                logger.info("Rate limit exceeded. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            elif isinstance(e, openai.APIConnectionError):
-                print("API connection error. Waiting...")
-                logger.info("API connection error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            else:
-                print("Unknown error. Waiting...")
-                logger.info("Unknown error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(1)
-
-        except json.decoder.JSONDecodeError as jsone:
-            print("JSON parsing in response error. Waiting...")
-            logger.info("JSON parsing in response error. Waiting...")
-            print(jsone)
-            logger.info(jsone)
-            time.sleep(5)
+async def arequest_chatgpt_response_engine(config, logger, base_url=None, max_retries=40, timeout=100, api_key=None):
+    client = get_client("openai", base_url, api_key, use_async=True)
+    return await arequest_with_retries(lambda: create_response(client, config), config, logger, max_retries)
 
-        retries += 1
 
-    logger.info(f"API response {ret}")
-    return ret
+def has_cache_breakpoint(messages: list) -> bool:
+    return any(
+        isinstance(block, dict) and "cache_control" in block
+        for message in messages if isinstance(message.get("content"), list)
+        for block in message["content"]
+    )
 
 
 def create_anthropic_config(
@@ -282,7 +475,8 @@ def create_anthropic_config(
             }]
         }]
         
-    if batch_size > 1:
+    # samples of the same prompt share it as a cached prefix, unless the prompt already has its own breakpoints
+    if batch_size > 1 and not has_cache_breakpoint(messages):
         if isinstance(messages[0]["content"], list):
             messages[0]["content"][0]["cache_control"] = {"type": "ephemeral"}
         else:
@@ -297,46 +491,10 @@ def create_anthropic_config(
 
 
 def request_anthropic_engine(config, logger, base_url=None, max_retries=40, timeout=100):
-    ret = None
-    retries = 0
-
-    client = anthropic.Anthropic(base_url=None)
-
-    while ret is None and retries < max_retries:
-        try:
-            logger.info("Creating API request")
+    client = get_client("anthropic", base_url)
+    return request_with_retries(lambda: create_anthropic_message(client, config), config, logger, max_retries, "anthropic")
 
-            ret = client.messages.create(**config)
-
-        except anthropic.AnthropicError as e:
-            print(e)
-            if isinstance(e, anthropic.BadRequestError):
-                logger.info("Request invalid")
-                print(e)
-                logger.info(e)
-                raise e
-            elif isinstance(e, anthropic.RateLimitError):
-                print(config)
-                print("Rate limit exceeded. Waiting...")
-                logger.info("Rate limit exceeded. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            elif isinstance(e, anthropic.APIConnectionError):
-                print("API connection error. Waiting...")
-                logger.info("API connection error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(5)
-            else:
-                print("Unknown error. Waiting...")
-                logger.info("Unknown error. Waiting...")
-                print(e)
-                logger.info(e)
-                time.sleep(1)
 
-        retries += 1
-
-        logger.info(f"API response {ret}")
-        return ret
-    return None
+async def arequest_anthropic_engine(config, logger, base_url=None, max_retries=40, timeout=100):
+    client = get_client("anthropic", base_url, use_async=True)
+    return await arequest_with_retries(lambda: create_anthropic_message(client, config), config, logger, max_retries, "anthropic")
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+
+# off: always query the API
+# read_through: answer from the cache, query and store on a miss
+# write_through: always query the API and store the responses, e.g. to refresh the cache
+# replay: only answer from the cache, a miss is an error, no request leaves the process
+LLM_CACHE_MODES = ("off", "read_through", "write_through", "replay")
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE_MODE", "off")
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "patchpilot", "llm_cache.sqlite")
+)
+
+
+class LLMCacheMiss(KeyError):
+    pass
+
+
+class LLMCache:
+    """Responses of codegen calls stored in SQLite, keyed by the model, the prompt and the sampling parameters.
+    Identical calls made again in the same process get the next sample index, so a sampled run is replayed
+    call by call instead of returning the first response every time.
+    """
+
+    def __init__(self, path, mode):
+        assert mode in LLM_CACHE_MODES, f"Unknown LLM_CACHE_MODE {mode}, expected one of {LLM_CACHE_MODES}"
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.sample_indices = {}
+        self.connection = None
+
+    def get_connection(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # the connection is shared by all threads, every access holds self.lock
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, trajs BLOB)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get_key(self, model, message, params):
+        """Key of the next call with these arguments."""
+        call = json.dumps({"model": model, "message": message, "params": params}, sort_keys=True, default=str)
+        call_hash = hashlib.sha256(call.encode("utf-8", "surrogatepass")).hexdigest()
+        with self.lock:
+            sample_index = self.sample_indices.get(call_hash, 0)
+            self.sample_indices[call_hash] = sample_index + 1
+        return f"{call_hash}:{sample_index}"
+
+    def get(self, key):
+        if self.mode not in ("read_through", "replay"):
+            return None
+        with self.lock:
+            row = self.get_connection().execute("SELECT trajs FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return pickle.loads(row[0])
+        if self.mode == "replay":
+            raise LLMCacheMiss(f"No cached response for {key} in {self.path}, LLM_CACHE_MODE=replay")
+        return None
+
+    def put(self, key, model, trajs):
+        if self.mode not in ("read_through", "write_through"):
+            return
+        # failed requests come back as empty responses, they are retried on the next run instead of replayed
+        if any(not traj.get("response") and not any(traj.get("usage", {}).values()) for traj in trajs):
+            return
+        with self.lock:
+            connection = self.get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, trajs) VALUES (?, ?, ?)",
+                (key, model, pickle.dumps(trajs, protocol=pickle.HIGHEST_PROTOCOL)),
+            )
+            connection.commit()
+
+
+llm_cache = None
+llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """The process-wide cache configured by LLM_CACHE_MODE and LLM_CACHE_PATH, or None if caching is off."""
+    global llm_cache
+    if LLM_CACHE_MODE == "off":
+        return None
+    with llm_cache_lock:
+        if llm_cache is None:
+            llm_cache = LLMCache(LLM_CACHE_PATH, LLM_CACHE_MODE)
+    return llm_cache
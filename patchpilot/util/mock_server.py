@@ -0,0 +1,281 @@
+"""
+OpenAI and Anthropic compatible stub server, to run the pipeline without a model API and to benchmark it.
+
+Run it standalone with `python patchpilot/util/mock_server.py --port 2953` and point a backend at it, or use
+`--backend mock`, which starts one inside the process unless MOCK_LLM_URL points at a running server.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_LLM_URL = os.environ.get("MOCK_LLM_URL", None)
+MOCK_LLM_LATENCY = float(os.environ.get("MOCK_LLM_LATENCY", 0))
+MOCK_LLM_LATENCY_JITTER = float(os.environ.get("MOCK_LLM_LATENCY_JITTER", 0))
+MOCK_LLM_RATE_LIMIT_RATE = float(os.environ.get("MOCK_LLM_RATE_LIMIT_RATE", 0))
+MOCK_LLM_ERROR_RATE = float(os.environ.get("MOCK_LLM_ERROR_RATE", 0))
+MOCK_LLM_RESPONSES = os.environ.get("MOCK_LLM_RESPONSES", None)
+DEFAULT_RESPONSE = "This is a mock response."
+
+
+def load_canned_responses(path):
+    """
+    Canned responses are a JSON list of {"match": regex, "response": text, "tool_calls": [{"name", "arguments"}]},
+    the first pattern found in the prompt wins. tool_calls is optional, it is only answered to requests offering tools.
+    """
+    if not path:
+        return []
+    with open(path, "r") as f:
+        return [
+            (re.compile(canned["match"]), canned.get("response", ""), canned.get("tool_calls", []))
+            for canned in json.load(f)
+        ]
+
+
+def count_tokens(text):
+    # rough estimate, the stub has no tokenizer
+    return max(1, len(text) // 4)
+
+
+def get_prompt_text(body):
+    texts = [body.get("system", "") if isinstance(body.get("system"), str) else ""]
+    if isinstance(body.get("prompt"), str):
+        texts.append(body["prompt"])
+    if isinstance(body.get("input"), str):
+        texts.append(body["input"])
+    for message in body.get("messages", []):
+        content = message.get("content", "")
+        if isinstance(content, list):
+            texts.extend(block.get("text", "") for block in content if isinstance(block, dict))
+        elif isinstance(content, str):
+            texts.append(content)
+    return "\n".join(text for text in texts if text)
+
+
+class MockLLMServer:
+    """Serves /v1/chat/completions, /v1/completions, /v1/responses and /v1/messages from a background thread."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=MOCK_LLM_LATENCY,
+        latency_jitter=MOCK_LLM_LATENCY_JITTER,
+        rate_limit_rate=MOCK_LLM_RATE_LIMIT_RATE,
+        error_rate=MOCK_LLM_ERROR_RATE,
+        canned_responses=None,
+        default_response=DEFAULT_RESPONSE,
+    ):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.canned_responses = canned_responses or []
+        self.default_response = default_response
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def get_response(self, prompt):
+        """The text and tool calls answered to a prompt."""
+        for pattern, response, tool_calls in self.canned_responses:
+            if pattern.search(prompt):
+                return response, tool_calls
+        return self.default_response, []
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with server.lock:
+                    server.num_requests += 1
+                if server.latency or server.latency_jitter:
+                    time.sleep(max(0.0, server.latency + random.uniform(-server.latency_jitter, server.latency_jitter)))
+                draw = random.random()
+                if draw < server.rate_limit_rate:
+                    self.send_json(
+                        429,
+                        {"type": "error", "error": {"type": "rate_limit_error", "message": "Mock rate limit"}},
+                        {"retry-after": "1"},
+                    )
+                    return
+                if draw < server.rate_limit_rate + server.error_rate:
+                    self.send_json(500, {"type": "error", "error": {"type": "api_error", "message": "Mock server error"}})
+                    return
+                prompt = get_prompt_text(body)
+                text, tool_calls = server.get_response(prompt)
+                if not body.get("tools"):
+                    tool_calls = []
+                prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(text)
+                path = self.path.rstrip("/")
+                if path.endswith("/chat/completions"):
+                    n = body.get("n", 1) or 1
+                    message = {"role": "assistant", "content": text}
+                    if tool_calls:
+                        message["tool_calls"] = [
+                            {
+                                "id": f"call_{uuid.uuid4().hex}",
+                                "type": "function",
+                                "function": {"name": tool_call["name"], "arguments": json.dumps(tool_call["arguments"])},
+                            }
+                            for tool_call in tool_calls
+                        ]
+                    self.send_json(200, {
+                        "id": f"chatcmpl-{uuid.uuid4().hex}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [
+                            {"index": i, "finish_reason": "tool_calls" if tool_calls else "stop", "message": message}
+                            for i in range(n)
+                        ],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens * n,
+                            "total_tokens": prompt_tokens + completion_tokens * n,
+                        },
+                    })
+                elif path.endswith("/completions"):
+                    self.send_json(200, {
+                        "id": f"cmpl-{uuid.uuid4().hex}",
+                        "object": "text_completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "mock"),
+                        "choices": [{"index": 0, "finish_reason": "stop", "text": text, "logprobs": None}],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                    })
+                elif path.endswith("/responses"):
+                    self.send_json(200, {
+                        "id": f"resp_{uuid.uuid4().hex}",
+                        "object": "response",
+                        "created_at": int(time.time()),
+                        "status": "completed",
+                        "model": body.get("model", "mock"),
+                        "output": [{
+                            "type": "message",
+                            "id": f"msg_{uuid.uuid4().hex}",
+                            "status": "completed",
+                            "role": "assistant",
+                            "content": [{"type": "output_text", "text": text, "annotations": []}],
+                        }],
+                        "parallel_tool_calls": False,
+                        "tool_choice": "auto",
+                        "tools": [],
+                        "usage": {
+                            "input_tokens": prompt_tokens,
+                            "output_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                            "input_tokens_details": {"cached_tokens": 0},
+                            "output_tokens_details": {"reasoning_tokens": 0},
+                        },
+                    })
+                elif path.endswith("/messages"):
+                    self.send_json(200, {
+                        "id": f"msg_{uuid.uuid4().hex}",
+                        "type": "message",
+                        "role": "assistant",
+                        "model": body.get("model", "mock"),
+                        "content": [{"type": "text", "text": text}] + [
+                            {
+                                "type": "tool_use",
+                                "id": f"toolu_{uuid.uuid4().hex}",
+                                "name": tool_call["name"],
+                                "input": tool_call["arguments"],
+                            }
+                            for tool_call in tool_calls
+                        ],
+                        "stop_reason": "tool_use" if tool_calls else "end_turn",
+                        "stop_sequence": None,
+                        "usage": {"input_tokens": prompt_tokens, "output_tokens": completion_tokens},
+                    })
+                else:
+                    self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mock-llm-server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+mock_server = None
+mock_server_lock = threading.Lock()
+
+
+def get_mock_server_url():
+    """URL of the server used by the mock backend, MOCK_LLM_URL or a server started in this process."""
+    global mock_server
+    if MOCK_LLM_URL:
+        return MOCK_LLM_URL
+    with mock_server_lock:
+        if mock_server is None:
+            mock_server = MockLLMServer(canned_responses=load_canned_responses(MOCK_LLM_RESPONSES)).start()
+    return mock_server.url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2953)
+    parser.add_argument("--latency", type=float, default=MOCK_LLM_LATENCY, help="Seconds to wait before answering")
+    parser.add_argument("--latency_jitter", type=float, default=MOCK_LLM_LATENCY_JITTER)
+    parser.add_argument(
+        "--rate_limit_rate", type=float, default=MOCK_LLM_RATE_LIMIT_RATE, help="Fraction of requests answered with 429"
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=MOCK_LLM_ERROR_RATE, help="Fraction of requests answered with 500"
+    )
+    parser.add_argument("--responses", type=str, default=MOCK_LLM_RESPONSES, help="JSON file with canned responses")
+    parser.add_argument("--default_response", type=str, default=DEFAULT_RESPONSE)
+    args = parser.parse_args()
+
+    server = MockLLMServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        canned_responses=load_canned_responses(args.responses),
+        default_response=args.default_response,
+    )
+    print(f"Mock LLM server listening on {server.url}")
+    server.httpd.serve_forever()
@@ -1,8 +1,41 @@
 from abc import ABC, abstractmethod
 from typing import List
+import asyncio
+import concurrent.futures
+import os
 import re
+import threading
 from patchpilot.util.api_requests import create_chatgpt_config, request_chatgpt_engine, create_anthropic_config, \
-    request_anthropic_engine, request_chatgpt_response_engine
+    request_anthropic_engine, request_chatgpt_response_engine, arequest_chatgpt_engine, arequest_anthropic_engine, \
+    arequest_chatgpt_response_engine
+from patchpilot.util.llm_cache import get_llm_cache
+from patchpilot.util.mock_server import get_mock_server_url
+
+
+# one event loop in a background thread runs the async requests of the whole process,
+# so many requests can be in flight without a thread for each of them
+event_loop = None
+event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global event_loop
+    with event_loop_lock:
+        if event_loop is None:
+            event_loop = asyncio.new_event_loop()
+            threading.Thread(target=event_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return event_loop
+
+
+def submit_coroutine(coroutine) -> concurrent.futures.Future:
+    """Schedule a coroutine, e.g. model.acodegen(...), on the shared event loop and return its future.
+    Do not wait for the future from a coroutine running on that loop."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return submit_coroutine(coroutine).result()
 
 
 class DecoderBase(ABC):
@@ -21,10 +54,47 @@ class DecoderBase(ABC):
         self.temperature = temperature
         self.max_new_tokens = max_new_tokens
 
+    def get_cache_params(self, num_samples, kwargs):
+        return {
+            "decoder": type(self).__name__,
+            "batch_size": self.batch_size,
+            "temperature": self.temperature,
+            "max_new_tokens": self.max_new_tokens,
+            "num_samples": num_samples,
+            "kwargs": kwargs,
+        }
+
+    def codegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        """Generate num_samples responses to message, answered from the LLM cache when it is enabled."""
+        cache = get_llm_cache()
+        if cache is None:
+            return self.generate(message, num_samples, **kwargs)
+        key = cache.get_key(self.name, message, self.get_cache_params(num_samples, kwargs))
+        trajs = cache.get(key)
+        if trajs is None:
+            trajs = self.generate(message, num_samples, **kwargs)
+            cache.put(key, self.name, trajs)
+        return trajs
+
+    async def acodegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        cache = get_llm_cache()
+        if cache is None:
+            return await self.agenerate(message, num_samples, **kwargs)
+        key = cache.get_key(self.name, message, self.get_cache_params(num_samples, kwargs))
+        trajs = cache.get(key)
+        if trajs is None:
+            trajs = await self.agenerate(message, num_samples, **kwargs)
+            cache.put(key, self.name, trajs)
+        return trajs
+
     @abstractmethod
-    def codegen(self, message: str, num_samples: int = 1) -> List[dict]:
+    def generate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
         pass
 
+    async def agenerate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        # decoders without native async requests block a worker thread instead of the event loop
+        return await asyncio.to_thread(self.generate, message, num_samples, **kwargs)
+
     @abstractmethod
     def is_direct_completion(self) -> bool:
         pass
@@ -36,27 +106,40 @@ class DecoderBase(ABC):
         return self.name
 
 
+EMPTY_USAGE = {
+    "completion_tokens": 0,
+    "prompt_tokens": 0,
+    "cached_prompt_tokens": 0,
+}
+
+
+def get_cached_prompt_tokens(usage, details="prompt_tokens_details") -> int:
+    """Prompt tokens answered from the prompt cache of an OpenAI compatible API, 0 if it does not report them."""
+    return getattr(getattr(usage, details, None), "cached_tokens", None) or 0
+
+
 class OpenSourceChatDecoder(DecoderBase):
+    base_url = os.environ.get("OPENSOURCE_BASE_URL", "http://0.0.0.0:2952/v1")
+    api_key = os.environ.get("OPENSOURCE_API_KEY", "sk1")
+    # vLLM and SGLang serve several samples in one request with n
+    supports_n = os.environ.get("OPENSOURCE_SUPPORTS_N", "1") == "1"
+
     def __init__(self, name, logger, batch_size=1, temperature=0.8, max_new_tokens=1024):
         super().__init__(name, logger, batch_size, temperature, max_new_tokens)
 
-    def codegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
-        if self.temperature == 0:
-            assert num_samples == 1
-        trajs = []
-        for _ in range(num_samples):
-            config = create_chatgpt_config(
-                message=message,
-                max_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-                batch_size=1,
-                model=self.name,
-                **kwargs,
-            )
-            ret = request_chatgpt_engine(
-                config, self.logger, base_url="http://0.0.0.0:2952/v1", api_key="sk1"
-            )
-            content = ret.choices[0].message.content
+    def create_config(self, message, batch_size=1, **kwargs):
+        return create_chatgpt_config(
+            message=message,
+            max_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            batch_size=batch_size,
+            model=self.name,
+            **kwargs,
+        )
+
+    def parse_response(self, ret, index=0, with_usage=True) -> dict:
+        if ret:
+            content = ret.choices[index].message.content
             reasoning_content_match = re.search(r"<think>(.*?)</think>", content, re.DOTALL)
 
             if reasoning_content_match:
@@ -64,45 +147,69 @@ class OpenSourceChatDecoder(DecoderBase):
             else:
                 reasoning_content = ""
 
-            if ret:
-                trajs.append(
-                    {
-                        "response": content,
-                        "reasoning_content": reasoning_content,
-                        "usage": {
-                            "completion_tokens": ret.usage.completion_tokens,
-                            "prompt_tokens": ret.usage.prompt_tokens,
-                        },
-                    }
-                )
-            else:
-                trajs.append(
-                    {
-                        "response": "",
-                        "reasoning_content": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                )
-
-        return trajs
-
+            return {
+                "response": content,
+                "reasoning_content": reasoning_content,
+                "usage": {
+                    "completion_tokens": ret.usage.completion_tokens,
+                    "prompt_tokens": ret.usage.prompt_tokens,
+                    "cached_prompt_tokens": get_cached_prompt_tokens(ret.usage),
+                } if with_usage else dict(EMPTY_USAGE),
+            }
+        return {
+            "response": "",
+            "reasoning_content": "",
+            "usage": dict(EMPTY_USAGE),
+        }
+
+    def parse_choices(self, ret, num_samples) -> List[dict]:
+        if not ret:
+            return [self.parse_response(ret) for _ in range(num_samples)]
+        # the usage of a request with n samples covers all of them, it is counted on the first one
+        return [self.parse_response(ret, index, index == 0) for index in range(len(ret.choices))]
+
+    def use_n(self, config, num_samples):
+        # create_chatgpt_config leaves out n for the reasoning models
+        return num_samples == 1 or (self.supports_n and "n" in config)
+
+    def generate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        config = self.create_config(message, num_samples, **kwargs)
+        if not self.use_n(config, num_samples):
+            # the samples are requested concurrently on the shared event loop
+            return run_coroutine(self.agenerate(message, num_samples, **kwargs))
+        ret = request_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+        return self.parse_choices(ret, num_samples)
+
+    async def agenerate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        config = self.create_config(message, num_samples, **kwargs)
+        if self.use_n(config, num_samples):
+            ret = await arequest_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+            return self.parse_choices(ret, num_samples)
+        config = self.create_config(message, 1, **kwargs)
+        rets = await asyncio.gather(*(
+            arequest_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+            for _ in range(num_samples)
+        ))
+        return [self.parse_response(ret) for ret in rets]
 
     def is_direct_completion(self) -> bool:
         return False
 
 
 class OpenAIChatDecoder(DecoderBase):
+    # None uses the OpenAI API, subclasses point the same protocol at other servers
+    base_url = None
+    api_key = None
+
     def __init__(self, name: str, logger, **kwargs) -> None:
         super().__init__(name, logger, **kwargs)
 
-    def codegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
-        if self.temperature == 0:
-            assert num_samples == 1
-        batch_size = min(self.batch_size, num_samples)
-        config = create_chatgpt_config(
+    def create_config(self, message, batch_size, **kwargs):
+        return create_chatgpt_config(
             message=message,
             max_tokens=self.max_new_tokens,
             temperature=self.temperature,
@@ -110,166 +217,203 @@ class OpenAIChatDecoder(DecoderBase):
             model=self.name,
             **kwargs,
         )
+
+    def get_request_mode(self):
         if 'o1' in self.name or 'o3-mini' in self.name:  # o1 doesn't support sampling multiple completions
-            responses = []
+            return "single_sample"
+        elif 'o3' in self.name or 'o4' in self.name:
+            return "responses"
+        return "chat"
+
+    @staticmethod
+    def parse_single_sample_response(ret) -> dict:
+        tool_calls_one_sample = None
+        if hasattr(ret.choices[0].message, 'tool_calls'):
+            tool_calls_one_sample = ret.choices[0].message.tool_calls
+        if ret:
+            return {
+                "response": ret.choices[0].message.content,
+                "tool_call": tool_calls_one_sample,
+                "usage": {
+                    "completion_tokens": ret.usage.completion_tokens,
+                    "prompt_tokens": ret.usage.prompt_tokens,
+                    "cached_prompt_tokens": get_cached_prompt_tokens(ret.usage),
+                },
+            }
+        return {
+            "response": "",
+            "tool_call": None,
+            "usage": dict(EMPTY_USAGE),
+        }
+
+    @staticmethod
+    def parse_responses_api_response(ret) -> dict:
+        if ret:
+            return {
+                "response": ret.output_text,
+                "tool_call": None,
+                "usage": {
+                    "completion_tokens": ret.usage.output_tokens,
+                    "prompt_tokens": ret.usage.input_tokens,
+                    "cached_prompt_tokens": get_cached_prompt_tokens(ret.usage, "input_tokens_details"),
+                },
+            }
+        return {
+            "response": "",
+            "tool_call": None,
+            "usage": dict(EMPTY_USAGE),
+        }
+
+    @staticmethod
+    def parse_chat_response(ret) -> List[dict]:
+        if ret:
+            responses = [choice.message.content for choice in ret.choices]
             all_tool_calls = []
-            for _ in range(batch_size):
-                ret = request_chatgpt_engine(config, self.logger)
-                tool_calls_one_sample = None
-                if hasattr(ret.choices[0].message, 'tool_calls'):
+            for choice in ret.choices:
+                if hasattr(choice.message, 'tool_calls'):
                     tool_calls_one_sample = ret.choices[0].message.tool_calls
-                if ret:
-                    response=ret.choices[0].message.content
-                    completion_tokens = ret.usage.completion_tokens
-                    prompt_tokens = ret.usage.prompt_tokens
-                    respose_block = {
-                        "response": response,
-                        "tool_call": tool_calls_one_sample,
-                        "usage": {
-                            "completion_tokens": completion_tokens,
-                            "prompt_tokens": prompt_tokens,
-                        },
-                    }
-                else:
-                    respose_block = {
-                        "response": "",
-                        "tool_call": None,
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                responses.append(respose_block)
-            trajs = [responses[0]]
-            for response_block in responses[1:]:
-                trajs.append(response_block)
-            return trajs
-        elif 'o3' in self.name or 'o4' in self.name:
-            responses = []
-            for _ in range(batch_size):
-                ret = request_chatgpt_response_engine(config, self.logger)
-                tool_calls_one_sample = None
-                if ret:
-                    response=ret.output_text
-                    completion_tokens = ret.usage.output_tokens
-                    prompt_tokens = ret.usage.input_tokens
-                    respose_block = {
-                        "response": response,
-                        "tool_call": tool_calls_one_sample,
-                        "usage": {
-                            "completion_tokens": completion_tokens,
-                            "prompt_tokens": prompt_tokens,
-                        },
-                    }
+                    all_tool_calls.append(tool_calls_one_sample)
                 else:
-                    respose_block = {
-                        "response": "",
-                        "tool_call": None,
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                responses.append(respose_block)
-            trajs = [responses[0]]
-            for response_block in responses[1:]:
-                trajs.append(response_block)
-            return trajs
+                    all_tool_calls.append(None)
+            completion_tokens = ret.usage.completion_tokens
+            prompt_tokens = ret.usage.prompt_tokens
+            cached_prompt_tokens = get_cached_prompt_tokens(ret.usage)
         else:
-            ret = request_chatgpt_engine(config, self.logger)
-            if ret:
-                responses = [choice.message.content for choice in ret.choices]
-                all_tool_calls = []
-                for choice in ret.choices:
-                    if hasattr(choice.message, 'tool_calls'):
-                        tool_calls_one_sample = ret.choices[0].message.tool_calls
-                        all_tool_calls.append(tool_calls_one_sample)
-                    else:
-                        all_tool_calls.append(None)
-                completion_tokens = ret.usage.completion_tokens
-                prompt_tokens = ret.usage.prompt_tokens
-            else:
-                responses = [""]
-                all_tool_calls = [None]
-                completion_tokens = 0
-                prompt_tokens = 0
-
-            # The nice thing is, when we generate multiple samples from the same input (message),
-            # the input tokens are only charged once according to openai API.
-            # Therefore, we assume the request cost is only counted for the first sample.
-            # More specifically, the `prompt_tokens` is for one input message,
-            # and the `completion_tokens` is the sum of all returned completions.
-            # Therefore, for the second and later samples, the cost is zero.
-            trajs = [
+            responses = [""]
+            all_tool_calls = [None]
+            completion_tokens = 0
+            prompt_tokens = 0
+            cached_prompt_tokens = 0
+
+        # The nice thing is, when we generate multiple samples from the same input (message),
+        # the input tokens are only charged once according to openai API.
+        # Therefore, we assume the request cost is only counted for the first sample.
+        # More specifically, the `prompt_tokens` is for one input message,
+        # and the `completion_tokens` is the sum of all returned completions.
+        # Therefore, for the second and later samples, the cost is zero.
+        trajs = [
+            {
+                "response": responses[0],
+                "tool_call": all_tool_calls[0],
+                "usage": {
+                    "completion_tokens": completion_tokens,
+                    "prompt_tokens": prompt_tokens,
+                    "cached_prompt_tokens": cached_prompt_tokens,
+                },
+            }
+        ]
+        for index in range(1, len(responses)):
+            trajs.append(
                 {
-                    "response": responses[0],
-                    "tool_call": all_tool_calls[0],
-                    "usage": {
-                        "completion_tokens": completion_tokens,
-                        "prompt_tokens": prompt_tokens,
-                    },
+                    "response": responses[index],
+                    "tool_call": all_tool_calls[index],
+                    "usage": dict(EMPTY_USAGE),
                 }
-            ]
-            for index in range(1, len(responses)):
-                trajs.append(
-                    {
-                        "response": responses[index],
-                        "tool_call": all_tool_calls[index],
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                )
-            return trajs
+            )
+        return trajs
+
+    def generate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        batch_size = min(self.batch_size, num_samples)
+        if self.get_request_mode() != "chat" and batch_size > 1:
+            # these models have no n, the samples are requested concurrently on the shared event loop
+            return run_coroutine(self.agenerate(message, num_samples, **kwargs))
+        config = self.create_config(message, batch_size, **kwargs)
+        request_mode = self.get_request_mode()
+        if request_mode == "single_sample":
+            ret = request_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+            return [self.parse_single_sample_response(ret)]
+        elif request_mode == "responses":
+            ret = request_chatgpt_response_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+            return [self.parse_responses_api_response(ret)]
+        ret = request_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+        return self.parse_chat_response(ret)
+
+    async def agenerate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        batch_size = min(self.batch_size, num_samples)
+        config = self.create_config(message, batch_size, **kwargs)
+        request_mode = self.get_request_mode()
+        if request_mode == "single_sample":
+            rets = await asyncio.gather(*(
+                arequest_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+                for _ in range(batch_size)
+            ))
+            return [self.parse_single_sample_response(ret) for ret in rets]
+        elif request_mode == "responses":
+            rets = await asyncio.gather(*(
+                arequest_chatgpt_response_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+                for _ in range(batch_size)
+            ))
+            return [self.parse_responses_api_response(ret) for ret in rets]
+        ret = await arequest_chatgpt_engine(config, self.logger, base_url=self.base_url, api_key=self.api_key)
+        return self.parse_chat_response(ret)
 
     def is_direct_completion(self) -> bool:
         return False
 
 
+class MockChatDecoder(OpenAIChatDecoder):
+    """OpenAI decoder talking to the stub server of patchpilot/util/mock_server.py."""
+
+    def __init__(self, name: str, logger, **kwargs) -> None:
+        super().__init__(name, logger, **kwargs)
+        self.base_url = get_mock_server_url()
+        self.api_key = "mock"
+
+
 class DeepSeekChatDecoder(DecoderBase):
+    base_url = "https://api.deepseek.com"
+
     def __init__(self, name: str, logger, **kwargs) -> None:
         super().__init__(name, logger, **kwargs)
 
-    def codegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+    def create_config(self, message, **kwargs):
+        return create_chatgpt_config(
+            message=message,
+            max_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            batch_size=1,
+            model=self.name,
+            **kwargs,
+        )
+
+    @staticmethod
+    def parse_response(ret) -> dict:
+        if ret:
+            return {
+                "response": ret.choices[0].message.content,
+                "reasoning_content": ret.choices[0].message.model_extra["reasoning_content"],
+                "usage": {
+                    "completion_tokens": ret.usage.completion_tokens,
+                    "prompt_tokens": ret.usage.prompt_tokens,
+                    "cached_prompt_tokens": get_cached_prompt_tokens(ret.usage),
+                },
+            }
+        return {
+            "response": "",
+            "usage": dict(EMPTY_USAGE),
+        }
+
+    def generate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
         if self.temperature == 0:
             assert num_samples == 1
-        trajs = []
-        for _ in range(num_samples):
-            config = create_chatgpt_config(
-                message=message,
-                max_tokens=self.max_new_tokens,
-                temperature=self.temperature,
-                batch_size=1,
-                model=self.name,
-                **kwargs,
-            )
-            ret = request_chatgpt_engine(
-                config, self.logger, base_url="https://api.deepseek.com"
-            )
-            if ret:
-                trajs.append(
-                    {
-                        "response": ret.choices[0].message.content,
-                        "reasoning_content": ret.choices[0].message.model_extra["reasoning_content"],
-                        "usage": {
-                            "completion_tokens": ret.usage.completion_tokens,
-                            "prompt_tokens": ret.usage.prompt_tokens,
-                        },
-                    }
-                )
-            else:
-                trajs.append(
-                    {
-                        "response": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                )
+        if num_samples > 1:
+            # the samples are requested concurrently on the shared event loop
+            return run_coroutine(self.agenerate(message, num_samples, **kwargs))
+        ret = request_chatgpt_engine(self.create_config(message, **kwargs), self.logger, base_url=self.base_url)
+        return [self.parse_response(ret)]
 
-        return trajs
+    async def agenerate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        config = self.create_config(message, **kwargs)
+        rets = await asyncio.gather(*(
+            arequest_chatgpt_engine(config, self.logger, base_url=self.base_url) for _ in range(num_samples)
+        ))
+        return [self.parse_response(ret) for ret in rets]
 
     def is_direct_completion(self) -> bool:
         return False
@@ -279,10 +423,7 @@ class ClaudeChatDecoder(DecoderBase):
     def __init__(self, name: str, logger, **kwargs) -> None:
         super().__init__(name, logger, **kwargs)
 
-    def codegen(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
-        if self.temperature == 0:
-            assert num_samples == 1
-        batch_size = min(self.batch_size, num_samples)
+    def create_config(self, message, batch_size, **kwargs):
         config = create_anthropic_config(
             message=message,
             max_tokens=self.max_new_tokens,
@@ -300,72 +441,60 @@ class ClaudeChatDecoder(DecoderBase):
             }
             config["thinking"] = thinking
             config["temperature"] = 1
+        return config
+
+    @staticmethod
+    def parse_response(ret, reasoning_mode) -> dict:
+        response = ""
+        thinking = ""
+        usage = dict(EMPTY_USAGE, cache_creation_prompt_tokens=0)
+        if ret:
+            for choice in ret.content:
+                if choice.type == "thinking":
+                    thinking = choice.thinking
+                elif choice.type == "text":
+                    response = choice.text
+            cache_read_tokens = getattr(ret.usage, "cache_read_input_tokens", None) or 0
+            cache_creation_tokens = getattr(ret.usage, "cache_creation_input_tokens", None) or 0
+            usage = {
+                "completion_tokens": ret.usage.output_tokens,
+                # input_tokens only counts the prompt after the last cache breakpoint, the cached part is reported apart
+                "prompt_tokens": ret.usage.input_tokens,
+                "cached_prompt_tokens": cache_read_tokens,
+                "cache_creation_prompt_tokens": cache_creation_tokens,
+            }
+        if reasoning_mode:
+            return {
+                "response": response,
+                "reasoning_content": thinking,
+                "usage": usage,
+            }
+        return {
+            "response": response,
+            "usage": usage,
+        }
 
-            responses = []
-            for _ in range(batch_size):
-                ret = request_anthropic_engine(config, self.logger)
-                if ret:
-                    for choice in ret.content:
-                        if choice.type == "thinking":
-                            thinking = choice.thinking
-                        elif choice.type == "text":
-                            response = choice.text
-                    completion_tokens = ret.usage.output_tokens
-                    prompt_tokens = ret.usage.input_tokens
-
-                    respose_block = {
-                        "response": response,
-                        "reasoning_content": thinking,
-                        "usage": {
-                            "completion_tokens": completion_tokens,
-                            "prompt_tokens": prompt_tokens,
-                        },
-                    }
-                else:
-                    respose_block = {
-                        "response":"",
-                        "reasoning_content": "",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                responses.append(respose_block)
-            trajs = [responses[0]]
-            for response_block in responses[1:]:
-                trajs.append(response_block)
-            return trajs
+    def generate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        batch_size = min(self.batch_size, num_samples)
+        if batch_size > 1:
+            # Anthropic has no n, the samples are requested concurrently on the shared event loop
+            return run_coroutine(self.agenerate(message, num_samples, **kwargs))
+        config = self.create_config(message, batch_size, **kwargs)
+        reasoning_mode = kwargs.get("reasoning_mode", False)
+        return [self.parse_response(request_anthropic_engine(config, self.logger), reasoning_mode)]
 
-        else:
-            responses = []
-            for _ in range(batch_size):
-                ret = request_anthropic_engine(config, self.logger)
-                if ret:
-                    for choice in ret.content:
-                        response = choice.text
-                    completion_tokens = ret.usage.output_tokens
-                    prompt_tokens = ret.usage.input_tokens
-
-                    respose_block = {
-                        "response": response,
-                        "usage": {
-                            "completion_tokens": completion_tokens,
-                            "prompt_tokens": prompt_tokens,
-                        },
-                    }
-                else:
-                    respose_block = {
-                        "response":"",
-                        "usage": {
-                            "completion_tokens": 0,
-                            "prompt_tokens": 0,
-                        },
-                    }
-                responses.append(respose_block)
-            trajs = [responses[0]]
-            for response_block in responses[1:]:
-                trajs.append(response_block)
-            return trajs
+    async def agenerate(self, message: str, num_samples: int = 1, **kwargs) -> List[dict]:
+        if self.temperature == 0:
+            assert num_samples == 1
+        batch_size = min(self.batch_size, num_samples)
+        config = self.create_config(message, batch_size, **kwargs)
+        reasoning_mode = kwargs.get("reasoning_mode", False)
+        # the first sample writes the prompt cache, the others are only sent once it is written so that they read it
+        rets = [await arequest_anthropic_engine(config, self.logger)]
+        rets += await asyncio.gather(*(arequest_anthropic_engine(config, self.logger) for _ in range(batch_size - 1)))
+        return [self.parse_response(ret, reasoning_mode) for ret in rets]
 
     def is_direct_completion(self) -> bool:
         return False
@@ -407,6 +536,15 @@ def make_model(
             temperature=temperature,
             **kwargs
         )
+    elif backend == "mock":
+        return MockChatDecoder(
+            name=model,
+            logger=logger,
+            batch_size=batch_size,
+            max_new_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs
+        )
     elif backend == "opensource":
         return OpenSourceChatDecoder(
             name=model,
@@ -1,14 +1,27 @@
 import ast
 import copy
+import hashlib
+import io
 import os
 import re
 import subprocess
+import threading
+import tokenize
 import uuid
 from collections import OrderedDict
+from difflib import SequenceMatcher
+
+from pyflakes.checker import Checker
 
 from patchpilot.util.preprocess_data import get_repo_files
-from get_repo_structure.get_patch_info import parse_patch 
-from get_repo_structure.get_repo_structure import clone_repo, checkout_commit, apply_patch, repo_to_top_folder   
+from get_repo_structure.get_patch_info import apply_hunks, parse_patch, split_patch_by_file
+from get_repo_structure.get_repo_structure import (
+    apply_patch,
+    checkout_commit,
+    clone_repo,
+    read_files_at_commit,
+    repo_to_top_folder,
+)
 
 
 def check_syntax(code):
@@ -48,54 +61,125 @@ def check_code_differ_by_just_empty_lines(codes, prev_codes) -> bool:
     return normalized_code1 == normalized_code2
 
 
-def lint_code(repo_playground, temp_name, code, prev_code="") -> tuple[bool, set, set]:
+# pyflakes messages of the fatal flake8 codes, lint_code only reports these and E9 (syntax errors)
+FATAL_PYFLAKES_CODES = {
+    "UndefinedName": "F821",
+    "UndefinedLocal": "F823",
+    "DuplicateArgument": "F831",
+    "ImportStarNotPermitted": "F406",
+    "FutureFeatureNotDefined": "F407",
+    "BreakOutsideLoop": "F701",
+    "ContinueOutsideLoop": "F702",
+    "YieldOutsideFunction": "F704",
+    "ReturnOutsideFunction": "F706",
+}
+# the same as flake8
+NOQA_INLINE_REGEX = re.compile(r"# noqa(?::[\s]?(?P<codes>([A-Z]+[0-9]+(?:[,\s]+)?)+))?", re.IGNORECASE)
+NOQA_FILE_REGEX = re.compile(r"\s*# flake8[:=]\s*noqa", re.IGNORECASE)
+
+# lint errors keyed by the hash of the code, the previous content of a file is linted again for every candidate and retry
+LINT_CACHE_SIZE = int(os.environ.get("LINT_CACHE_SIZE", 4096))
+lint_cache = OrderedDict()
+lint_cache_lock = threading.Lock()
+
+
+def get_noqa_lines(tokens, lines):
+    # like flake8, a noqa comment applies to every line of a token spanning several lines, e.g. a multi-line string
+    noqa_lines = dict()
+    min_line, max_line = len(lines) + 2, -1
+    for token in tokens:
+        if token.type in (tokenize.ENDMARKER, tokenize.DEDENT):
+            continue
+        min_line = min(min_line, token.start[0])
+        max_line = max(max_line, token.end[0])
+        if token.type in (tokenize.NL, tokenize.NEWLINE):
+            joined = "".join(lines[min_line - 1: max_line])
+            for line_number in range(min_line, max_line + 1):
+                noqa_lines[line_number] = joined
+            min_line, max_line = len(lines) + 2, -1
+    return noqa_lines
+
+
+def is_noqa(error, noqa_line):
+    match = NOQA_INLINE_REGEX.search(noqa_line)
+    if match is None:
+        return False
+    if match.group("codes") is None:
+        return True
+    codes = tuple(code for code in re.split(r"[,\s]", match.group("codes")) if code)
+    return error.split(" ", 1)[0].startswith(codes)
 
-    # Generate a temperary folder and add uuid to avoid collision
-    repo_playground = os.path.join(repo_playground, str(uuid.uuid4()))
 
-    # assert playground doesn't exist
-    assert not os.path.exists(repo_playground), f"{repo_playground} already exists"
-
-    # create playground
-    os.makedirs(repo_playground)
+def get_lint_errors(code) -> set:
+    """
+    Check the code for the fatal flake8 errors in-process with pyflakes.
 
-    with open(f"{repo_playground}/{temp_name}", "w") as f:
-        f.write(prev_code)
+    Arguments:
+    code: A string with the code to check.
 
-    # lint the code
-    # check for fatal errors
-    fatal = "E9,F821,F823,F831,F406,F407,F701,F702,F704,F706"
-    o = subprocess.run(
-        f"flake8 --select={fatal} --isolated {repo_playground}/{temp_name}",
-        shell=True,
-        capture_output=True,
-    )
-    s = o.stdout.decode("utf-8")
+    Returns:
+    errors: A set of error messages, formatted like flake8 without the file name, line and column, e.g. "F821 undefined name 'x'".
+    """
+    # the lines as flake8 reads them from the file
+    lines = io.StringIO(code.removeprefix("\ufeff"), newline=None).readlines()
+    if any(NOQA_FILE_REGEX.match(line) for line in lines):
+        return set()
+    source = "".join(lines)
 
-    prev_errors = set()
-    if s != "":
-        for error in s.split(f"{repo_playground}/{temp_name}:")[1:]:
-            num_free_error = ":".join(error.split(":")[2:]).strip()
-            prev_errors.add(num_free_error)
+    tokens, token_error = [], None
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (tokenize.TokenError, SyntaxError) as e:
+        token_error = e
 
-    with open(f"{repo_playground}/{temp_name}", "w") as f:
-        f.write(code)
+    errors = []
+    try:
+        tree = ast.parse(source)
+    except SyntaxError as e:
+        token_error = e
+    else:
+        for message in Checker(tree, withDoctest=False).messages:
+            error_code = FATAL_PYFLAKES_CODES.get(type(message).__name__)
+            if error_code is not None:
+                errors.append((message.lineno, f"{error_code} {message.message % message.message_args}"))
+    if token_error is not None:
+        error_code = "E902" if isinstance(token_error, tokenize.TokenError) else "E999"
+        line_number = 1
+        if len(token_error.args) > 1 and token_error.args[1]:
+            # (filename, line, column, ...) for syntax errors and (line, column) for token errors
+            line_number = token_error.args[1][1] if len(token_error.args[1]) > 2 else token_error.args[1][0]
+        errors.append((line_number, f"{error_code} {type(token_error).__name__}: {token_error.args[0]}"))
+
+    noqa_lines = get_noqa_lines(tokens, lines) if token_error is None else dict()
+    lint_errors = set()
+    for line_number, error in errors:
+        noqa_line = noqa_lines.get(line_number)
+        if noqa_line is None:
+            noqa_line = lines[line_number - 1] if 0 < line_number <= len(lines) else ""
+        if not is_noqa(error, noqa_line):
+            lint_errors.add(error)
+    return lint_errors
+
+
+def get_cached_lint_errors(code) -> set:
+    key = hashlib.sha256(code.encode("utf-8", errors="surrogatepass")).hexdigest()
+    with lint_cache_lock:
+        if key in lint_cache:
+            lint_cache.move_to_end(key)
+            return set(lint_cache[key])
+    errors = get_lint_errors(code)
+    with lint_cache_lock:
+        lint_cache[key] = frozenset(errors)
+        while len(lint_cache) > LINT_CACHE_SIZE:
+            lint_cache.popitem(last=False)
+    return errors
 
-    o = subprocess.run(
-        f"flake8 --select={fatal} --isolated {repo_playground}/{temp_name}",
-        shell=True,
-        capture_output=True,
-    )
-    s = o.stdout.decode("utf-8")
 
-    # remove playground
-    subprocess.run(f"rm -rf {repo_playground}", shell=True)
+def lint_code(repo_playground, temp_name, code, prev_code="") -> tuple[bool, set, set]:
 
-    errors = set()
-    if s != "":
-        for error in s.split(f"{repo_playground}/{temp_name}:")[1:]:
-            num_free_error = ":".join(error.split(":")[2:]).strip()
-            errors.add(num_free_error)
+    # only the errors the code introduces count, the previous content is usually the same for many calls
+    prev_errors = get_cached_lint_errors(prev_code)
+    errors = get_cached_lint_errors(code)
 
     if len(errors - prev_errors) > 0:
         return False, prev_errors, errors
@@ -103,8 +187,280 @@ def lint_code(repo_playground, temp_name, code, prev_code="") -> tuple[bool, set
     return True, set(), set()
 
 
+def split_file_lines(content):
+    """Split a file into lines that keep their newline, the last line has none if the file doesn't end with one."""
+    lines = content.split("\n")
+    last_line = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last_line:
+        lines.append(last_line)
+    return lines
+
+
+def get_blob_id(content):
+    """The object id git gives to a file with this content."""
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def get_diff_opcodes(old_lines, new_lines):
+    # the edits are local, only the lines between the common prefix and suffix are matched
+    prefix = 0
+    while prefix < min(len(old_lines), len(new_lines)) and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < min(len(old_lines), len(new_lines)) - prefix
+        and old_lines[len(old_lines) - suffix - 1] == new_lines[len(new_lines) - suffix - 1]
+    ):
+        suffix += 1
+    matcher = SequenceMatcher(
+        None, old_lines[prefix:len(old_lines) - suffix], new_lines[prefix:len(new_lines) - suffix], autojunk=False
+    )
+    codes = []
+    if prefix:
+        codes.append(("equal", 0, prefix, 0, prefix))
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal" and codes and codes[-1][0] == "equal":
+            codes[-1] = ("equal", codes[-1][1], prefix + i2, codes[-1][3], prefix + j2)
+        else:
+            codes.append((tag, prefix + i1, prefix + i2, prefix + j1, prefix + j2))
+    if suffix:
+        i1, j1 = len(old_lines) - suffix, len(new_lines) - suffix
+        if codes and codes[-1][0] == "equal":
+            codes[-1] = ("equal", codes[-1][1], len(old_lines), codes[-1][3], len(new_lines))
+        else:
+            codes.append(("equal", i1, len(old_lines), j1, len(new_lines)))
+    return slide_diff_opcodes(codes, old_lines, new_lines)
+
+
+def slide_diff_opcodes(codes, old_lines, new_lines):
+    # like git, an inserted or deleted block that could also be placed later is moved down as far as possible
+    codes = [list(code) for code in codes]
+    k = 0
+    while k + 1 < len(codes):
+        tag, i1, i2, j1, j2 = codes[k]
+        if tag not in ("insert", "delete") or codes[k + 1][0] != "equal":
+            k += 1
+            continue
+        lines, start, end = (new_lines, j1, j2) if tag == "insert" else (old_lines, i1, i2)
+        next_end = codes[k + 1][4] if tag == "insert" else codes[k + 1][2]
+        if k + 2 < len(codes):
+            # the block is not merged with the next change
+            next_end -= 1
+        shift = 0
+        while end + shift < next_end and lines[start + shift] == lines[end + shift]:
+            shift += 1
+        if not shift:
+            k += 1
+            continue
+        if k > 0 and codes[k - 1][0] == "equal":
+            codes[k - 1][2] += shift
+            codes[k - 1][4] += shift
+        else:
+            codes.insert(k, ["equal", i1, i1 + shift, j1, j1 + shift])
+            k += 1
+        for index in range(1, 5):
+            codes[k][index] += shift
+        codes[k + 1][1] += shift
+        codes[k + 1][3] += shift
+        if codes[k + 1][1] == codes[k + 1][2]:
+            # the block reached the end of the file
+            del codes[k + 1]
+        k += 1
+    return [tuple(code) for code in codes]
+
+
+def group_diff_opcodes(codes, context=3):
+    # same grouping as difflib, changes at most 2 * context lines apart share a hunk
+    codes = list(codes)
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def get_hunk_range(start, stop):
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    if not length:
+        # an empty range is given by the line before it
+        return f"{start},0"
+    return f"{start + 1},{length}"
+
+
+def get_hunk_func_name(old_lines, start):
+    # git's default funcname, the last line before the hunk that starts with a letter, "_" or "$", cut at 80 bytes
+    for line in reversed(old_lines[:start]):
+        if re.match(r"[A-Za-z_$]", line):
+            return line.encode("utf-8")[:80].decode("utf-8", errors="ignore").rstrip()
+    return ""
+
+
+def get_file_diff(file_path, old_content, new_content, file_mode="100644") -> str:
+    """
+    Generate the git diff of one file in memory. The diff is a valid unified diff with git's headers that `git apply`
+    accepts, but the hunks may be shaped differently from the ones of `git diff`, the lines are matched with difflib
+    instead of git's Myers algorithm.
+
+    Arguments:
+    file_path: A string with the path of the file in the repository.
+    old_content: A string with the content of the file before the change, None if the file is created.
+    new_content: A string with the content of the file after the change, None if the file is deleted.
+    file_mode: A string with the git mode of the file.
+
+    Returns:
+    diff: A string with the git diff of the file, empty if the file is not changed.
+    """
+    if old_content == new_content:
+        return ""
+    old_id = get_blob_id(old_content) if old_content is not None else "0" * 40
+    new_id = get_blob_id(new_content) if new_content is not None else "0" * 40
+    diff_lines = [f"diff --git a/{file_path} b/{file_path}"]
+    if old_content is None:
+        diff_lines += [f"new file mode {file_mode}", f"index {old_id[:7]}..{new_id[:7]}"]
+    elif new_content is None:
+        diff_lines += [f"deleted file mode {file_mode}", f"index {old_id[:7]}..{new_id[:7]}"]
+    else:
+        diff_lines.append(f"index {old_id[:7]}..{new_id[:7]} {file_mode}")
+    old_lines = split_file_lines(old_content or "")
+    new_lines = split_file_lines(new_content or "")
+    if not old_lines and not new_lines:
+        # an empty file is created or deleted, git shows no hunk
+        return "\n".join(diff_lines) + "\n"
+    diff_lines.append(f"--- a/{file_path}" if old_content is not None else "--- /dev/null")
+    diff_lines.append(f"+++ b/{file_path}" if new_content is not None else "+++ /dev/null")
+    diff = "\n".join(diff_lines) + "\n"
+    for group in group_diff_opcodes(get_diff_opcodes(old_lines, new_lines)):
+        old_range = get_hunk_range(group[0][1], group[-1][2])
+        new_range = get_hunk_range(group[0][3], group[-1][4])
+        func_name = get_hunk_func_name(old_lines, group[0][1])
+        diff += f"@@ -{old_range} +{new_range} @@" + (f" {func_name}" if func_name else "") + "\n"
+        for tag, i1, i2, j1, j2 in group:
+            hunk_lines = []
+            if tag == "equal":
+                hunk_lines += [" " + line for line in old_lines[i1:i2]]
+            if tag in ("replace", "delete"):
+                hunk_lines += ["-" + line for line in old_lines[i1:i2]]
+            if tag in ("replace", "insert"):
+                hunk_lines += ["+" + line for line in new_lines[j1:j2]]
+            for line in hunk_lines:
+                diff += line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+    return diff
+
+
+def get_git_diff(file_pathes, old_contents, new_contents, file_modes=None) -> str:
+    """
+    Generate the git diff of several files in memory, the files are ordered by path like in `git diff`.
+    See get_file_diff for how the hunks may differ from the ones of git.
+
+    Arguments:
+    file_pathes: A list of file paths.
+    old_contents: A list with the contents of the files before the change, None for created files.
+    new_contents: A list with the contents of the files after the change, None for deleted files.
+    file_modes: A list with the git modes of the files, 100644 for all files if not given.
+
+    Returns:
+    diff: A string with the git diff of the changed files.
+    """
+    if file_modes is None:
+        file_modes = ["100644"] * len(file_pathes)
+    files = dict()
+    for file_path, old_content, new_content, file_mode in zip(file_pathes, old_contents, new_contents, file_modes):
+        files[file_path] = (old_content, new_content, file_mode)
+    return "".join(get_file_diff(file_path, *files[file_path]) for file_path in sorted(files))
+
+
+def apply_file_patch(content, hunks) -> str:
+    """
+    Apply the hunks of one file to its content in memory, like `git apply`.
+
+    Arguments:
+    content: A string with the content of the file.
+    hunks: A list of hunks of the file returned by split_patch_by_file.
+
+    Returns:
+    new_content: A string with the patched content.
+    """
+    lines = content.split("\n")
+    if content.endswith("\n") or not content:
+        lines.pop()
+    ends_with_newline = content.endswith("\n")
+    new_lines = apply_hunks(lines, hunks)
+    if hunks:
+        last_hunk = hunks[-1]
+        last_hunk_end = last_hunk["old_start"] - (1 if last_hunk["old_lines"] else 0) + len(last_hunk["old_lines"])
+        # the newline at the end of the file is only changed by a hunk that reaches the end
+        if last_hunk["old_no_newline"] or last_hunk["new_no_newline"] or last_hunk_end >= len(lines):
+            ends_with_newline = not last_hunk["new_no_newline"]
+    if not new_lines:
+        return ""
+    return "\n".join(new_lines) + ("\n" if ends_with_newline else "")
+
+
 def get_diff_real_git_repo(repo_path, file_to_contents, repo_name, commit_id, base_patch_diff='') -> str:
-    """create a fake git repo to obtain git diff format"""
+    """obtain the git diff of the base patch and file_to_contents against the commit, in memory from the files in the local mirror"""
+
+    file_patches = []
+    if base_patch_diff:
+        try:
+            file_patches = split_patch_by_file(base_patch_diff)
+        except ValueError as e:
+            print(f"Base patch can not be applied in memory, diffing in a checkout: {e}")
+            return get_diff_git_checkout(repo_path, file_to_contents, repo_name, commit_id, base_patch_diff)
+
+    file_pathes = set(file_to_contents)
+    for file_patch in file_patches:
+        file_pathes.update(path for path in (file_patch["old_file"], file_patch["new_file"]) if path is not None)
+    orig_files = read_files_at_commit(repo_name, commit_id, sorted(file_pathes))
+    if orig_files is None:
+        return get_diff_git_checkout(repo_path, file_to_contents, repo_name, commit_id, base_patch_diff)
+
+    contents = {file_path: content for file_path, (_, content) in orig_files.items()}
+    try:
+        for file_patch in file_patches:
+            old_file, new_file = file_patch["old_file"], file_patch["new_file"]
+            old_content = ""
+            if old_file is not None:
+                if old_file not in contents:
+                    raise ValueError(f"{old_file} does not exist at {commit_id}")
+                old_content = contents.pop(old_file)
+            new_content = apply_file_patch(old_content, file_patch["hunks"])
+            if new_file is not None:
+                contents[new_file] = new_content
+    except ValueError as e:
+        # like git apply, a base patch that does not apply changes nothing
+        print(f"An error occurred while applying the base patch: {e}")
+        contents = {file_path: content for file_path, (_, content) in orig_files.items()}
+
+    for file_name, content in file_to_contents.items():
+        contents[file_name] = content
+
+    # like git diff in a checkout, files created by the base patch are untracked and not part of the diff
+    tracked_files = sorted(orig_files)
+    return get_git_diff(
+        tracked_files,
+        [orig_files[file_path][1] for file_path in tracked_files],
+        [contents.get(file_path) for file_path in tracked_files],
+        [orig_files[file_path][0] for file_path in tracked_files],
+    )
+
+
+def get_diff_git_checkout(repo_path, file_to_contents, repo_name, commit_id, base_patch_diff='') -> str:
+    """check out the repo to obtain git diff format, used when the local mirror is not available"""
 
     # Generate a temperary folder and add uuid to avoid collision
     repo_playground = os.path.join(repo_path, str(uuid.uuid4()))
@@ -115,7 +471,7 @@ def get_diff_real_git_repo(repo_path, file_to_contents, repo_name, commit_id, ba
     # create playground
     os.makedirs(repo_playground)
 
-    clone_repo(repo_name, repo_playground)
+    clone_repo(repo_name, repo_playground, commit_id)
     checkout_commit(f"{repo_playground}/{repo_to_top_folder[repo_name]}", commit_id)
     # apply base_patch_diff
     if base_patch_diff:
@@ -140,7 +496,7 @@ def get_diff_real_git_repo(repo_path, file_to_contents, repo_name, commit_id, ba
 
 
 def fake_git_repo(repo_playground, file_pathes, old_contents, new_contents) -> str:
-    """create a fake git repo to obtain git diff format"""
+    """obtain git diff format of the changed files, in memory without a git playground"""
 
     if not isinstance(file_pathes, list):
         # for backwards compatibility
@@ -148,122 +504,21 @@ def fake_git_repo(repo_playground, file_pathes, old_contents, new_contents) -> s
         old_contents = [old_contents]
         new_contents = [new_contents]
 
-    # Generate a temperary folder and add uuid to avoid collision
-    repo_playground = os.path.join(repo_playground, str(uuid.uuid4()))
-
-    # assert playground doesn't exist
-    assert not os.path.exists(repo_playground), f"{repo_playground} already exists"
-
-    # create playground
-    os.makedirs(repo_playground)
-
-    # create a fake git repo
-    subprocess.run(f"cd {repo_playground} && git init", shell=True)
-
-    for file_path, old_content, new_content in zip(
-        file_pathes, old_contents, new_contents
-    ):
-        # create a file
-        subprocess.run(
-            f"mkdir -p {repo_playground}/{os.path.dirname(file_path)}", shell=True
-        )
-
-        with open(f"{repo_playground}/{file_path}", "w") as f:
-            f.write(old_content)
-
-        # add file to git
-        # same message is okay
-        subprocess.run(
-            f"cd {repo_playground} && git add {file_path} && git commit -m 'initial commit'",
-            shell=True,
-        )
-
-    for file_path, old_content, new_content in zip(
-        file_pathes, old_contents, new_contents
-    ):
-        # edit file
-        with open(f"{repo_playground}/{file_path}", "w") as f:
-            f.write(new_content)
-
-    # get git diff
-    o = subprocess.run(
-        f"cd {repo_playground} && git diff .", shell=True, capture_output=True
-    )
-
-    s = o.stdout.decode("utf-8")
-
-    # remove playground
-    subprocess.run(f"rm -rf {repo_playground}", shell=True)
-
-    return s
+    return get_git_diff(file_pathes, old_contents, new_contents)
 
 
 def fake_git_apply(repo_playground, file_path, old_content, patch) -> str:
-    """create a fake git repo to obtain new file content"""
+    """obtain the new file content by applying the patch in memory, without a git playground"""
 
-    # Generate a temperary folder and add uuid to avoid collision
-    repo_playground = os.path.join(repo_playground, str(uuid.uuid4()))
-
-    # assert playground doesn't exist
-    assert not os.path.exists(repo_playground), f"{repo_playground} already exists"
-
-    # create playground
-    os.makedirs(repo_playground)
-
-    # create a fake git repo
-    subprocess.run(f"cd {repo_playground} && git init", shell=True)
-
-    # create a file
-    subprocess.run(
-        f"mkdir -p {repo_playground}/{os.path.dirname(file_path)}", shell=True
-    )
-
-    with open(f"{repo_playground}/{file_path}", "w") as f:
-        f.write(old_content)
-
-    # add file to git
-    subprocess.run(
-        f"cd {repo_playground} && git add {file_path} && git commit -m 'initial commit'",
-        shell=True,
-    )
-
-    # apply patch file
-    patch_file = f"{str(uuid.uuid4())}.patch"
-    with open(f"{repo_playground}/{patch_file}", "w") as f:
-        f.write(patch)
-    o = subprocess.run(
-        f"cd {repo_playground} && git apply --whitespace=nowarn {patch_file}",
-        shell=True,
-        capture_output=True,
-    )
-    if o.stderr.decode("utf-8"):
-        print("stderr> ", o.stderr.decode("utf-8"))
-        # TODO: This rarely happen but the patch should be valid, needs to look into it
-
-        with open(f"{repo_playground}/{file_path}", "w") as f:
-            f.write(old_content + "\n")
-
-        o = subprocess.run(
-            f"cd {repo_playground} && git apply --whitespace=nowarn {patch_file}",
-            shell=True,
-            capture_output=True,
-        )
-
-        if o.stderr.decode("utf-8"):
-            print("stderr> ", o.stderr.decode("utf-8"))
-            assert False, "shouldn't happen"
-
-    # get git diff
-    o = subprocess.run(
-        f"cd {repo_playground} && cat {file_path}", shell=True, capture_output=True
-    )
-
-    s = o.stdout.decode("utf-8")
-
-    # remove playground
-    subprocess.run(f"rm -rf {repo_playground}", shell=True)
-
-    return s
+    try:
+        hunks = []
+        for file_patch in split_patch_by_file(patch):
+            if file_path in (file_patch["old_file"], file_patch["new_file"]):
+                hunks.extend(file_patch["hunks"])
+        return apply_file_patch(old_content, hunks)
+    except ValueError as e:
+        print("stderr> ", e)
+        assert False, "shouldn't happen"
 
 
 def get_functions(tree):
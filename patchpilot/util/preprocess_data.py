@@ -1,9 +1,12 @@
+import ast
 import json
 import os
 import re
+from bisect import bisect_right
 from collections import defaultdict
 
 from patchpilot.util.parse_global_var import parse_global_var_from_code
+from get_repo_structure.file_text import join_lines
 from get_repo_structure.get_repo_structure import (
     get_project_structure_from_scratch,
     parse_python_file,
@@ -198,14 +201,16 @@ def transfer_arb_locs_to_locs(
             "import_interval": import_interval,
         }
 
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
+    # every lookup below is restricted to pred_file
+    classes = repo_index.classes_by_file.get(pred_file, [])
+    functions = repo_index.functions_by_file.get(pred_file, [])
     imports = []
     import_interval = []
-    for file in files:
-        if file[0] == pred_file:
-            imports = file[2]
-            import_interval = file[3]
-            break
+    file = repo_index.get_file(pred_file)
+    if file is not None:
+        imports = file[2]
+        import_interval = file[3]
 
     used_globals = []
 
@@ -226,7 +231,7 @@ def transfer_arb_locs_to_locs(
                 relevant_class = [
                     clazz
                     for clazz in classes
-                    if clazz["file"] == pred_file and clazz["name"] == loc
+                    if clazz["name"] == loc
                 ]
 
                 if len(relevant_class) == 0:
@@ -249,7 +254,7 @@ def transfer_arb_locs_to_locs(
                     relevant_class = [
                         clazz
                         for clazz in classes
-                        if clazz["file"] == pred_file and clazz["name"] == class_name
+                        if clazz["name"] == class_name
                     ]
                     if len(relevant_class) == 0:
                         print(f"{class_name} class could not be found")
@@ -274,7 +279,7 @@ def transfer_arb_locs_to_locs(
                     relevant_function = [
                         function
                         for function in functions
-                        if function["file"] == pred_file and function["name"] == loc
+                        if function["name"] == loc
                     ]
                     if len(relevant_function) == 0:
                         print(f"{loc} function could not be found")
@@ -283,8 +288,7 @@ def transfer_arb_locs_to_locs(
                             relevant_class = [
                                 clazz
                                 for clazz in classes
-                                if clazz["file"] == pred_file
-                                and clazz["name"] == current_class_name
+                                if clazz["name"] == current_class_name
                             ]
                             relevant_method = [
                                 method
@@ -311,14 +315,13 @@ def transfer_arb_locs_to_locs(
                             # look for it in any class
                             relevant_method = []
                             for clazz in classes:
-                                if clazz["file"] == pred_file:
-                                    relevant_method.extend(
-                                        [
-                                            method
-                                            for method in clazz["methods"]
-                                            if method["name"] == loc
-                                        ]
-                                    )
+                                relevant_method.extend(
+                                    [
+                                        method
+                                        for method in clazz["methods"]
+                                        if method["name"] == loc
+                                    ]
+                                )
 
                             if len(relevant_method) == 1:
                                 line_loc.append(
@@ -374,14 +377,11 @@ def transfer_arb_locs_to_locs(
     # TODO: think of strategies to do bunched up lines
     # TODO: e.g., we can have multiple code segments (right now, its just one)
 
-    for file_content in files:
-        if file_content[0] == pred_file:
-            content = file_content[1]
-            break
-
     if len(line_loc) == 0:
         return [], [], [], []
 
+    content = repo_index.get_file(pred_file)[1]
+
     # compute overlapping locations instead
     if loc_interval:
         contextual_line_loc = []
@@ -660,12 +660,121 @@ def filter_proposed_functions(proposed_functions, repo_structure):
     return filtered_functions
 
 
+class RepoIndex:
+    """
+    Lookup tables over a project structure, built with a single walk of the structure.
+
+    The search and preprocess helpers accept a RepoIndex wherever they take a structure, so
+    build it once per structure and pass it around instead of re-walking the raw dict.
+
+    Arguments:
+    structure -- a dictionary representing the directory structure
+    """
+
+    def __init__(self, structure):
+        self.structure = structure
+        self.files, self.classes, self.functions = get_full_file_paths_and_classes_and_functions(structure)
+        self.file_by_path = {}
+        self.classes_by_file = {}
+        self.functions_by_file = {}
+        self.classes_by_name = {}
+        self.functions_by_name = {}
+        # method name -> list of (class, method)
+        self.methods_by_name = {}
+        for file in self.files:
+            if isinstance(file, tuple):
+                self.file_by_path.setdefault(file[0], file)
+        for clazz in self.classes:
+            self.classes_by_file.setdefault(clazz["file"], []).append(clazz)
+            self.classes_by_name.setdefault(clazz["name"], []).append(clazz)
+            for method in clazz["methods"]:
+                self.methods_by_name.setdefault(method["name"], []).append((clazz, method))
+        for function in self.functions:
+            self.functions_by_file.setdefault(function["file"], []).append(function)
+            self.functions_by_name.setdefault(function["name"], []).append(function)
+        # filled per file on first use, most lookups only touch a few files
+        self.call_sites_by_file = {}
+        self.scopes_by_file = {}
+
+    def get_file(self, file_path):
+        """Return the (path, text, imports, import_interval) entry of a file, or None."""
+        return self.file_by_path.get(file_path)
+
+    def get_call_sites(self, file_path):
+        """Return {callee name: sorted lines of the calls} for a file, taken from its AST."""
+        if file_path not in self.call_sites_by_file:
+            call_sites = {}
+            try:
+                tree = ast.parse(join_lines(self.file_by_path[file_path][1]))
+            except Exception:
+                tree = None
+            if tree is not None:
+                for node in ast.walk(tree):
+                    if not isinstance(node, ast.Call):
+                        continue
+                    if isinstance(node.func, ast.Name):
+                        callee = node.func.id
+                    elif isinstance(node.func, ast.Attribute):
+                        callee = node.func.attr
+                    else:
+                        continue
+                    # the callee name is the last token of node.func
+                    call_sites.setdefault(callee, set()).add(node.func.end_lineno)
+            self.call_sites_by_file[file_path] = {
+                callee: sorted(lines) for callee, lines in call_sites.items()
+            }
+        return self.call_sites_by_file[file_path]
+
+    def get_enclosing_scope(self, file_path, line):
+        """
+        Return the outermost free function containing the line, or else the outermost method containing it.
+
+        Returns:
+        ("function", function), ("method", (class, method)) or None if the line is at module level
+        """
+        if file_path not in self.scopes_by_file:
+            functions = [
+                (function["start_line"], function["end_line"], function)
+                for function in self.functions_by_file.get(file_path, [])
+            ]
+            methods = [
+                (method["start_line"], method["end_line"], (clazz, method))
+                for clazz in self.classes_by_file.get(file_path, [])
+                for method in clazz.get("methods", [])
+            ]
+            self.scopes_by_file[file_path] = (get_outermost_intervals(functions), get_outermost_intervals(methods))
+        for scope_type, (starts, intervals) in zip(("function", "method"), self.scopes_by_file[file_path]):
+            i = bisect_right(starts, line) - 1
+            if i >= 0 and line <= intervals[i][1]:
+                return scope_type, intervals[i][2]
+        return None
+
+
+def get_outermost_intervals(intervals):
+    """
+    Keep the intervals that are not nested in another one. Scopes are either nested or disjoint, so the result is
+    sorted and disjoint, and the outermost scope containing a line can be found with bisect on the starts.
+    """
+    outermost = []
+    for interval in sorted(intervals, key=lambda interval: (interval[0], -interval[1])):
+        if not outermost or interval[0] > outermost[-1][1]:
+            outermost.append(interval)
+    return [interval[0] for interval in outermost], outermost
+
+
+def get_repo_index(structure):
+    """Return structure itself if it is already a RepoIndex, otherwise index it."""
+    if isinstance(structure, RepoIndex):
+        return structure
+    return RepoIndex(structure)
+
+
 def get_full_file_paths_and_classes_and_functions(structure, current_path=""):
     """
     Recursively retrieve all file paths, classes, and functions within a directory structure.
 
     Arguments:
-    structure -- a dictionary representing the directory structure
+    structure -- a dictionary representing the directory structure, or a RepoIndex
     current_path -- the path accumulated so far, used during recursion (default="")
 
     Returns:
@@ -674,6 +783,8 @@ def get_full_file_paths_and_classes_and_functions(structure, current_path=""):
     - classes: list of class details with file paths
     - functions: list of function details with file paths
     """
+    if isinstance(structure, RepoIndex):
+        return structure.files, structure.classes, structure.functions
     files = []
     classes = []
     functions = []
@@ -735,96 +846,52 @@ def find_definitions_by_name(target_name, structure):
 
     Arguments:
     - target_name: str, the name of the function or method to search for
-    - structure: dict, the project structure containing file paths, classes, and functions
+    - structure: dict or RepoIndex, the project structure containing file paths, classes, and functions
 
     Returns:
     - List of dicts with keys: 'name', 'file', 'start_line', 'end_line', 'type' ('function' or 'method')
     """
     results = []
-    _, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
 
     # Search free functions
-    for fn in functions:
-        if fn.get("name") == target_name:
-            results.append({
-                "type": "function",
-                "name": target_name,
-                "file": fn.get("file"),
-                "start_line": fn.get("start_line"),
-                "end_line": fn.get("end_line"),
-            })
+    for fn in repo_index.functions_by_name.get(target_name, []):
+        results.append({
+            "type": "function",
+            "name": target_name,
+            "file": fn.get("file"),
+            "start_line": fn.get("start_line"),
+            "end_line": fn.get("end_line"),
+        })
 
     # Search methods inside classes
-    for cls in classes:
-        for method in cls.get("methods", []):
-            if method.get("name") == target_name:
-                results.append({
-                    "type": "method",
-                    "class": cls.get("name"),
-                    "name": target_name,
-                    "file": cls.get("file"),
-                    "start_line": method.get("start_line"),
-                    "end_line": method.get("end_line"),
-                })
+    for cls, method in repo_index.methods_by_name.get(target_name, []):
+        results.append({
+            "type": "method",
+            "class": cls.get("name"),
+            "name": target_name,
+            "file": cls.get("file"),
+            "start_line": method.get("start_line"),
+            "end_line": method.get("end_line"),
+        })
 
     return results
 
 
 def find_callers_by_name(target_name, structure):
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
     callers = []
     seen = set()
     # Iterate through files with content
-    for entry in files:
+    for entry in repo_index.files:
         if isinstance(entry, tuple) and len(entry) >= 2:
             file_path, text_lines, *_ = entry
-            for idx, line in enumerate(text_lines):
-                # Skip the definition line of the target function/method
-                if re.search(rf"\bdef\s+{re.escape(target_name)}\s*\(", line):
-                    continue
-                # Match calls like target_name(
-                if re.search(rf"\b{re.escape(target_name)}\s*\(", line):
-                    call_line = idx + 1
-                    found = False
-                    # Check within free functions
-                    for fn in functions:
-                        if fn.get("file") == file_path and fn.get("start_line") <= call_line <= fn.get("end_line"):
-                            key = ("function", fn["name"], file_path, fn.get("start_line"), fn.get("end_line"))
-                            if key not in seen:
-                                seen.add(key)
-                                callers.append({
-                                    "type": "function",
-                                    "caller_name": fn.get("name", ""),
-                                    "file": file_path,
-                                    "start_line": fn.get("start_line", 0),
-                                    "end_line": fn.get("end_line", 0),
-                                })
-                            found = True
-                            break
-                    if found:
-                        continue
-                    # Check within class methods
-                    for cls in classes:
-                        if cls.get("file") == file_path:
-                            for method in cls.get("methods", []):
-                                if method.get("start_line") <= call_line <= method.get("end_line"):
-                                    key = ("method", cls.get("name"), method.get("name"), file_path, method.get("start_line"), method.get("end_line"))
-                                    if key not in seen:
-                                        seen.add(key)
-                                        callers.append({
-                                            "type": "method",
-                                            "class": cls.get("name"),
-                                            "caller_name": method.get("name"),
-                                            "file": file_path,
-                                            "start_line": method.get("start_line"),
-                                            "end_line": method.get("end_line"),
-                                        })
-                                    found = True
-                                    break
-                            if found:
-                                break
-                    if found:
-                        continue
+            # only parse the files that mention the target
+            if target_name not in join_lines(text_lines):
+                continue
+            for call_line in repo_index.get_call_sites(file_path).get(target_name, []):
+                scope = repo_index.get_enclosing_scope(file_path, call_line)
+                if scope is None:
                     # Global scope call
                     key = ("global", file_path, call_line, call_line)
                     if key not in seen:
@@ -835,21 +902,41 @@ def find_callers_by_name(target_name, structure):
                             "start_line": call_line,
                             "end_line": call_line,
                         })
+                elif scope[0] == "function":
+                    fn = scope[1]
+                    key = ("function", fn["name"], file_path, fn.get("start_line"), fn.get("end_line"))
+                    if key not in seen:
+                        seen.add(key)
+                        callers.append({
+                            "type": "function",
+                            "caller_name": fn.get("name", ""),
+                            "file": file_path,
+                            "start_line": fn.get("start_line", 0),
+                            "end_line": fn.get("end_line", 0),
+                        })
+                else:
+                    cls, method = scope[1]
+                    key = ("method", cls.get("name"), method.get("name"), file_path, method.get("start_line"), method.get("end_line"))
+                    if key not in seen:
+                        seen.add(key)
+                        callers.append({
+                            "type": "method",
+                            "class": cls.get("name"),
+                            "caller_name": method.get("name"),
+                            "file": file_path,
+                            "start_line": method.get("start_line"),
+                            "end_line": method.get("end_line"),
+                        })
     return callers
 
 
 def find_modified_functions(diff, structure):
-    _, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
 
     file_to_modified_lines = parse_diff_to_modified_lines(diff)
 
-    file_to_classes = defaultdict(list)
-    for cls in classes:
-        file_to_classes[cls['file']].append(cls)
-
-    file_to_functions = defaultdict(list)
-    for func in functions:
-        file_to_functions[func['file']].append(func)
+    file_to_classes = repo_index.classes_by_file
+    file_to_functions = repo_index.functions_by_file
 
     modified_functions = set()
 
@@ -893,6 +980,9 @@ def parse_diff_to_modified_lines(diff_text):
 
 
 def extract_file_content(files, file_name, start_line, end_line):
+    if isinstance(files, RepoIndex):
+        file = files.get_file(file_name)
+        files = [file] if file is not None else []
     for f_name, source_lines, *_ in files:
         if f_name == file_name:
             return "\n".join(source_lines[start_line-1:end_line])
@@ -918,16 +1008,15 @@ def get_repo_structure(instance_id: str, repo_name, base_commit, playground, **k
 
 
 def get_repo_files(structure, filepaths: list[str]):
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
     file_contents = dict()
     for filepath in filepaths:
         content = None
 
-        for file_content in files:
-            if file_content[0] == filepath:
-                content = "\n".join(file_content[1])
-                file_contents[filepath] = content
-                break
+        file_content = repo_index.get_file(filepath)
+        if file_content is not None:
+            content = "\n".join(file_content[1])
+            file_contents[filepath] = content
 
         assert content is not None, "file not found"
     return file_contents
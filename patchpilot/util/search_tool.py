@@ -1,8 +1,9 @@
 from fuzzysearch import find_near_matches
+from get_repo_structure.file_text import FileLines, join_lines
 from patchpilot.util.preprocess_data import (
     get_full_file_paths_and_classes_and_functions,
+    get_repo_index,
 )
-import ast
 
 
 search_string_schema = {
@@ -82,9 +83,40 @@ search_func_def_with_class_and_file_schema = {
   }
 }
 
+def get_definition_depth(repo_index, file_path, definition):
+    """
+    Number of classes and functions of the file enclosing a definition.
+    """
+    depth = 0
+    for clazz in repo_index.classes_by_file.get(file_path, []):
+        scopes = [clazz] + clazz["methods"]
+        depth += sum(
+            scope is not definition and scope["start_line"] <= definition["start_line"] and definition["end_line"] <= scope["end_line"]
+            for scope in scopes
+        )
+    for function in repo_index.functions_by_file.get(file_path, []):
+        if function is not definition and function["start_line"] <= definition["start_line"] and definition["end_line"] <= function["end_line"]:
+            depth += 1
+    return depth
+
+
+def get_definition_code(repo_index, file_path, definition) -> str:
+    """
+    Source of a function definition taken from the text of its file, starting at the def keyword like ast.get_source_segment.
+    """
+    file_lines = repo_index.get_file(file_path)[1]
+    start, end = definition["start_line"] - 1, definition["end_line"]
+    if isinstance(file_lines, FileLines):
+        lines = file_lines.view(start, end)
+    else:
+        lines = file_lines[start:end]
+    return join_lines(lines).lstrip(" \t")
+
+
 def search_func_def_with_class_and_file(structure, function_name: str, class_name: str = "") -> list[str]:
     """
     Accepts a function name, file name, and class name to search and return the code of the function definition, along with the file and class containing the function. Only function name is required, but file name and class name are preferred if available.
+    The definitions are looked up in the parsed structure, files are not parsed again.
     """
     print(f"Searching for function {function_name} in class {class_name if class_name else 'any'}")
     
@@ -92,51 +124,43 @@ def search_func_def_with_class_and_file(structure, function_name: str, class_nam
     found_function_code = ""
     found_file_name = ""
     
-    # Get the list of files, classes, and functions from the provided structure
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
+    repo_index = get_repo_index(structure)
 
-    
-    for file in files:        
-        file_path, file_contents = file[0], "\n".join(file[1])
-        
-        # Parse file contents to check for class and function definitions
-        tree = ast.parse(file_contents)
-        
-        # If a specific class name is provided, search within the class
-        if class_name:
-            found_class = False
-            for node in ast.walk(tree):
-                if isinstance(node, ast.ClassDef) and node.name == class_name:
-                    found_class = True
-                    for item in node.body:
-                        if isinstance(item, ast.FunctionDef) and item.name == function_name:
-                            found_function_code = ast.get_source_segment(file_contents, item)
-                            found_file_name = file_path
-                            found_class_name = class_name
-                            break
-                    break
-            if not found_class:
-                continue  # Class not found in this file, skip to next file
-        else:
-            # If no specific class name, search for the function definition directly
-            for node in ast.walk(tree):
-                if isinstance(node, ast.FunctionDef) and node.name == function_name:
-                    found_function_code = ast.get_source_segment(file_contents, node)
-                    found_file_name = file_path
-                    # Check if function is within a class
-                    parent_class = next((cls.name for cls in ast.walk(tree) if isinstance(cls, ast.ClassDef) and node in cls.body), None)
-                    found_class_name = parent_class if parent_class else ""
-                    break
-
-        if found_function_code:
-          print(f"Found function {function_name} in class {found_class_name} in file {found_file_name}")
-          break  # Stop search once function definition is found
+    if class_name:
+        # only the first class with that name in each file is searched, like the ast.walk order of the file
+        searched_files = set()
+        for clazz in repo_index.classes_by_name.get(class_name, []):
+            if clazz["file"] in searched_files:
+                continue
+            searched_files.add(clazz["file"])
+            method = next((method for method in clazz["methods"] if method["name"] == function_name), None)
+            if method is not None:
+                found_function_code = get_definition_code(repo_index, clazz["file"], method)
+                found_file_name = clazz["file"]
+                found_class_name = class_name
+                break
+    else:
+        # free functions, methods and nested functions with that name, the first file wins
+        candidates = [(function["file"], function, "") for function in repo_index.functions_by_name.get(function_name, [])]
+        candidates += [(clazz["file"], method, clazz["name"]) for clazz, method in repo_index.methods_by_name.get(function_name, [])]
+        if candidates:
+            file_order = {file[0]: i for i, file in enumerate(repo_index.files)}
+            first_file = min(candidates, key=lambda candidate: file_order.get(candidate[0], len(file_order)))[0]
+            # the least nested definition of the file, then the first one
+            _, definition, parent_class = min(
+                (candidate for candidate in candidates if candidate[0] == first_file),
+                key=lambda candidate: (get_definition_depth(repo_index, first_file, candidate[1]), candidate[1]["start_line"]),
+            )
+            found_function_code = get_definition_code(repo_index, first_file, definition)
+            found_file_name = first_file
+            found_class_name = parent_class
+
+    if found_function_code:
+        print(f"Found function {function_name} in class {found_class_name} in file {found_file_name}")
 
     # Return the result as a list with file name, class name, and function code
     return [found_file_name, found_class_name, found_function_code]
-            
-      
-      
+
 
 def search_func_def(function_name: str, structure) -> list[str]:
     """
@@ -144,10 +168,9 @@ def search_func_def(function_name: str, structure) -> list[str]:
     """
     search_res=[]
     print(f"searching for function {function_name}")
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
-    for function_struct in functions:
-        if function_struct["name"] == function_name:
-            search_res.append(function_struct["file"])
+    repo_index = get_repo_index(structure)
+    for function_struct in repo_index.functions_by_name.get(function_name, []):
+        search_res.append(function_struct["file"])
     return [] if not search_res else search_res
 
 
@@ -158,13 +181,93 @@ def search_class_def(class_name: str, structure) -> list[str]:
     # Implementation code
     search_res=[]
     print(f"searching for class {class_name}")
-    files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
-    for class_struct in classes:
-        if class_struct["name"] == class_name:
-            search_res.append(class_struct["file"])
+    repo_index = get_repo_index(structure)
+    for class_struct in repo_index.classes_by_name.get(class_name, []):
+        search_res.append(class_struct["file"])
     return [] if not search_res else search_res
 
 
+def get_candidate_files(files, query_string: str, max_l_dist: int = 0):
+    """
+    Yields the files that may contain the string within max_l_dist edits, in their original order.
+    Files are skipped using the n-gram index of the structure text, files without an index are always yielded.
+    The index is only built for fuzzy searches, a plain scan is as fast as building it for an exact one.
+    """
+    matches = {}
+    for file in files:
+        lines = file[1]
+        if isinstance(lines, FileLines):
+            ngram_index = lines.buffer.get_ngram_index(build=max_l_dist > 0)
+            if ngram_index is not None:
+                if id(ngram_index) not in matches:
+                    matches[id(ngram_index)] = ngram_index.match_slots(query_string, max_l_dist)
+                if not ngram_index.may_contain(matches[id(ngram_index)], lines.base):
+                    continue
+        yield file
+
+
+def get_near_match_regions(query_string: str, file_contents: str, max_l_dist: int):
+    """
+    Returns the (start, end) regions of file_contents that can hold a match of query_string within max_l_dist edits,
+    or None if the query is too short to rule anything out. find_near_matches finds the same matches in these regions
+    as in the whole file.
+    A match is at most len(query_string) + max_l_dist long and keeps at least len(query_string) - q + 1 - max_l_dist * q
+    of the q-grams of the query, so a window of that length around it must contain enough of them.
+    """
+    for q in (3, 2):
+        threshold = len(query_string) - q + 1 - max_l_dist * q
+        if threshold > 0:
+            break
+    else:
+        return None
+    # number of query positions for each q-gram
+    weights = {}
+    for i in range(len(query_string) - q + 1):
+        gram = query_string[i:i + q]
+        weights[gram] = weights.get(gram, 0) + 1
+    occurrences = []
+    for gram in weights:
+        position = file_contents.find(gram)
+        while position != -1:
+            occurrences.append((position, gram))
+            position = file_contents.find(gram, position + 1)
+    occurrences.sort()
+    window = len(query_string) + max_l_dist - q
+    max_match_length = len(query_string) + max_l_dist
+    in_window = {}
+    total = 0
+    start = 0
+    regions = []
+    for position, gram in occurrences:
+        if not in_window.get(gram):
+            total += weights[gram]
+        in_window[gram] = in_window.get(gram, 0) + 1
+        while occurrences[start][0] < position - window:
+            old_gram = occurrences[start][1]
+            in_window[old_gram] -= 1
+            if not in_window[old_gram]:
+                total -= weights[old_gram]
+            start += 1
+        if total >= threshold:
+            # any match ending the window lies within max_match_length of its last q-gram
+            region_start, region_end = max(0, position - max_match_length), position + max_match_length
+            if regions and region_start <= regions[-1][1]:
+                regions[-1] = (regions[-1][0], region_end)
+            else:
+                regions.append((region_start, region_end))
+    return regions
+
+
+def count_near_matches(query_string: str, file_contents: str, max_l_dist: int) -> int:
+    regions = get_near_match_regions(query_string, file_contents, max_l_dist)
+    if regions is None:
+        return len(find_near_matches(query_string, file_contents, max_l_dist=max_l_dist))
+    return sum(
+        len(find_near_matches(query_string, file_contents[start:end], max_l_dist=max_l_dist))
+        for start, end in regions
+    )
+
+
 def search_string(query_string: str, structure) -> list[str]:
     """
     Accepts a string to search for and returns the file paths where the string is found. We only return the files that contain the specific string the most number of times. 
@@ -173,9 +276,10 @@ def search_string(query_string: str, structure) -> list[str]:
     file_to_num_occurrences = {}
     print(f"searching for string '{query_string}'")
     files, classes, functions = get_full_file_paths_and_classes_and_functions(structure)
-    for file in files:
-        if query_string in "\n".join(file[1]):
-            file_to_num_occurrences[file[0]] = "\n".join(file[1]).count(query_string)
+    for file in get_candidate_files(files, query_string):
+        file_contents = join_lines(file[1])
+        if query_string in file_contents:
+            file_to_num_occurrences[file[0]] = file_contents.count(query_string)
     file_to_num_occurrences = dict(sorted(file_to_num_occurrences.items(), key=lambda item: item[1], reverse=True))
     if file_to_num_occurrences:
         return [file for file in file_to_num_occurrences.keys()][:20]
@@ -183,11 +287,12 @@ def search_string(query_string: str, structure) -> list[str]:
      # Fuzzy search if no exact matches found
     print(f"Performing Fuzzy search for string '{query_string}'")
     fuzzy_matches = {}
-    for file in files:
-        file_path, file_contents = file[0], "\n".join(file[1])
-        matches = find_near_matches(query_string, file_contents, max_l_dist=min(len(query_string) // 3, 9))
-        if matches:
-            fuzzy_matches[file_path] = len(matches)
+    max_l_dist = min(len(query_string) // 3, 9)
+    for file in get_candidate_files(files, query_string, max_l_dist):
+        file_path, file_contents = file[0], join_lines(file[1])
+        num_matches = count_near_matches(query_string, file_contents, max_l_dist)
+        if num_matches:
+            fuzzy_matches[file_path] = num_matches
 
     if fuzzy_matches:
         # Sort files by number of fuzzy matches in descending order
@@ -0,0 +1,144 @@
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from patchpilot.util.postprocess_data import fake_git_apply, get_git_diff
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+FILE_LINES = ["def foo(x):", "    return x", "", "class A:", "    pass", "    x = 1", "import os", "# comment", "    if x:", "        y()"]
+FILE_PATHS = ["a.py", "pkg/b.py", "pkg/sub/c.py", "z.py"]
+
+
+def run_git(repo, *args, stdin=None):
+    return subprocess.run(["git", "-C", str(repo), *args], input=stdin, capture_output=True, check=True).stdout
+
+
+def write_files(repo, files):
+    for file_path, content in files.items():
+        path = os.path.join(repo, file_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        with open(path, "w", newline="") as f:
+            f.write(content)
+
+
+def read_files(repo, file_paths):
+    files = dict()
+    for file_path in file_paths:
+        path = os.path.join(repo, file_path)
+        files[file_path] = open(path, newline="").read() if os.path.exists(path) else None
+    return files
+
+
+@pytest.fixture
+def repo(tmp_path):
+    run_git(tmp_path, "init", "-q")
+    run_git(tmp_path, "config", "user.email", "test@example.com")
+    run_git(tmp_path, "config", "user.name", "test")
+    return tmp_path
+
+
+def commit_files(repo, old_files):
+    write_files(repo, old_files)
+    run_git(repo, "add", "-A")
+    run_git(repo, "commit", "-q", "--allow-empty", "-m", "old")
+
+
+def random_content(rng, num_lines):
+    content = "\n".join(rng.choice(FILE_LINES) + str(rng.randint(0, 3)) * rng.randint(0, 1) for _ in range(num_lines))
+    # about a third of the files do not end with a newline
+    return content + "\n" if num_lines and rng.random() < 0.7 else content
+
+
+def random_edit(rng, content):
+    lines = content.split("\n")
+    for _ in range(rng.randint(1, 4)):
+        index = rng.randint(0, len(lines))
+        operation = rng.random()
+        if operation < 0.35:
+            lines.insert(index, rng.choice(FILE_LINES))
+        elif operation < 0.7 and len(lines) > 1:
+            del lines[min(index, len(lines) - 1)]
+        else:
+            lines[min(index, len(lines) - 1)] = rng.choice(FILE_LINES) + "  # changed"
+    new_content = "\n".join(lines)
+    if rng.random() < 0.2:
+        # add or remove the newline at the end of the file
+        new_content = new_content[:-1] if new_content.endswith("\n") else new_content + "\n"
+    return new_content
+
+
+def check_round_trip(repo, old_files, new_files):
+    """The in-memory diff applies with git apply, and fake_git_apply applies the diff of git."""
+    commit_files(repo, old_files)
+    file_paths = sorted(set(old_files) | set(new_files))
+    diff = get_git_diff(file_paths, [old_files.get(path) for path in file_paths], [new_files.get(path) for path in file_paths])
+    if diff:
+        run_git(repo, "apply", "--check", "-", stdin=diff.encode("utf-8"))
+        run_git(repo, "apply", "-", stdin=diff.encode("utf-8"))
+    assert read_files(repo, file_paths) == {path: new_files.get(path) for path in file_paths}
+
+    run_git(repo, "checkout", "-q", "--", ".")
+    write_files(repo, new_files)
+    git_diff = run_git(repo, "diff").decode("utf-8")
+    for file_path, old_content in old_files.items():
+        new_content = new_files.get(file_path)
+        if old_content is not None and new_content is not None:
+            assert fake_git_apply("playground", file_path, old_content, git_diff) == new_content
+            assert fake_git_apply("playground", file_path, old_content, diff) == new_content
+
+
+@pytest.mark.parametrize(
+    "old_content, new_content",
+    [
+        ("a\nb\nc\n", "a\nB\nc\n"),
+        ("a\nb\nc", "a\nb\nc\n"),
+        ("a\nb\nc\n", "a\nb\nc"),
+        ("a\nb\nc", "a\nb\nC"),
+        ("a\nb\nc", "a\nb"),
+        ("a\nb", "a\nb\nc"),
+        ("a", "b"),
+        ("a\n", ""),
+        ("", "a"),
+        ("x\n" * 20 + "end", "x\n" * 10 + "y\n" + "x\n" * 10 + "end\n"),
+    ],
+)
+def test_round_trip_end_of_file(repo, old_content, new_content):
+    check_round_trip(repo, {"a.py": old_content, "b.py": "unchanged\n"}, {"a.py": new_content, "b.py": "unchanged\n"})
+
+
+def test_round_trip_created_and_deleted_files(repo):
+    old_files = {"a.py": "import os\n", "pkg/b.py": "x = 1", "pkg/empty.py": ""}
+    new_files = {"a.py": None, "pkg/b.py": "x = 2", "pkg/c.py": "y = 1\n", "pkg/empty.py": None, "pkg/new_empty.py": ""}
+    check_round_trip(repo, old_files, new_files)
+
+
+def test_round_trip_random_edits(repo):
+    rng = random.Random(0)
+    for _ in range(40):
+        file_paths = rng.sample(FILE_PATHS, rng.randint(1, 3))
+        old_files = {file_path: random_content(rng, rng.randint(0, 50)) for file_path in file_paths}
+        new_files = {file_path: random_edit(rng, content) for file_path, content in old_files.items()}
+        check_round_trip(repo, old_files, new_files)
+        run_git(repo, "rm", "-q", "-r", "--cached", ".")
+        for file_path in file_paths:
+            os.remove(os.path.join(repo, file_path))
+
+
+def test_headers_match_git(repo):
+    old_files = {"pkg/b.py": "def foo(x):\n" + "    x += 1\n" * 10 + "    return x\n", "a.py": "a = 1"}
+    new_files = {"pkg/b.py": "def foo(x):\n" + "    x += 1\n" * 10 + "    return x + 1\n", "a.py": "a = 2"}
+    commit_files(repo, old_files)
+    write_files(repo, new_files)
+    git_diff = run_git(repo, "diff").decode("utf-8")
+    file_paths = sorted(old_files, reverse=True)
+    diff = get_git_diff(file_paths, [old_files[path] for path in file_paths], [new_files[path] for path in file_paths])
+    # a single change has only one shape, so here the diff is the one of git, including index lines and function names
+    assert diff == git_diff
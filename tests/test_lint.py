@@ -0,0 +1,83 @@
+import shutil
+import subprocess
+
+import pytest
+
+from patchpilot.util.postprocess_data import get_lint_errors, lint_code
+
+# the errors lint_code checked with flake8 before it ran pyflakes in-process
+FATAL_FLAKE8_CODES = "E9,F821,F823,F831,F406,F407,F701,F702,F704,F706"
+
+LINT_CASES = [
+    # fatal pyflakes errors
+    "x = y",
+    "continue",
+    "def f():\n  break",
+    "def f(a, a): pass",
+    "def f():\n  from os import *",
+    "from __future__ import nope",
+    "yield 1",
+    "return 1",
+    "class A:\n  return 1",
+    "def f():\n  print(x)\n  x = 1",
+    "class A:\n    x = 1\n    def f(self): return x",
+    # not reported
+    "from os import *\nq",
+    "import os",
+    "x = f'{1}'",
+    "",
+    "\n\n",
+    # syntax and token errors
+    "x = (",
+    "def f(:\n",
+    "x = 1\n  y = 2",
+    "if x:\npass",
+    "print(1",
+    'a = """\nunterminated',
+    "a = \"\\xff\n",
+    "\tif x:\n        pass",
+    "if True:\n    x = 1\n   y = 2",
+    "x = `1`",
+    "@",
+    # noqa comments
+    "x = y  # noqa\nz = w # NOQA:F821\nq = r  # noqa: E501\nt = u # noqa:F821,E1",
+    "x = y\n# flake8: noqa",
+    "x = y\n# flake8: noqa: F821",
+    'x = """\n%s\n""" % y  # noqa',
+    'x = """\ny\n"""; z  # noqa',
+    "x = {\n  y  # noqa\n}",
+    "x = (  # noqa\n",
+    # byte order mark and line endings
+    "\ufeffx = y",
+    "\ufeffx = (",
+    "x = y\r\nz = w  # noqa\r\n",
+    "def f():\r\n    return 1\r\n        x = 2\r\n",
+    "x = 1\ry = z\r",
+]
+
+
+def flake8_lint_errors(tmp_path, code):
+    path = tmp_path / "test.py"
+    with open(path, "w", newline="") as f:
+        f.write(code)
+    o = subprocess.run(
+        ["flake8", f"--select={FATAL_FLAKE8_CODES}", "--isolated", str(path)], capture_output=True
+    )
+    errors = set()
+    for error in o.stdout.decode("utf-8").split(f"{path}:")[1:]:
+        errors.add(":".join(error.split(":")[2:]).strip())
+    return errors
+
+
+@pytest.mark.skipif(shutil.which("flake8") is None, reason="flake8 is not installed")
+@pytest.mark.parametrize("code", LINT_CASES)
+def test_lint_errors_match_flake8(tmp_path, code):
+    assert get_lint_errors(code) == flake8_lint_errors(tmp_path, code)
+
+
+def test_lint_code_reports_new_errors_only():
+    prev_code = "def f():\n    return x\n"
+    assert lint_code("playground", "test.py", prev_code + "y = 1\n", prev_code) == (True, set(), set())
+    success, prev_errors, errors = lint_code("playground", "test.py", prev_code + "y = z\n", prev_code)
+    assert not success
+    assert errors - prev_errors == {"F821 undefined name 'z'"}
@@ -0,0 +1,145 @@
+import argparse
+import json
+import re
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("datasets")
+
+import get_repo_structure.get_repo_structure as repo_structure
+from patchpilot.fl import localize
+from patchpilot.repair import repair
+from patchpilot.util import mock_server
+from patchpilot.util.mock_server import MockLLMServer
+
+pytestmark = pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+
+INSTANCE_ID = "psf__requests-1"
+PROBLEM_STATEMENT = "`requests.utils.add_numbers(1, 2)` returns -1, it subtracts its arguments instead of adding them."
+OLD_UTILS = "def add_numbers(a, b):\n    return a - b\n\n\ndef subtract_numbers(a, b):\n    return a - b\n"
+NEW_UTILS = OLD_UTILS.replace("return a - b", "return a + b", 1)
+
+CANNED_RESPONSES = [
+    (
+        r"call the appropriate function to search",
+        "",
+        [{"name": "search_func_def", "arguments": {"function_name": "add_numbers"}}],
+    ),
+    (r"provide a list of files that one would need to edit", "```\nrequests/utils.py\n```", []),
+    (r"skeleton of relevant files", "```\nrequests/utils.py\nfunction: add_numbers\n```", []),
+    (r"provide a set of locations", "```\nrequests/utils.py\nfunction: add_numbers\nline: 2\n```", []),
+    (
+        r"Here is the current step for fixing the issue",
+        "```python\n### requests/utils.py\n<<<<<<< SEARCH\ndef add_numbers(a, b):\n    return a - b\n=======\n"
+        "def add_numbers(a, b):\n    return a + b\n>>>>>>> REPLACE\n```",
+        [],
+    ),
+    (
+        r"step-by-step plan for repairing it",
+        "--- BEGIN STEPS ---\n<STEP> Add the arguments in add_numbers </STEP> <Actions to be Taken> Return the sum of a and b "
+        "in add_numbers of requests/utils.py </Actions to be Taken>\n--- END STEPS ---",
+        [],
+    ),
+]
+
+
+def run_git(repo, *args):
+    return subprocess.run(["git", "-C", str(repo), *args], capture_output=True, check=True).stdout
+
+
+@pytest.fixture
+def bug(tmp_path, monkeypatch):
+    """A one-file psf/requests repository, served from a mirror in tmp_path like the ones of SWE-bench."""
+    repo = tmp_path / "requests"
+    (repo / "requests").mkdir(parents=True)
+    (repo / "requests" / "__init__.py").write_text("")
+    (repo / "requests" / "utils.py").write_text(OLD_UTILS)
+    run_git(repo, "init", "-q")
+    run_git(repo, "add", "-A")
+    run_git(repo, "-c", "user.email=test@example.com", "-c", "user.name=test", "commit", "-q", "-m", "init")
+    base_commit = run_git(repo, "rev-parse", "HEAD").decode("utf-8").strip()
+    run_git(tmp_path, "clone", "-q", "--mirror", str(repo), str(tmp_path / "mirrors" / "psf__requests.git"))
+
+    monkeypatch.setattr(repo_structure, "REPO_MIRROR_DIR", str(tmp_path / "mirrors"))
+    monkeypatch.setattr(repo_structure, "STRUCTURE_CACHE_DIR", str(tmp_path / "structures"))
+    monkeypatch.setattr(localize, "PROJECT_STRUCTURE", None)
+    monkeypatch.chdir(tmp_path)
+    bug = {
+        "instance_id": INSTANCE_ID,
+        "repo": "psf/requests",
+        "base_commit": base_commit,
+        "problem_statement": PROBLEM_STATEMENT,
+    }
+    monkeypatch.setattr(localize, "load_dataset", lambda *args, **kwargs: [bug])
+    monkeypatch.setattr(repair, "load_dataset", lambda *args, **kwargs: [bug])
+    return bug
+
+
+@pytest.fixture
+def server(monkeypatch):
+    canned_responses = [(re.compile(match, re.IGNORECASE), text, tool_calls) for match, text, tool_calls in CANNED_RESPONSES]
+    server = MockLLMServer(canned_responses=canned_responses).start()
+    monkeypatch.setattr(mock_server, "MOCK_LLM_URL", server.url)
+    yield server
+    server.stop()
+
+
+def test_localize_and_repair_with_mock_backend(tmp_path, monkeypatch, bug, server):
+    loc_folder = tmp_path / "loc"
+    monkeypatch.setattr(sys, "argv", [
+        "localize.py", "--output_folder", str(loc_folder), "--file_level", "--related_level", "--fine_grain_line_level",
+        "--compress", "--top_n", "1", "--backend", "mock", "--model", "mock-model", "--target_id", INSTANCE_ID,
+    ])
+    localize.main()
+
+    locs = [json.loads(line) for line in open(loc_folder / "loc_outputs.jsonl")]
+    assert len(locs) == 1
+    assert locs[0]["found_files"] == ["requests/utils.py"]
+    assert [related_locs.strip() for related_locs in locs[0]["found_related_locs"][0]] == ["function: add_numbers"]
+    # the tool call of the search step was answered, and its result was shown to the file level prompt
+    log = open(loc_folder / "localization_logs" / f"{INSTANCE_ID}.log").read()
+    assert "add_numbers is in: requests/utils.py" in log
+
+    repair_folder = tmp_path / "repair"
+    (repair_folder / "repair_logs").mkdir(parents=True)
+    monkeypatch.setattr(repair, "locs_global", locs)
+    args = argparse.Namespace(
+        benchmark="lite",
+        task_ids_to_repair=[INSTANCE_ID],
+        output_folder=str(repair_folder),
+        output_file=str(repair_folder / "output.jsonl"),
+        raw_output_file=str(repair_folder / "output.jsonl"),
+        reproduce_folder=str(tmp_path / "reproduce"),
+        verify_folder=str(tmp_path / "verify"),
+        tasks_list=[],
+        model="mock-model",
+        backend="mock",
+        max_samples=1,
+        num_samples=1,
+        batch_size=1,
+        sample_mod=True,
+        refine_mod=False,
+        best_patch_file=None,
+        top_n=1,
+        loc_interval=False,
+        context_window=10,
+        fine_grain_loc_only=False,
+        add_space=False,
+        sticky_scroll=False,
+        intended_behavior=False,
+        diverse=False,
+        mock=False,
+        num_threads=1,
+    )
+    repair.repair(args)
+
+    processed = [json.loads(line) for line in open(repair_folder / "output_0_processed.jsonl")]
+    assert [result["instance_id"] for result in processed] == [INSTANCE_ID]
+    assert "-    return a - b\n+    return a + b\n" in processed[0]["model_patch"]
+    assert subprocess.run(
+        ["git", "apply", "--check", "-"], input=processed[0]["model_patch"].encode("utf-8"), cwd=tmp_path / "requests"
+    ).returncode == 0
+    assert server.num_requests > 0